@@ -1,31 +1,612 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, g, has_app_context, has_request_context
+from flask import Response, stream_with_context
 from flask_cors import CORS
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import qrcode
+import qrcode.image.svg
+from PIL import Image, ImageDraw, ImageFont
 import sqlite3
 import os
-from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
 import json
+import atexit
+import bisect
+import click
+import csv
+import fcntl
+import functools
+import hashlib
+import io
+import mimetypes
+import queue
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeout
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
 
 app = Flask(__name__)
 CORS(app)
 
 # === RUTAS ABSOLUTAS PARA RENDER / SERVIDOR ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, "colegios.db")
-UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+DB_FILE = os.environ.get("DB_FILE", os.path.join(BASE_DIR, "colegios.db"))
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", os.path.join(BASE_DIR, "uploads"))
+UPLOAD_TMP = os.path.join(UPLOAD_FOLDER, ".tmp")
+os.makedirs(UPLOAD_TMP, exist_ok=True)
+
+
+# === CONFIGURACIÓN SQLITE (se puede ajustar con variables de entorno) ===
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", "-16000"))  # negativo = KiB
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(128 * 1024 * 1024)))
+SQLITE_TEMP_STORE = os.environ.get("SQLITE_TEMP_STORE", "MEMORY")
+SQLITE_STMT_CACHE = int(os.environ.get("SQLITE_STMT_CACHE", "256"))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+
+
+def _abrir_conexion(ruta=DB_FILE):
+    """Abre una conexión nueva con los PRAGMAs aplicados una sola vez."""
+    conn = sqlite3.connect(
+        ruta,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+        check_same_thread=False,
+        cached_statements=SQLITE_STMT_CACHE,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
+    if ruta != DB_FILE:
+        # shard: las tablas centrales (usuarios, colegios...) se resuelven en "central"
+        conn.execute("ATTACH DATABASE ? AS central", (DB_FILE,))
+    return conn
 
 
-def get_conn():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+class PooledConnection:
+    """
+    Envoltorio de una conexión del pool. Se usa igual que sqlite3.Connection,
+    pero close() la devuelve al pool en lugar de cerrarla.
+    """
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._adjuntos = []  # archivos con ATTACH, se sueltan al devolverla
+        self._pendientes = {}  # mediciones de CursorMedido aún sin registrar
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def cursor(self):
+        raw = self._raw.cursor()
+        return CursorMedido(raw, self._pendientes) if METRICAS or CONSULTAS_LENTAS_MS > 0 else raw
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, filas):
+        return self.cursor().executemany(sql, filas)
+
+    def __enter__(self):
+        self._raw.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._raw.__exit__(*exc)
+
+    def close(self):
+        if self._raw is not None:
+            # lo que no se leyó hasta el final se registra aquí, con la conexión aún propia
+            for medicion in list(self._pendientes.values()):
+                registrar_consulta(self._raw, medicion)
+            self._pendientes.clear()
+            raw, self._raw = self._raw, None
+            try:
+                if self._adjuntos and raw.in_transaction:
+                    raw.rollback()
+                for esquema in self._adjuntos:
+                    raw.execute(f"DETACH DATABASE {esquema}")
+            except sqlite3.Error:
+                raw.close()  # release() la descarta
+            self._pool.release(raw)
+
+
+class ConnectionPool:
+    """Pool de conexiones SQLite por proceso (compartido entre hilos del worker)."""
+
+    def __init__(self, size, timeout, ruta=DB_FILE):
+        self.size = size
+        self.timeout = timeout
+        self.ruta = ruta
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._creadas = 0
+        self._en_uso = 0
+        self._checkouts = 0
+        self._esperas = 0
+        self._timeouts = 0
+        self._checkout_total = 0.0
+        self._checkout_max = 0.0
+
+    def acquire(self):
+        inicio = time.perf_counter()
+        with self._lock:
+            # tras un fork (gunicorn --preload) no se heredan conexiones del padre
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle
+            raw = None
+            try:
+                raw = idle.get_nowait()
+            except queue.Empty:
+                if self._creadas < self.size:
+                    self._creadas += 1
+                    raw = False  # marcador: crear fuera del lock
+        if raw is False:
+            try:
+                raw = _abrir_conexion(self.ruta)
+            except Exception:
+                with self._lock:
+                    self._creadas -= 1
+                raise
+        elif raw is None:
+            with self._lock:
+                self._esperas += 1
+            try:
+                raw = idle.get(timeout=self.timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._timeouts += 1
+                raise RuntimeError("pool de conexiones agotado")
+        espera = time.perf_counter() - inicio
+        if METRICAS:
+            metricas.observar("db_pool_wait_seconds", (os.path.basename(self.ruta),), espera)
+        with self._lock:
+            self._en_uso += 1
+            self._checkouts += 1
+            self._checkout_total += espera
+            self._checkout_max = max(self._checkout_max, espera)
+        return PooledConnection(self, raw)
+
+    def release(self, raw):
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+        except sqlite3.Error:
+            # conexión rota: se descarta y se libera su cupo
+            with self._lock:
+                self._creadas -= 1
+                self._en_uso -= 1
+            return
+        with self._lock:
+            self._en_uso -= 1
+            if self._pid == os.getpid():
+                self._idle.put(raw)
+                return
+        raw.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": self._pid,
+                "db": os.path.basename(self.ruta),
+                "max_size": self.size,
+                "size": self._creadas,
+                "idle": self._idle.qsize(),
+                "in_use": self._en_uso,
+                "checkouts": self._checkouts,
+                "waits": self._esperas,
+                "timeouts": self._timeouts,
+                "checkout_avg_ms": round(self._checkout_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                "checkout_max_ms": round(self._checkout_max * 1000, 3),
+            }
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT)
+
+
+# =============== SHARDS POR COLEGIO (opcional) ===============
+# Con DB_SHARDS=1 cada colegio migrado (flask partir-colegios) tiene su propio
+# archivo en shards/, así la escritura de un colegio no bloquea a los demás.
+# colegios.db queda como base central (colegios, usuarios, versiones de caché,
+# mapa de shards) y se adjunta como "central" a cada shard: las consultas sin
+# prefijo a usuarios/colegios siguen funcionando igual. Los colegios aún no
+# migrados siguen en colegios.db.
+DB_SHARDS = os.environ.get("DB_SHARDS", "0") == "1"
+SHARDS_DIR = os.path.join(BASE_DIR, "shards")
+# los ids nuevos de un shard empiezan en indice * SHARD_ID_RANGO,
+# así una ruta que solo trae el id sabe a qué shard ir
+SHARD_ID_RANGO = 10 ** 10
+SHARD_MOVIDO = "colegio movido a su shard"  # mensaje de los triggers de la central
+# parámetro de ruta -> tabla, para las rutas que no traen el colegio
+RUTA_ID_TABLA = {
+    "doc_id": "documentos",
+    "evento_id": "eventos",
+    "qr_id": "asistencia_qr",
+    "curso_id": "cursos",
+    "est_id": "estudiantes",
+    "com_id": "comisiones",
+    "prof_id": "profesores",
+}
+# tablas mantenidas por triggers: al partir se rellenan solas
+TABLAS_DERIVADAS = ("archivos", "asistencia_resumen_diario", "asistencia_registro_campos", "sync_revisiones")
+
+_shards = {}             # colegio -> (indice, ruta)
+_shards_indice = {}      # indice -> colegio
+_shards_version = None   # meta.shards_version con la que se cargó el mapa
+_shard_pools = {}
+_shards_lock = threading.Lock()
+
+
+def _registrar_conn(conn):
+    # dentro de una petición, el teardown la devuelve aunque la ruta falle
+    if has_app_context():
+        g.setdefault("_db_conns", []).append(conn)
     return conn
 
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+def _version_shards(conn):
+    row = conn.execute("SELECT valor FROM meta WHERE clave='shards_version'").fetchone()
+    return row["valor"] if row else "0"
+
+
+def _cargar_shards():
+    global _shards, _shards_indice, _shards_version
+    conn = db_pool.acquire()
+    try:
+        version = _version_shards(conn)
+        rows = conn.execute("SELECT colegio, indice, archivo FROM shards").fetchall()
+    finally:
+        conn.close()
+    with _shards_lock:
+        _shards = {r["colegio"]: (r["indice"], os.path.join(SHARDS_DIR, r["archivo"])) for r in rows}
+        _shards_indice = {r["indice"]: r["colegio"] for r in rows}
+        _shards_version = version
+
+
+def _verificar_mapa_shards():
+    """
+    Recarga el mapa si otro proceso movió un colegio (meta.shards_version).
+    Una vez por petición; fuera de una petición, en cada llamada.
+    """
+    if has_request_context():
+        if g.get("_mapa_shards_ok"):
+            return
+        g._mapa_shards_ok = True
+    conn = db_pool.acquire()
+    try:
+        version = _version_shards(conn)
+    finally:
+        conn.close()
+    if version != _shards_version:
+        _cargar_shards()
+
+
+def shard_de(colegio):
+    """(indice, ruta) del shard del colegio, o None si sigue en la base central."""
+    if not DB_SHARDS or not colegio:
+        return None
+    _verificar_mapa_shards()
+    return _shards.get(colegio)
+
+
+def colegio_de_id(tabla, fila_id):
+    """Colegio dueño de una fila según su id (None = base central)."""
+    if not DB_SHARDS:
+        return None
+    indice = fila_id // SHARD_ID_RANGO
+    if indice:
+        _verificar_mapa_shards()
+        return _shards_indice.get(indice)
+    conn = db_pool.acquire()
+    try:
+        row = conn.execute("SELECT colegio FROM shard_ids WHERE tabla=? AND id=?",
+                           (tabla, fila_id)).fetchone()
+    finally:
+        conn.close()
+    return row["colegio"] if row else None
+
+
+def _pool_de(colegio):
+    shard = shard_de(colegio)
+    if shard is None:
+        return db_pool
+    ruta = shard[1]
+    pool = _shard_pools.get(ruta)
+    if pool is None:
+        with _shards_lock:
+            pool = _shard_pools.setdefault(ruta, ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, ruta))
+    return pool
+
+
+def _colegio_de_request():
+    """Colegio de la petición: ruta, id de la ruta, ?colegio=, JSON o formulario."""
+    if "_colegio_shard" in g:
+        return g._colegio_shard
+    colegio = None
+    args = request.view_args or {}
+    if "colegio" in args:
+        colegio = args["colegio"]
+    else:
+        for nombre, tabla in RUTA_ID_TABLA.items():
+            if nombre in args:
+                colegio = colegio_de_id(tabla, args[nombre])
+                break
+        else:
+            colegio = request.args.get("colegio")
+            if not colegio and request.is_json:
+                cuerpo = request.get_json(silent=True)
+                if isinstance(cuerpo, dict):
+                    colegio = cuerpo.get("colegio")
+                    if not colegio and isinstance(cuerpo.get("qr_id"), int):
+                        colegio = colegio_de_id("asistencia_qr", cuerpo["qr_id"])
+            elif not colegio and request.mimetype == "multipart/form-data":
+                colegio = request.form.get("colegio")
+    g._colegio_shard = colegio
+    return colegio
+
+
+def get_conn(colegio=None):
+    """
+    Conexión a la base del colegio. Sin argumento, dentro de una petición,
+    el colegio sale de la misma petición; si no, es la base central.
+    """
+    if DB_SHARDS and colegio is None and has_request_context():
+        colegio = _colegio_de_request()
+    return _registrar_conn(_pool_de(colegio).acquire())
+
+
+def conn_central():
+    return _registrar_conn(db_pool.acquire())
+
 
+def iterar_shards():
+    """
+    Recorre la base central y todos los shards: genera (colegio, conexión),
+    con colegio None para la central. Para las pocas consultas globales.
+    """
+    if DB_SHARDS:
+        _cargar_shards()
+    yield None, conn_central()
+    for colegio in sorted(_shards) if DB_SHARDS else ():
+        yield colegio, get_conn(colegio)
+
+
+def _archivo_shard(colegio):
+    base = "".join(ch if ch.isalnum() else "_" for ch in normalizar_texto(colegio))[:40]
+    return f"{base}-{hashlib.sha1(colegio.encode('utf-8')).hexdigest()[:8]}.db"
+
+
+def crear_shard(colegio):
+    """
+    Crea el shard de un colegio y mueve sus datos desde la base central.
+    Mientras copia tiene tomada la escritura de la central (BEGIN IMMEDIATE),
+    así que nadie puede escribir filas del colegio que queden sin copiar; con
+    muchos datos conviene correrlo fuera de horario (flask partir-colegios).
+    """
+    os.makedirs(SHARDS_DIR, exist_ok=True)
+    archivo = _archivo_shard(colegio)
+    ruta = os.path.join(SHARDS_DIR, archivo)
+    central = sqlite3.connect(DB_FILE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0, isolation_level=None)
+    central.row_factory = sqlite3.Row
+    c = central.cursor()
+    shard = None
+    try:
+        if c.execute("SELECT 1 FROM shards WHERE colegio=?", (colegio,)).fetchone():
+            return False
+        # restos de un intento anterior que no llegó a registrarse
+        for sufijo in ("", "-wal", "-shm"):
+            if os.path.exists(ruta + sufijo):
+                os.unlink(ruta + sufijo)
+        init_db(ruta, central=False)
+        shard = _abrir_conexion(ruta)  # con la central adjunta como "central"
+        shard.isolation_level = None
+        shard.execute("PRAGMA synchronous=FULL")
+
+        tablas = [r["name"] for r in shard.execute("""
+            SELECT name FROM main.sqlite_master
+            WHERE type='table' AND name NOT LIKE 'sqlite_%'
+        """)]
+        por_colegio = {}
+        for tabla in tablas:
+            columnas = [r["name"] for r in shard.execute(f"PRAGMA main.table_info({tabla})")]
+            if "colegio" in columnas:
+                por_colegio[tabla] = ("colegio = ?", columnas)
+            elif tabla == "asistencia_registros":
+                por_colegio[tabla] = ("qr_id IN (SELECT id FROM {s}.asistencia_qr WHERE colegio = ?)", columnas)
+
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            indice = c.execute("SELECT COALESCE(MAX(indice), 0) + 1 FROM shards").fetchone()[0]
+            # tope de ids: solo se copia y se borra lo que existía al tomar el lock
+            topes = {}
+            for tabla, (_filtro, columnas) in por_colegio.items():
+                if "id" in columnas:
+                    topes[tabla] = c.execute(f"SELECT IFNULL(MAX(id), 0) FROM main.{tabla}").fetchone()[0]
+
+            def condicion(tabla, esquema):
+                filtro = por_colegio[tabla][0].format(s=esquema)
+                return filtro + (f" AND id <= {int(topes[tabla])}" if tabla in topes else "")
+
+            # 1) copiar al shard y dejarlo en disco (fsync) antes de tocar la central
+            # BEGIN simple: IMMEDIATE tomaría también la central adjunta
+            shard.execute("BEGIN")
+            for tabla, (_filtro, columnas) in por_colegio.items():
+                if tabla in TABLAS_DERIVADAS:
+                    continue
+                cols = ", ".join(columnas)
+                shard.execute(f"""
+                    INSERT INTO main.{tabla} ({cols})
+                    SELECT {cols} FROM central.{tabla} WHERE {condicion(tabla, "central")}
+                """, (colegio,))
+            base = indice * SHARD_ID_RANGO
+            for r in shard.execute("SELECT name FROM main.sqlite_master WHERE sql LIKE '%AUTOINCREMENT%'").fetchall():
+                shard.execute("DELETE FROM main.sqlite_sequence WHERE name=?", (r["name"],))
+                shard.execute("INSERT INTO main.sqlite_sequence (name, seq) VALUES (?, ?)", (r["name"], base))
+            shard.execute("COMMIT")
+
+            # 2) en la misma transacción de la central: registrar ids viejos y el shard,
+            #    borrar lo copiado y avisar a los demás workers que el mapa cambió
+            c.execute("ATTACH DATABASE ? AS shard", (ruta,))
+            for tabla in RUTA_ID_TABLA.values():
+                c.execute(f"""
+                    INSERT OR REPLACE INTO main.shard_ids (tabla, id, colegio)
+                    SELECT ?, id, ? FROM shard.{tabla}
+                """, (tabla, colegio))
+            for tabla in ["asistencia_registros"] + [t for t in por_colegio if t != "asistencia_registros"]:
+                c.execute(f"DELETE FROM main.{tabla} WHERE {condicion(tabla, 'main')}", (colegio,))
+            # los borrados de arriba dejaron marcas de sincronización en la central
+            c.execute("DELETE FROM main.sync_revisiones WHERE colegio = ?", (colegio,))
+            # una petición que eligió la central antes de este commit no puede
+            # dejar filas huérfanas: su INSERT falla y se reintenta (ver abajo)
+            for tabla, (filtro, _columnas) in por_colegio.items():
+                if filtro == "colegio = ?" and tabla not in TABLAS_DERIVADAS:
+                    c.execute(f"""
+                        CREATE TRIGGER IF NOT EXISTS main.trg_shard_movido_{tabla}
+                        BEFORE INSERT ON {tabla}
+                        WHEN EXISTS (SELECT 1 FROM shards WHERE colegio = NEW.colegio)
+                        BEGIN
+                            SELECT RAISE(ABORT, '{SHARD_MOVIDO}');
+                        END
+                    """)
+            c.execute("INSERT INTO main.shards (colegio, indice, archivo) VALUES (?, ?, ?)",
+                      (colegio, indice, archivo))
+            c.execute("""
+                INSERT INTO main.meta (clave, valor) VALUES ('shards_version', '1')
+                ON CONFLICT (clave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1
+            """)
+            c.execute("COMMIT")
+        except BaseException:
+            if central.in_transaction:
+                c.execute("ROLLBACK")
+            if shard.in_transaction:
+                shard.execute("ROLLBACK")
+            raise
+    finally:
+        if shard is not None:
+            shard.close()
+        central.close()
+    _cargar_shards()
+    return True
+
+
+@app.errorhandler(sqlite3.IntegrityError)
+def _colegio_movido(e):
+    if SHARD_MOVIDO in str(e):
+        return jsonify({"error": "colegio en mantenimiento, reintente"}), 503, {"Retry-After": "1"}
+    raise e
+
+
+@app.cli.command("partir-colegios")
+@click.argument("colegios", nargs=-1)
+def partir_colegios_cmd(colegios):
+    """
+    Mueve cada colegio (o solo los indicados) a su propio shard.
+    flask --app app partir-colegios ["LAS ROSAS" ...]   (con DB_SHARDS=1 al servir)
+    """
+    if not colegios:
+        conn = conn_central()
+        colegios = [r["nombre"] for r in conn.execute("SELECT nombre FROM colegios ORDER BY nombre")]
+        conn.close()
+    for colegio in colegios:
+        inicio = time.perf_counter()
+        if crear_shard(colegio):
+            print(f"  {colegio}: shard creado ({time.perf_counter() - inicio:.1f}s)")
+        else:
+            print(f"  {colegio}: ya tenía shard")
+
+
+@app.teardown_appcontext
+def _devolver_conexiones(exc):
+    for conn in g.pop("_db_conns", []):
+        conn.close()
+
+
+def iterar_consulta(sql, params=(), tam=500, conn=None):
+    """
+    Genera bloques de filas (fetchmany) para respuestas en streaming.
+    Usar con stream_with_context; la conexión se devuelve al terminar.
+    """
+    if conn is None:
+        conn = get_conn()
+    try:
+        c = conn.cursor()
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(tam)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+class _EcoCSV:
+    """'Archivo' para csv.writer que devuelve la línea en vez de guardarla."""
+
+    def write(self, valor):
+        return valor
+
+
+def respuesta_csv(generador, nombre_archivo):
+    # BOM para que Excel abra bien las tildes
+    def con_bom():
+        yield "\ufeff"
+        yield from generador
+    resp = Response(stream_with_context(con_bom()), mimetype="text/csv")
+    resp.headers.set("Content-Disposition", "attachment", **_disposicion(nombre_archivo))
+    return resp
+
+
+def _agregar_columnas(c, tabla, columnas):
+    """ALTER TABLE ADD COLUMN para las columnas que falten (BD creadas antes)."""
+    existentes = {r[1] for r in c.execute(f"PRAGMA table_info({tabla})").fetchall()}
+    for nombre, tipo in columnas:
+        if nombre in existentes:
+            continue
+        try:
+            c.execute(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}")
+        except sqlite3.OperationalError as e:
+            # otro worker la agregó primero
+            if "duplicate column" not in str(e):
+                raise
+
+
+# Copia cada clave del JSON de una respuesta QR a asistencia_registro_campos.
+# {r} es NEW dentro del trigger o el alias de la tabla al reconstruir.
+_SQL_REGISTRO_CAMPOS = """
+    INSERT INTO asistencia_registro_campos (registro_id, qr_id, campo, valor)
+    SELECT {r}.id, {r}.qr_id, j.key,
+           CASE j.type WHEN 'true' THEN 'true' WHEN 'false' THEN 'false'
+                ELSE CAST(j.value AS TEXT) END
+    FROM {desde}json_each(COALESCE(
+        CASE WHEN json_valid({r}.datos) THEN
+            CASE WHEN json_type({r}.datos) = 'object' THEN {r}.datos END
+        END, '{{}}')) AS j
+    WHERE j.type != 'null'
+"""
+
+
+def _init_tablas_centrales(conn, c):
+    """Tablas que con DB_SHARDS=1 quedan solo en la base central."""
     # colegios
     c.execute("""
     CREATE TABLE IF NOT EXISTS colegios (
@@ -34,19 +615,6 @@ def init_db():
     )
     """)
 
-    # =============== ASISTENCIA BIOMÉTRICA (ENTRADA / SALIDA) ===============
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS asistencia_marcaciones (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        colegio TEXT,
-        usuario_id INTEGER,
-        usuario_nombre TEXT,
-        email TEXT,
-        tipo TEXT,             -- 'entrada' o 'salida'
-        timestamp TEXT DEFAULT (datetime('now','localtime'))
-    )
-    """)
-
     # ===== usuarios con UNIQUE(email, colegio) =====
     c.execute("""
     CREATE TABLE IF NOT EXISTS usuarios (
@@ -87,6 +655,74 @@ def init_db():
     except Exception as e:
         print("Aviso migración usuarios:", e)
 
+    # versiones por colegio de los catálogos cacheados (ETag)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS cache_versiones (
+        colegio TEXT,
+        recurso TEXT,
+        version INTEGER DEFAULT 0,
+        PRIMARY KEY (colegio, recurso)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+        clave TEXT PRIMARY KEY,
+        valor TEXT
+    )
+    """)
+    # identifica esta BD para que un ETag no sobreviva a un reemplazo del archivo
+    c.execute("INSERT OR IGNORE INTO meta (clave, valor) VALUES ('cache_epoch', ?)",
+              (secrets.token_hex(4),))
+
+    # tokens cerrados con /logout (ver SESIÓN), compartidos por todos los workers
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sesiones_revocadas (
+        jti TEXT PRIMARY KEY,
+        vence REAL
+    ) WITHOUT ROWID
+    """)
+
+    # mapa de shards por colegio (ver SHARDS POR COLEGIO)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shards (
+        colegio TEXT PRIMARY KEY,
+        indice INTEGER UNIQUE,
+        archivo TEXT
+    )
+    """)
+    # ids anteriores a la migración: qué colegio tiene cada fila direccionable por id
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shard_ids (
+        tabla TEXT,
+        id INTEGER,
+        colegio TEXT,
+        PRIMARY KEY (tabla, id)
+    ) WITHOUT ROWID
+    """)
+
+
+def init_db(ruta=DB_FILE, central=True):
+    """Crea o migra el esquema. Los shards (central=False) no llevan las tablas centrales."""
+    conn = sqlite3.connect(ruta)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+
+    if central:
+        _init_tablas_centrales(conn, c)
+
+    # =============== ASISTENCIA BIOMÉTRICA (ENTRADA / SALIDA) ===============
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS asistencia_marcaciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        colegio TEXT,
+        usuario_id INTEGER,
+        usuario_nombre TEXT,
+        email TEXT,
+        tipo TEXT,             -- 'entrada' o 'salida'
+        timestamp TEXT DEFAULT (datetime('now','localtime'))
+    )
+    """)
+
     # documentos
     c.execute("""
     CREATE TABLE IF NOT EXISTS documentos (
@@ -99,6 +735,44 @@ def init_db():
         creado_en DATETIME DEFAULT CURRENT_TIMESTAMP
     )
     """)
+    _agregar_columnas(c, "documentos", [("sha256", "TEXT"), ("tamano", "INTEGER"), ("mime", "TEXT")])
+
+    # archivos físicos por contenido (uploads/ab/cd/<sha256>) con contador de referencias
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS archivos (
+        sha256 TEXT PRIMARY KEY,
+        tamano INTEGER,
+        mime TEXT,
+        refs INTEGER DEFAULT 0,
+        creado_en DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_archivos_ref_ins
+    AFTER INSERT ON documentos WHEN NEW.sha256 IS NOT NULL
+    BEGIN
+        INSERT INTO archivos (sha256, tamano, mime, refs) VALUES (NEW.sha256, NEW.tamano, NEW.mime, 1)
+        ON CONFLICT (sha256) DO UPDATE SET refs = refs + 1;
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_archivos_ref_upd
+    AFTER UPDATE OF sha256 ON documentos
+    WHEN OLD.sha256 IS NOT NEW.sha256
+    BEGIN
+        UPDATE archivos SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+        INSERT INTO archivos (sha256, tamano, mime, refs)
+        SELECT NEW.sha256, NEW.tamano, NEW.mime, 1 WHERE NEW.sha256 IS NOT NULL
+        ON CONFLICT (sha256) DO UPDATE SET refs = refs + 1;
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_archivos_ref_del
+    AFTER DELETE ON documentos WHEN OLD.sha256 IS NOT NULL
+    BEGIN
+        UPDATE archivos SET refs = refs - 1 WHERE sha256 = OLD.sha256;
+    END
+    """)
 
     # categorias de doc
     c.execute("""
@@ -132,6 +806,16 @@ def init_db():
         fecha_fin TEXT
     )
     """)
+    # eventos recurrentes: regla JSON y fecha de la última repetición (NULL = sin fin)
+    _agregar_columnas(c, "eventos", [("regla", "TEXT"), ("serie_fin", "TEXT")])
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_eventos_ventana
+    ON eventos (colegio, fecha_inicio, fecha_fin)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_eventos_recurrentes
+    ON eventos (colegio, fecha_inicio) WHERE regla IS NOT NULL
+    """)
 
     # asistencia QR (cabecera)
     c.execute("""
@@ -221,8 +905,958 @@ def init_db():
     )
     """)
 
+    # índices para los reportes por rango de fechas (timestamp se guarda
+    # como 'YYYY-MM-DD HH:MM:SS', así que se compara directo sin date()).
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_marcaciones_colegio_ts
+    ON asistencia_marcaciones (colegio, timestamp)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_marcaciones_colegio_usuario_ts
+    ON asistencia_marcaciones (colegio, usuario_nombre, email, timestamp)
+    """)
+
+    conn.commit()
+
+    # resumen diario por usuario, mantenido por triggers sobre las marcaciones
+    c.execute("BEGIN IMMEDIATE")
+    existia = c.execute("""
+        SELECT 1 FROM sqlite_master WHERE type='table' AND name='asistencia_resumen_diario'
+    """).fetchone()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS asistencia_resumen_diario (
+        colegio TEXT,
+        fecha TEXT,
+        usuario_nombre TEXT,
+        email TEXT,
+        entradas INTEGER DEFAULT 0,
+        salidas INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0
+    )
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_resumen_diario_clave
+    ON asistencia_resumen_diario (colegio, fecha, usuario_nombre, email)
+    """)
+    # se compara con IS para que NULL cuente como un valor más (igual que GROUP BY)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_resumen_diario_ins
+    AFTER INSERT ON asistencia_marcaciones
+    BEGIN
+        UPDATE asistencia_resumen_diario
+        SET entradas = entradas + (NEW.tipo = 'entrada'),
+            salidas = salidas + (NEW.tipo = 'salida'),
+            total = total + 1
+        WHERE colegio IS NEW.colegio AND fecha IS date(NEW.timestamp)
+          AND usuario_nombre IS NEW.usuario_nombre AND email IS NEW.email;
+        INSERT INTO asistencia_resumen_diario (colegio, fecha, usuario_nombre, email, entradas, salidas, total)
+        SELECT NEW.colegio, date(NEW.timestamp), NEW.usuario_nombre, NEW.email,
+               (NEW.tipo = 'entrada'), (NEW.tipo = 'salida'), 1
+        WHERE changes() = 0;
+    END
+    """)
+    # ids que se están pasando al archivo anual: su borrado no descuenta del resumen
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS marcaciones_archivando (
+        id INTEGER PRIMARY KEY
+    )
+    """)
+    row = c.execute("""
+        SELECT sql FROM sqlite_master WHERE type='trigger' AND name='trg_resumen_diario_del'
+    """).fetchone()
+    if row and "marcaciones_archivando" not in row["sql"]:
+        c.execute("DROP TRIGGER trg_resumen_diario_del")
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_resumen_diario_del
+    AFTER DELETE ON asistencia_marcaciones
+    WHEN NOT EXISTS (SELECT 1 FROM marcaciones_archivando WHERE id = OLD.id)
+    BEGIN
+        UPDATE asistencia_resumen_diario
+        SET entradas = entradas - (OLD.tipo = 'entrada'),
+            salidas = salidas - (OLD.tipo = 'salida'),
+            total = total - 1
+        WHERE colegio IS OLD.colegio AND fecha IS date(OLD.timestamp)
+          AND usuario_nombre IS OLD.usuario_nombre AND email IS OLD.email;
+        DELETE FROM asistencia_resumen_diario
+        WHERE colegio IS OLD.colegio AND fecha IS date(OLD.timestamp)
+          AND usuario_nombre IS OLD.usuario_nombre AND email IS OLD.email
+          AND total <= 0;
+    END
+    """)
+    if not existia:
+        reconstruir_resumen_diario(c)
+    conn.commit()
+
+    # personas que marcaron en cada colegio (para el buscador del biométrico)
+    c.execute("BEGIN IMMEDIATE")
+    existia = c.execute("""
+        SELECT 1 FROM sqlite_master WHERE type='table' AND name='asistencia_personas'
+    """).fetchone()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS asistencia_personas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        colegio TEXT,
+        usuario_nombre TEXT,
+        email TEXT,
+        nombre_norm TEXT,      -- minúsculas y sin tildes
+        email_norm TEXT,
+        total INTEGER DEFAULT 0
+    )
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_personas_clave
+    ON asistencia_personas (colegio, usuario_nombre, email)
+    """)
+    if not existia:
+        reconstruir_personas(c)
+    conn.commit()
+
+    # respuestas de formularios QR campo por campo, para filtrar y contar en SQL
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_registros_qr_creado
+    ON asistencia_registros (qr_id, creado_en)
+    """)
+    c.execute("BEGIN IMMEDIATE")
+    existia = c.execute("""
+        SELECT 1 FROM sqlite_master WHERE type='table' AND name='asistencia_registro_campos'
+    """).fetchone()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS asistencia_registro_campos (
+        registro_id INTEGER,
+        qr_id INTEGER,
+        campo TEXT,
+        valor TEXT COLLATE NOCASE
+    )
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_registro_campos_valor
+    ON asistencia_registro_campos (qr_id, campo, valor)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_registro_campos_registro
+    ON asistencia_registro_campos (registro_id)
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_registro_campos_ins
+    AFTER INSERT ON asistencia_registros
+    BEGIN
+        {_SQL_REGISTRO_CAMPOS.format(r="NEW", desde="")};
+    END
+    """)
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_registro_campos_del
+    AFTER DELETE ON asistencia_registros
+    BEGIN
+        DELETE FROM asistencia_registro_campos WHERE registro_id = OLD.id;
+    END
+    """)
+    if not existia:
+        c.execute(_SQL_REGISTRO_CAMPOS.format(r="r", desde="asistencia_registros AS r, "))
     conn.commit()
+
+    # años pasados al archivo (ver ARCHIVO ANUAL DE ASISTENCIA)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS asistencia_archivos (
+        anio INTEGER PRIMARY KEY,
+        archivo TEXT
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS asistencia_qr_archivo (
+        qr_id INTEGER,
+        anio INTEGER,
+        PRIMARY KEY (qr_id, anio)
+    ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+    # horarios descompuestos en intervalos (minutos desde 00:00) para consultas
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS horario_periodos (
+        colegio TEXT,
+        periodo INTEGER,
+        inicio TEXT,           -- 'HH:MM'
+        fin TEXT,
+        PRIMARY KEY (colegio, periodo)
+    )
+    """)
+    c.execute("BEGIN IMMEDIATE")
+    existia = c.execute("""
+        SELECT 1 FROM sqlite_master WHERE type='table' AND name='horario_intervalos'
+    """).fetchone()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS horario_intervalos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        colegio TEXT,
+        docente TEXT,
+        dia TEXT,              -- Lun, Mar, Mie, Jue, Vie, Sab, Dom
+        inicio INTEGER,
+        fin INTEGER,
+        periodo INTEGER,
+        curso TEXT,
+        aula TEXT
+    )
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_intervalos_dia
+    ON horario_intervalos (colegio, dia, inicio)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_intervalos_aula
+    ON horario_intervalos (colegio, aula, dia, inicio)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_intervalos_curso
+    ON horario_intervalos (colegio, curso, dia, inicio)
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_intervalos_docente
+    ON horario_intervalos (colegio, docente)
+    """)
+    if not existia:
+        for row in c.execute("SELECT DISTINCT colegio FROM horarios").fetchall():
+            reindexar_horarios(c, row["colegio"])
+    conn.commit()
+
+    # revisiones para la sincronización incremental de la app (ver /sync)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sync_estado (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        rev INTEGER NOT NULL,
+        epoca TEXT NOT NULL,                 -- cambia si la base se rehace: el cliente resincroniza todo
+        podado_hasta INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("""
+        INSERT OR IGNORE INTO sync_estado (id, rev, epoca) VALUES (1, 0, lower(hex(randomblob(8))))
+    """)
+    existia = c.execute("""
+        SELECT 1 FROM sqlite_master WHERE type='table' AND name='sync_revisiones'
+    """).fetchone()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sync_revisiones (
+        tabla TEXT,
+        fila_id INTEGER,
+        colegio TEXT,
+        rev INTEGER,
+        borrado INTEGER,
+        cambiado_en TEXT,
+        PRIMARY KEY (tabla, fila_id, colegio)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_sync_colegio_rev
+    ON sync_revisiones (colegio, rev)
+    """)
+    for tabla in SYNC_TABLAS:
+        for evento, sql in _sql_triggers_sync(tabla).items():
+            c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_sync_{tabla}_{evento}
+            AFTER {evento.upper()} ON {tabla}
+            BEGIN
+                {sql}
+            END
+            """)
+        if not existia:
+            c.execute(f"""
+                INSERT INTO sync_revisiones (tabla, fila_id, colegio, rev, borrado, cambiado_en)
+                SELECT '{tabla}', id, IFNULL(colegio, ''),
+                       (SELECT rev FROM sync_estado) + ROW_NUMBER() OVER (ORDER BY id),
+                       0, datetime('now','localtime')
+                FROM {tabla}
+            """)
+            c.execute("""
+                UPDATE sync_estado SET rev = MAX(rev, IFNULL((SELECT MAX(rev) FROM sync_revisiones), 0))
+            """)
+    conn.commit()
+    conn.close()
+
+
+# tablas que la app guarda offline; cada cambio recibe una revisión creciente
+SYNC_TABLAS = ("estudiantes", "profesores", "cursos", "eventos", "documentos")
+
+_SQL_SYNC_MARCA = """
+    INSERT INTO sync_revisiones (tabla, fila_id, colegio, rev, borrado, cambiado_en)
+    SELECT '{tabla}', {r}.id, IFNULL({r}.colegio, ''), (SELECT rev FROM sync_estado), {borrado},
+           datetime('now','localtime')
+    WHERE {cond}
+    ON CONFLICT (tabla, fila_id, colegio) DO UPDATE
+    SET rev = excluded.rev, borrado = excluded.borrado, cambiado_en = excluded.cambiado_en;
+"""
+
+
+def _sql_triggers_sync(tabla):
+    """Cuerpo de los triggers insert/update/delete que marcan la revisión de cada fila."""
+    subir = "UPDATE sync_estado SET rev = rev + 1;"
+    alta = _SQL_SYNC_MARCA.format(tabla=tabla, r="NEW", borrado=0, cond="1")
+    return {
+        "insert": subir + alta,
+        # si la fila cambió de colegio, el colegio anterior la ve como borrada
+        "update": subir + alta + _SQL_SYNC_MARCA.format(
+            tabla=tabla, r="OLD", borrado=1, cond="OLD.colegio IS NOT NEW.colegio"),
+        "delete": subir + _SQL_SYNC_MARCA.format(tabla=tabla, r="OLD", borrado=1, cond="1"),
+    }
+
+
+def reconstruir_resumen_diario(c, esquemas=("main",)):
+    """
+    Recalcula asistencia_resumen_diario desde las marcaciones (de la base y
+    de los archivos adjuntos en `esquemas`). No hace commit.
+    """
+    marcaciones = union_archivos(esquemas, """
+        SELECT colegio, timestamp, usuario_nombre, email, tipo FROM {t}.asistencia_marcaciones
+    """)
+    c.execute("DELETE FROM asistencia_resumen_diario")
+    c.execute(f"""
+        INSERT INTO asistencia_resumen_diario (colegio, fecha, usuario_nombre, email, entradas, salidas, total)
+        SELECT colegio,
+               date(timestamp),
+               usuario_nombre,
+               email,
+               SUM(CASE WHEN tipo='entrada' THEN 1 ELSE 0 END),
+               SUM(CASE WHEN tipo='salida' THEN 1 ELSE 0 END),
+               COUNT(*)
+        FROM ({marcaciones})
+        GROUP BY colegio, date(timestamp), usuario_nombre, email
+    """)
+
+
+def normalizar_texto(texto):
+    """Minúsculas y sin tildes: 'José Pérez' -> 'jose perez'."""
+    if not texto:
+        return ""
+    descompuesto = unicodedata.normalize("NFKD", str(texto))
+    return "".join(ch for ch in descompuesto if not unicodedata.combining(ch)).lower().strip()
+
+
+def _sumar_personas(c, conteos):
+    """Suma marcaciones a asistencia_personas. conteos: {(colegio, nombre, email): n}."""
+    for (colegio, nombre, email), n in conteos.items():
+        # IS para que NULL cuente como un valor más (igual que el GROUP BY original)
+        c.execute("""
+            UPDATE asistencia_personas SET total = total + ?
+            WHERE colegio IS ? AND usuario_nombre IS ? AND email IS ?
+        """, (n, colegio, nombre, email))
+        if c.rowcount == 0:
+            c.execute("""
+                INSERT INTO asistencia_personas (colegio, usuario_nombre, email, nombre_norm, email_norm, total)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (colegio, nombre, email, normalizar_texto(nombre), normalizar_texto(email), n))
+
+
+def reconstruir_personas(c, esquemas=("main",)):
+    """Recalcula asistencia_personas desde las marcaciones (y sus archivos). No hace commit."""
+    marcaciones = union_archivos(esquemas, """
+        SELECT colegio, usuario_nombre, email FROM {t}.asistencia_marcaciones
+    """)
+    c.execute("DELETE FROM asistencia_personas")
+    rows = c.execute(f"""
+        SELECT colegio, usuario_nombre, email, COUNT(*) AS total
+        FROM ({marcaciones})
+        GROUP BY colegio, usuario_nombre, email
+    """).fetchall()
+    c.executemany("""
+        INSERT INTO asistencia_personas (colegio, usuario_nombre, email, nombre_norm, email_norm, total)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (r[0], r[1], r[2], normalizar_texto(r[1]), normalizar_texto(r[2]), r[3])
+        for r in rows
+    ])
+
+
+@app.cli.command("reconstruir-personas")
+def reconstruir_personas_cmd():
+    """Recalcula la tabla de personas del buscador (flask --app app reconstruir-personas)."""
+    total = 0
+    for _colegio, conn in iterar_shards():
+        c = conn.cursor()
+        esquemas = adjuntar_archivos(conn, anios_archivados(c))
+        c.execute("BEGIN IMMEDIATE")
+        reconstruir_personas(c, esquemas)
+        conn.commit()
+        total += c.execute("SELECT COUNT(*) FROM asistencia_personas").fetchone()[0]
+        conn.close()
+    print(f"personas reconstruidas: {total} filas")
+
+
+@app.cli.command("reconstruir-resumen")
+def reconstruir_resumen_cmd():
+    """Recalcula el resumen diario de marcaciones (flask --app app reconstruir-resumen)."""
+    total = 0
+    for _colegio, conn in iterar_shards():
+        c = conn.cursor()
+        esquemas = adjuntar_archivos(conn, anios_archivados(c))
+        c.execute("BEGIN IMMEDIATE")
+        reconstruir_resumen_diario(c, esquemas)
+        conn.commit()
+        total += c.execute("SELECT COUNT(*) FROM asistencia_resumen_diario").fetchone()[0]
+        conn.close()
+    print(f"resumen diario reconstruido: {total} filas")
+
+
+# =============== MÉTRICAS (formato Prometheus) ===============
+# Cada worker acumula en memoria latencia por endpoint, códigos de estado,
+# tiempo y filas por consulta SQL y espera del pool, y cada METRICAS_FLUSH_S
+# segundos deja una foto en METRICAS_DIR. /metrics suma las fotos de todos
+# los workers (las de workers muertos se acumulan en m-muertos.json).
+METRICAS = os.environ.get("METRICAS", "1") == "1"
+METRICAS_DIR = os.environ.get("METRICAS_DIR", os.path.join(BASE_DIR, "metricas"))
+METRICAS_FLUSH_S = float(os.environ.get("METRICAS_FLUSH_S", "5"))
+LIMITES_HTTP = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LIMITES_SQL = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+
+
+class Metricas:
+    """Histogramas y contadores con etiquetas de un proceso."""
+
+    # nombre -> (tipo, ayuda, etiquetas, límites de los buckets)
+    DEFINICIONES = {
+        "http_request_duration_seconds": (
+            "histogram", "Latencia de las peticiones por endpoint.", ("endpoint", "method"), LIMITES_HTTP),
+        "http_requests_total": (
+            "counter", "Peticiones por endpoint y código de estado.", ("endpoint", "method", "status"), None),
+        "sqlite_query_duration_seconds": (
+            "histogram", "Tiempo de ejecución y lectura de cada consulta.", ("query",), LIMITES_SQL),
+        "sqlite_query_rows_total": (
+            "counter", "Filas leídas o modificadas por consulta.", ("query",), None),
+        "db_pool_wait_seconds": (
+            "histogram", "Espera para obtener una conexión del pool.", ("db",), LIMITES_SQL),
+    }
+
+    def __init__(self, directorio, flush_s):
+        self.directorio = directorio
+        self.flush_s = flush_s
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _iniciar(self):
+        # con self._lock tomado; una vez por proceso (post-fork)
+        self._pid = os.getpid()
+        self._series = {nombre: {} for nombre in self.DEFINICIONES}
+        os.makedirs(self.directorio, exist_ok=True)
+        threading.Thread(target=self._loop, name="metricas", daemon=True).start()
+
+    def observar(self, nombre, etiquetas, valor):
+        limites = self.DEFINICIONES[nombre][3]
+        i = bisect.bisect_left(limites, valor)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._iniciar()
+            series = self._series[nombre]
+            serie = series.get(etiquetas)
+            if serie is None:
+                # cuenta por bucket (el último es +Inf) y al final la suma
+                serie = series[etiquetas] = [0] * (len(limites) + 1) + [0.0]
+            serie[i] += 1
+            serie[-1] += valor
+
+    def sumar(self, nombre, etiquetas, n=1):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._iniciar()
+            series = self._series[nombre]
+            series[etiquetas] = series.get(etiquetas, 0) + n
+
+    def _loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_s)
+            self.volcar()
+
+    def volcar(self):
+        """Escribe la foto de este proceso (reemplazo atómico)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            foto = {
+                nombre: [[list(k), list(v) if isinstance(v, list) else v] for k, v in series.items()]
+                for nombre, series in self._series.items()
+            }
+        fd, tmp = tempfile.mkstemp(dir=self.directorio, prefix=".m-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(foto, f)
+        os.replace(tmp, os.path.join(self.directorio, f"m-{self._pid}.json"))
+
+    @staticmethod
+    def _sumar_fotos(total, foto):
+        for nombre, series in foto.items():
+            destino = total.setdefault(nombre, {})
+            for etiquetas, valor in series:
+                clave = tuple(etiquetas)
+                previo = destino.get(clave)
+                if previo is None:
+                    destino[clave] = valor
+                elif isinstance(valor, list):
+                    destino[clave] = [a + b for a, b in zip(previo, valor)]
+                else:
+                    destino[clave] = previo + valor
+
+    @staticmethod
+    def _vivo(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _leer(self, ruta):
+        try:
+            with open(ruta) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def exportar(self):
+        """Texto para Prometheus con la suma de todos los workers."""
+        if self._pid == os.getpid():
+            self.volcar()
+        os.makedirs(self.directorio, exist_ok=True)
+        total = {}
+        muertos_ruta = os.path.join(self.directorio, "m-muertos.json")
+        with open(os.path.join(self.directorio, ".lock"), "a") as candado:
+            fcntl.flock(candado.fileno(), fcntl.LOCK_EX)
+            muertos = {}
+            self._sumar_fotos(muertos, self._leer(muertos_ruta))
+            difuntos = []
+            for nombre in os.listdir(self.directorio):
+                pid = nombre[2:-5]
+                if not (nombre.startswith("m-") and nombre.endswith(".json") and pid.isdigit()):
+                    continue
+                ruta = os.path.join(self.directorio, nombre)
+                if self._vivo(int(pid)):
+                    self._sumar_fotos(total, self._leer(ruta))
+                else:
+                    self._sumar_fotos(muertos, self._leer(ruta))
+                    difuntos.append(ruta)
+            if difuntos:
+                # lo contado por workers que ya no están no debe desaparecer
+                with open(muertos_ruta + ".tmp", "w") as f:
+                    json.dump(self._a_foto(muertos), f)
+                os.replace(muertos_ruta + ".tmp", muertos_ruta)
+                for ruta in difuntos:
+                    os.unlink(ruta)
+        self._sumar_fotos(total, self._a_foto(muertos))
+        return self._texto(total)
+
+    @staticmethod
+    def _a_foto(series_por_nombre):
+        return {
+            nombre: [[list(k), v] for k, v in series.items()]
+            for nombre, series in series_por_nombre.items()
+        }
+
+    @staticmethod
+    def _etiquetas(nombres, valores, le=None):
+        pares = [
+            '%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " "))
+            for n, v in zip(nombres, valores)
+        ]
+        if le is not None:
+            pares.append(f'le="{le}"')
+        return "{" + ",".join(pares) + "}" if pares else ""
+
+    def _texto(self, total):
+        lineas = []
+        for nombre, (tipo, ayuda, nombres, limites) in self.DEFINICIONES.items():
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            for clave, valor in sorted(total.get(nombre, {}).items()):
+                if tipo == "counter":
+                    lineas.append(f"{nombre}{self._etiquetas(nombres, clave)} {valor}")
+                    continue
+                acumulado = 0
+                for limite, n in zip(limites + ("+Inf",), valor[:-1]):
+                    acumulado += n
+                    le = limite if limite == "+Inf" else repr(float(limite))
+                    lineas.append(f"{nombre}_bucket{self._etiquetas(nombres, clave, le)} {acumulado}")
+                lineas.append(f"{nombre}_sum{self._etiquetas(nombres, clave)} {valor[-1]}")
+                lineas.append(f"{nombre}_count{self._etiquetas(nombres, clave)} {acumulado}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = Metricas(METRICAS_DIR, METRICAS_FLUSH_S)
+atexit.register(metricas.volcar)
+
+_RE_TABLA_SQL = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(?:\w+\.)?([A-Za-z_]\w*)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=2048)
+def etiqueta_sql(sql):
+    """'SELECT ... FROM asistencia_marcaciones ...' -> 'select asistencia_marcaciones'."""
+    partes = sql.split(None, 1)
+    verbo = partes[0].lower() if partes else ""
+    m = _RE_TABLA_SQL.search(sql)
+    return f"{verbo} {m.group(1)}" if m else verbo
+
+
+class CursorMedido:
+    """
+    Cursor de sqlite3 que mide cada consulta: el tiempo de execute más el de
+    las lecturas, y las filas leídas (o modificadas). Se registra al agotar
+    el resultado, al ejecutar otra consulta, al cerrar el cursor o al devolver
+    la conexión al pool (nunca desde __del__: el recolector podría correr con
+    el lock de las métricas tomado); si pasó de CONSULTAS_LENTAS_MS además va
+    al registro de consultas lentas.
+    """
+
+    __slots__ = ("_raw", "_pendientes", "_medicion")
+
+    def __init__(self, raw, pendientes):
+        self._raw = raw
+        # la medición va aparte: la conexión registra las pendientes sin
+        # retener el cursor (uno a medio leer retenido impediría el commit)
+        self._pendientes = pendientes
+        self._medicion = None  # [etiqueta, tiempo, filas, sql, params]
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def _medir(self, metodo, sql, params, params_plan):
+        self._registrar()
+        inicio = time.perf_counter()
+        metodo(sql, params)
+        # filas: las modificadas; en un SELECT (-1) se cuentan al leer
+        m = self._medicion = [etiqueta_sql(sql), time.perf_counter() - inicio,
+                              max(self._raw.rowcount, 0), sql, params_plan]
+        self._pendientes[id(m)] = m
+        return self
+
+    def execute(self, sql, params=()):
+        return self._medir(self._raw.execute, sql, params, params)
+
+    def executemany(self, sql, filas):
+        # para el EXPLAIN alcanza con la primera fila (si es una lista)
+        primera = filas[0] if isinstance(filas, (list, tuple)) and filas else None
+        return self._medir(self._raw.executemany, sql, filas, primera)
+
+    def _leido(self, inicio, n):
+        if self._medicion is not None:
+            self._medicion[1] += time.perf_counter() - inicio
+            self._medicion[2] += n
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        fila = self._raw.fetchone()
+        self._leido(inicio, fila is not None)
+        if fila is None:
+            self._registrar()
+        return fila
+
+    def fetchmany(self, size=None):
+        inicio = time.perf_counter()
+        filas = self._raw.fetchmany() if size is None else self._raw.fetchmany(size)
+        self._leido(inicio, len(filas))
+        if not filas:
+            self._registrar()
+        return filas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        filas = self._raw.fetchall()
+        self._leido(inicio, len(filas))
+        self._registrar()
+        return filas
+
+    def __iter__(self):
+        for fila in self._raw:
+            if self._medicion is not None:
+                self._medicion[2] += 1
+            yield fila
+        self._registrar()
+
+    def close(self):
+        self._registrar()
+        self._raw.close()
+
+    def _registrar(self):
+        m, self._medicion = self._medicion, None
+        # None en pendientes: ya la registró la conexión al volver al pool
+        if m is not None and self._pendientes.pop(id(m), None) is not None:
+            registrar_consulta(self._raw.connection, m)
+
+
+def registrar_consulta(conexion, medicion):
+    """Métricas y, si pasó de CONSULTAS_LENTAS_MS, registro de consultas lentas."""
+    etiqueta, tiempo, filas, sql, params = medicion
+    if METRICAS:
+        metricas.observar("sqlite_query_duration_seconds", (etiqueta,), tiempo)
+        metricas.sumar("sqlite_query_rows_total", (etiqueta,), filas)
+    if 0 < CONSULTAS_LENTAS_MS <= tiempo * 1000:
+        consultas_lentas.registrar(conexion, etiqueta, sql, params, tiempo, filas)
+
+
+@app.before_request
+def _metricas_inicio():
+    g._inicio_peticion = time.perf_counter()
+
+
+@app.after_request
+def _metricas_fin(resp):
+    inicio = g.pop("_inicio_peticion", None)
+    if METRICAS and inicio is not None:
+        clave = (request.endpoint or "sin_ruta", request.method)
+        metricas.observar("http_request_duration_seconds", clave, time.perf_counter() - inicio)
+        metricas.sumar("http_requests_total", clave + (str(resp.status_code),))
+    return resp
+
+
+@app.route("/metrics", methods=["GET"])
+def exportar_metricas():
+    return Response(metricas.exportar(), mimetype="text/plain; version=0.0.4")
+
+
+# =============== CONSULTAS LENTAS (EXPLAIN QUERY PLAN) ===============
+# Toda consulta que tarde más de CONSULTAS_LENTAS_MS (execute + lecturas) se
+# anota con la forma de sus parámetros y su plan, marcando recorridos
+# completos de tabla y ordenamientos con B-tree temporal. El plan se saca
+# mientras la conexión sigue tomada (CursorMedido registra antes de devolverla
+# al pool). Cada worker guarda las peores (por tiempo total) y las últimas en
+# memoria y cada METRICAS_FLUSH_S, si hubo novedades, las deja en
+# METRICAS_DIR/lentas-<pid>.json para que /admin/consultas_lentas las junte.
+CONSULTAS_LENTAS_MS = float(os.environ.get("CONSULTAS_LENTAS_MS", "100"))  # 0 = desactivado
+CONSULTAS_LENTAS_MAX = int(os.environ.get("CONSULTAS_LENTAS_MAX", "50"))
+CONSULTAS_LENTAS_SQL_MAX = 2000  # caracteres de SQL que se guardan
+
+_RE_ESPACIOS = re.compile(r"\s+")
+
+
+def forma_parametros(params):
+    """
+    Tipos de los parámetros, sin los valores: ('a', 1, 2, 3) -> 'str, int×3'.
+    Con parámetros con nombre: {'c': 'x'} -> 'c:str'.
+    """
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return ", ".join(f"{k}:{type(v).__name__}" for k, v in params.items())
+    grupos = []
+    for v in params:
+        tipo = "NULL" if v is None else type(v).__name__
+        if grupos and grupos[-1][0] == tipo:
+            grupos[-1][1] += 1
+        else:
+            grupos.append([tipo, 1])
+    return ", ".join(t if n == 1 else f"{t}×{n}" for t, n in grupos)
+
+
+def marcas_plan(plan):
+    """Problemas visibles en el plan: recorridos completos y B-tree temporales."""
+    marcas = []
+    for linea in plan:
+        detalle = linea.strip()
+        if (detalle.startswith("SCAN ") and " USING " not in detalle
+                and "CONSTANT ROW" not in detalle and "VIRTUAL TABLE" not in detalle
+                and not detalle.startswith("SCAN (subquery")):
+            marcas.append("recorrido_completo: " + detalle[5:])
+        elif "TEMP B-TREE" in detalle:
+            marcas.append("btree_temporal: " + detalle.split("TEMP B-TREE", 1)[1].strip().removeprefix("FOR "))
+    return marcas
+
+
+def explicar_consulta(conn, sql, params):
+    """Plan de la consulta como líneas indentadas ([] si no se puede obtener)."""
+    try:
+        filas = conn.execute("EXPLAIN QUERY PLAN " + sql, params if params is not None else ()).fetchall()
+    except (sqlite3.Error, ValueError):
+        # conexión ya cerrada, parámetros de executemany no disponibles, etc.
+        return []
+    nivel = {0: -1}
+    lineas = []
+    for fila in filas:
+        id_, padre, detalle = fila[0], fila[1], fila[3]
+        nivel[id_] = nivel.get(padre, -1) + 1
+        lineas.append("  " * nivel[id_] + detalle)
+    return lineas
+
+
+class ConsultasLentas:
+    """Las consultas más lentas de este proceso, agrupadas por texto SQL."""
+
+    def __init__(self, directorio, maximo, flush_s):
+        self.directorio = directorio
+        self.maximo = maximo
+        self.flush_s = flush_s
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _iniciar(self):
+        # con self._lock tomado; una vez por proceso (post-fork)
+        self._pid = os.getpid()
+        self._peores = {}  # SQL normalizado -> resumen
+        self._ultimas = deque(maxlen=self.maximo)
+        self._sucio = False  # hay cambios sin volcar
+        threading.Thread(target=self._loop, name="consultas-lentas", daemon=True).start()
+
+    def registrar(self, conexion, etiqueta, sql, params, tiempo, filas):
+        clave = _RE_ESPACIOS.sub(" ", sql).strip()[:CONSULTAS_LENTAS_SQL_MAX]
+        ms = round(tiempo * 1000, 2)
+        forma = forma_parametros(params)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._iniciar()
+            previa = self._peores.get(clave)
+        # el plan se calcula una vez por SQL y fuera del lock
+        plan = previa["plan"] if previa else explicar_consulta(conexion, sql, params)
+        marcas = previa["marcas"] if previa else marcas_plan(plan)
+        cuando = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            resumen = self._peores.get(clave)
+            if resumen is None:
+                resumen = self._peores[clave] = {
+                    "consulta": etiqueta, "sql": clave, "plan": plan, "marcas": marcas,
+                    "veces": 0, "total_ms": 0.0, "max_ms": 0.0,
+                }
+                if len(self._peores) > self.maximo:
+                    menor = min((k for k in self._peores if k != clave),
+                                key=lambda k: self._peores[k]["total_ms"])
+                    del self._peores[menor]
+            resumen["veces"] += 1
+            resumen["total_ms"] = round(resumen["total_ms"] + ms, 2)
+            resumen["max_ms"] = max(resumen["max_ms"], ms)
+            resumen.update(ultimo_ms=ms, filas=filas, parametros=forma, ultima_vez=cuando)
+            self._ultimas.append({
+                "consulta": etiqueta, "sql": clave, "ms": ms, "filas": filas,
+                "parametros": forma, "marcas": marcas, "cuando": cuando,
+            })
+            self._sucio = True
+        print(f"Consulta lenta ({ms} ms, {filas} filas): {clave[:300]}"
+              + (f" [{'; '.join(marcas)}]" if marcas else ""))
+
+    def _loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_s)
+            self.volcar()
+
+    def volcar(self):
+        """Escribe la foto de este proceso si cambió desde la última vez."""
+        with self._lock:
+            if self._pid != os.getpid() or not self._sucio:
+                return
+            foto = {"peores": [dict(r) for r in self._peores.values()], "ultimas": list(self._ultimas)}
+            self._sucio = False
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directorio, prefix=".lentas-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(foto, f)
+            os.replace(tmp, os.path.join(self.directorio, f"lentas-{os.getpid()}.json"))
+        except OSError as e:
+            print("Aviso consultas lentas:", e)
+
+    def juntar(self):
+        """Las fotos de todos los workers vivos, sumadas por SQL."""
+        self.volcar()
+        peores, ultimas = {}, []
+        try:
+            nombres = os.listdir(self.directorio)
+        except OSError:
+            nombres = []
+        for nombre in nombres:
+            pid = nombre[7:-5]
+            if not (nombre.startswith("lentas-") and nombre.endswith(".json") and pid.isdigit()):
+                continue
+            ruta = os.path.join(self.directorio, nombre)
+            if not Metricas._vivo(int(pid)):
+                try:
+                    os.unlink(ruta)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(ruta) as f:
+                    foto = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for r in foto.get("peores", []):
+                previo = peores.get(r["sql"])
+                if previo is None or previo.get("ultima_vez", "") < r.get("ultima_vez", ""):
+                    nuevo = dict(r)
+                    if previo is not None:
+                        nuevo["veces"] += previo["veces"]
+                        nuevo["total_ms"] = round(nuevo["total_ms"] + previo["total_ms"], 2)
+                        nuevo["max_ms"] = max(nuevo["max_ms"], previo["max_ms"])
+                    peores[r["sql"]] = nuevo
+                else:
+                    previo["veces"] += r["veces"]
+                    previo["total_ms"] = round(previo["total_ms"] + r["total_ms"], 2)
+                    previo["max_ms"] = max(previo["max_ms"], r["max_ms"])
+            ultimas.extend(dict(u, pid=int(pid)) for u in foto.get("ultimas", []))
+        return list(peores.values()), ultimas
+
+
+consultas_lentas = ConsultasLentas(METRICAS_DIR, CONSULTAS_LENTAS_MAX, METRICAS_FLUSH_S)
+atexit.register(consultas_lentas.volcar)
+
+
+# =============== CACHE DE CATÁLOGOS (ETag / If-None-Match) ===============
+CATALOGO_CACHE_MAX = int(os.environ.get("CATALOGO_CACHE_MAX", "512"))
+_catalogo_cache = OrderedDict()  # (recurso, colegio, query) -> (etag, body, mimetype)
+_catalogo_lock = threading.Lock()
+_cache_epoch = None
+
+
+def invalidar_catalogo(c, recurso, colegio=""):
+    """Sube la versión del catálogo; va en la misma transacción que el cambio."""
+    c.execute("""
+        INSERT INTO cache_versiones (colegio, recurso, version) VALUES (?, ?, 1)
+        ON CONFLICT (colegio, recurso) DO UPDATE SET version = version + 1
+    """, (colegio or "", recurso))
+
+
+def _etag_catalogo(recurso, colegio):
+    global _cache_epoch
+    conn = get_conn()
+    c = conn.cursor()
+    if _cache_epoch is None:
+        _cache_epoch = c.execute("SELECT valor FROM meta WHERE clave='cache_epoch'").fetchone()[0]
+    row = c.execute("""
+        SELECT version FROM cache_versiones WHERE colegio = ? AND recurso = ?
+    """, (colegio or "", recurso)).fetchone()
     conn.close()
+    return f"{_cache_epoch}.{recurso}.{row['version'] if row else 0}"
+
+
+def cache_catalogo(recurso):
+    """
+    Cachea la respuesta GET de un catálogo por (recurso, colegio, query).
+    La versión vive en SQLite, así que todos los workers ven la invalidación.
+    """
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(*args, **kwargs):
+            colegio = kwargs.get("colegio", "")
+            etag = _etag_catalogo(recurso, colegio)
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                resp.headers["Cache-Control"] = "no-cache"
+                return resp
+
+            clave = (recurso, colegio, request.query_string)
+            with _catalogo_lock:
+                guardado = _catalogo_cache.get(clave)
+                if guardado:
+                    _catalogo_cache.move_to_end(clave)
+            if guardado and guardado[0] == etag:
+                resp = Response(guardado[1], mimetype=guardado[2])
+            else:
+                resp = app.make_response(vista(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+                with _catalogo_lock:
+                    _catalogo_cache[clave] = (etag, resp.get_data(), resp.mimetype)
+                    _catalogo_cache.move_to_end(clave)
+                    while len(_catalogo_cache) > CATALOGO_CACHE_MAX:
+                        _catalogo_cache.popitem(last=False)
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "no-cache"
+            return resp
+        return envoltura
+    return decorador
 
 
 @app.route("/")
@@ -230,8 +1864,215 @@ def home():
     return "API Sistema Escolar funcionando ✅"
 
 
+# =============== SESIÓN (TOKENS FIRMADOS) ===============
+# /login entrega un token firmado (id, rol, colegio) que se verifica con HMAC.
+# Con AUTH_REQUERIDA=1 las rutas fuera de AUTH_PUBLICAS exigen token.
+SESION_TTL = int(os.environ.get("SESION_TTL", str(12 * 3600)))
+AUTH_REQUERIDA = os.environ.get("AUTH_REQUERIDA", "0") == "1"
+AUTH_PUBLICAS = {"home", "get_colegios", "login", "registrar_usuario", "registrar_asistencia",
+                 "exportar_metricas", "static"}
+# rutas que aceptan el token en ?token= (EventSource no manda cabeceras)
+AUTH_TOKEN_EN_URL = {"stream_marcaciones"}
+REVOCADOS_REFRESCO_S = float(os.environ.get("REVOCADOS_REFRESCO_S", "5"))
+DUENOS_CACHE_MAX = int(os.environ.get("DUENOS_CACHE_MAX", "4096"))
+SECRET_FILE = os.path.join(BASE_DIR, ".secret_key")
+
+
+def _clave_secreta():
+    """SECRET_KEY del entorno o una clave generada una vez y compartida por los workers."""
+    if os.environ.get("SECRET_KEY"):
+        return os.environ["SECRET_KEY"]
+    try:
+        fd = os.open(SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # otro worker la pudo haber creado recién: esperar a que esté escrita
+        for _ in range(50):
+            with open(SECRET_FILE) as f:
+                clave = f.read().strip()
+            if clave:
+                return clave
+            time.sleep(0.05)
+        raise RuntimeError(f"{SECRET_FILE} está vacío")
+    clave = secrets.token_hex(32)
+    with os.fdopen(fd, "w") as f:
+        f.write(clave)
+    return clave
+
+
+app.secret_key = _clave_secreta()
+_firmador = URLSafeTimedSerializer(app.secret_key, salt="sesion")
+
+
+class ListaRevocados:
+    """Copia en memoria de sesiones_revocadas; se relee cada `refresco_s` segundos."""
+
+    def __init__(self, refresco_s):
+        self.refresco_s = refresco_s
+        self._lock = threading.Lock()
+        self._jtis = {}  # jti -> vencimiento
+        self._leida = None
+
+    def revocar(self, jti, vence):
+        conn = db_pool.acquire()
+        try:
+            conn.execute("INSERT OR REPLACE INTO sesiones_revocadas (jti, vence) VALUES (?, ?)",
+                         (jti, vence))
+            conn.execute("DELETE FROM sesiones_revocadas WHERE vence < ?", (time.time(),))
+            conn.commit()
+        finally:
+            conn.close()
+        with self._lock:
+            self._jtis[jti] = vence
+
+    def _releer(self):
+        conn = db_pool.acquire()
+        try:
+            rows = conn.execute("SELECT jti, vence FROM sesiones_revocadas WHERE vence >= ?",
+                                (time.time(),)).fetchall()
+        finally:
+            conn.close()
+        self._jtis = {r["jti"]: r["vence"] for r in rows}
+        self._leida = time.monotonic()
+
+    def __contains__(self, jti):
+        # los /logout de otros workers se ven a lo sumo refresco_s después
+        if self._leida is None or time.monotonic() - self._leida >= self.refresco_s:
+            with self._lock:
+                if self._leida is None or time.monotonic() - self._leida >= self.refresco_s:
+                    self._releer()
+        return jti in self._jtis
+
+
+tokens_revocados = ListaRevocados(REVOCADOS_REFRESCO_S)
+
+
+def emitir_token(usuario):
+    return _firmador.dumps({
+        "id": usuario["id"],
+        "rol": usuario["rol"],
+        "colegio": usuario["colegio"],
+        "jti": secrets.token_urlsafe(8),
+    })
+
+
+def leer_token(token):
+    """Devuelve (datos, emitido_ts) o lanza BadSignature / SignatureExpired."""
+    datos, emitido = _firmador.loads(token, max_age=SESION_TTL, return_timestamp=True)
+    if datos.get("jti") in tokens_revocados:
+        raise BadSignature("token revocado")
+    return datos, emitido.timestamp()
+
+
+def _token_de_request():
+    auth = request.headers.get("Authorization", "")
+    if auth[:7].lower() == "bearer ":
+        return auth[7:].strip()
+    if request.endpoint in AUTH_TOKEN_EN_URL:
+        return request.args.get("token")
+    return None
+
+
+@app.before_request
+def verificar_sesion():
+    """Deja g.usuario con los datos del token; 401 si es inválido, 403 si es de otro colegio."""
+    g.usuario = None
+    if request.method == "OPTIONS":
+        return None
+    token = _token_de_request()
+    if token:
+        try:
+            g.usuario, g.token_emitido = leer_token(token)
+        except SignatureExpired:
+            return jsonify({"error": "sesión expirada"}), 401
+        except BadSignature:
+            return jsonify({"error": "token inválido"}), 401
+    elif AUTH_REQUERIDA and request.endpoint not in AUTH_PUBLICAS:
+        return jsonify({"error": "no autenticado"}), 401
+
+    if request.path.startswith("/admin/"):
+        if not g.usuario:
+            return jsonify({"error": "no autenticado"}), 401
+        if g.usuario.get("rol") != "admin":
+            return jsonify({"error": "solo administradores"}), 403
+
+    if g.usuario:
+        colegio = g.usuario["colegio"]
+        if any(otro is not None and otro != colegio for otro in _colegios_de_request()):
+            return jsonify({"error": "sin acceso a este colegio"}), 403
+    return None
+
+
+_duenos = OrderedDict()  # (tabla, id) -> colegio
+_duenos_lock = threading.Lock()
+
+
+def _colegio_dueno(tabla, fila_id):
+    """
+    Colegio de una fila direccionada por id (None si no existe). Los ids son
+    AUTOINCREMENT y el colegio de una fila no cambia: se guarda en memoria.
+    """
+    clave = (tabla, fila_id)
+    with _duenos_lock:
+        colegio = _duenos.get(clave)
+        if colegio is not None:
+            _duenos.move_to_end(clave)
+            return colegio
+    conn = _pool_de(colegio_de_id(tabla, fila_id)).acquire()
+    try:
+        row = conn.execute(f"SELECT colegio FROM {tabla} WHERE id=?", (fila_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    with _duenos_lock:
+        _duenos[clave] = row["colegio"]
+        while len(_duenos) > DUENOS_CACHE_MAX:
+            _duenos.popitem(last=False)
+    return row["colegio"]
+
+
+def _colegios_de_request():
+    """
+    Todos los colegios que toca la petición: el de la ruta, el dueño de la
+    fila de las rutas por id, ?colegio=, el JSON (también cada ítem de un
+    lote de marcaciones y el dueño de un qr_id) y el formulario.
+    """
+    colegios = []
+    args = request.view_args or {}
+    if "colegio" in args:
+        colegios.append(args["colegio"])
+    for nombre, tabla in RUTA_ID_TABLA.items():
+        if nombre in args:
+            colegios.append(_colegio_dueno(tabla, args[nombre]))
+    colegios.append(request.args.get("colegio"))
+    if request.is_json:
+        cuerpo = request.get_json(silent=True)
+        items = []
+        if isinstance(cuerpo, dict):
+            colegios.append(cuerpo.get("colegio"))
+            if isinstance(cuerpo.get("qr_id"), int):
+                colegios.append(_colegio_dueno("asistencia_qr", cuerpo["qr_id"]))
+            if isinstance(cuerpo.get("marcaciones"), list):
+                items = cuerpo["marcaciones"]
+        elif isinstance(cuerpo, list):
+            items = cuerpo
+        colegios.extend(m.get("colegio") for m in items if isinstance(m, dict))
+    elif request.mimetype in ("multipart/form-data", "application/x-www-form-urlencoded"):
+        colegios.append(request.form.get("colegio"))
+    return colegios
+
+
+@app.route("/logout", methods=["POST"])
+def logout():
+    if not g.usuario:
+        return jsonify({"error": "no autenticado"}), 401
+    tokens_revocados.revocar(g.usuario["jti"], g.token_emitido + SESION_TTL)
+    return jsonify({"mensaje": "sesión cerrada"}), 200
+
+
 # =============== COLEGIOS / LOGIN / USUARIOS =================
 @app.route("/colegios", methods=["GET"])
+@cache_catalogo("colegios")
 def get_colegios():
     conn = get_conn()
     c = conn.cursor()
@@ -265,6 +2106,8 @@ def login():
             "email": row["email"],
             "rol": row["rol"],
             "colegio": row["colegio"],
+            "token": emitir_token(row),
+            "expira_en": SESION_TTL,
         })
     else:
         return jsonify({"error": "Credenciales incorrectas"}), 401
@@ -276,7 +2119,12 @@ def registrar_usuario():
     nombre = data.get("nombre")
     email = data.get("email")
     password = data.get("password")
-    rol = data.get("rol", "docente")
+    rol = data.get("rol") or "docente"
+    if not isinstance(rol, str):
+        return jsonify({"error": "rol inválido"}), 400
+    # el registro es público: solo un admin con sesión puede dar otro rol
+    if rol != "docente" and not (g.usuario and g.usuario.get("rol") == "admin"):
+        return jsonify({"error": "solo un administrador puede asignar ese rol"}), 403
 
     nuevo_colegio = data.get("nuevo_colegio")
     colegio = data.get("colegio")
@@ -288,11 +2136,14 @@ def registrar_usuario():
     c = conn.cursor()
 
     # crear colegio si vino
+    colegio_creado = False
     if nuevo_colegio:
         c.execute("SELECT id FROM colegios WHERE nombre=?", (nuevo_colegio,))
         row = c.fetchone()
         if not row:
             c.execute("INSERT INTO colegios (nombre) VALUES (?)", (nuevo_colegio,))
+            invalidar_catalogo(c, "colegios")
+            colegio_creado = True
         colegio = nuevo_colegio
 
     if not colegio:
@@ -311,6 +2162,8 @@ def registrar_usuario():
     """, (nombre, email, password, rol, colegio))
     conn.commit()
     conn.close()
+    if DB_SHARDS and colegio_creado:
+        crear_shard(colegio)
     return jsonify({"mensaje": "usuario creado"}), 200
 
 
@@ -331,6 +2184,7 @@ def usuarios_por_colegio(colegio):
 
 # =============== DOCUMENTOS / HORARIOS / EVENTOS ===============
 @app.route("/documentos/categorias/<colegio>", methods=["GET"])
+@cache_catalogo("categorias")
 def listar_categorias(colegio):
     conn = get_conn()
     c = conn.cursor()
@@ -359,6 +2213,8 @@ def crear_categoria():
         INSERT OR IGNORE INTO documento_categorias (colegio, nombre)
         VALUES (?, ?)
     """, (colegio, nombre))
+    if c.rowcount:
+        invalidar_catalogo(c, "categorias", colegio)
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "categoria creada"}), 200
@@ -392,6 +2248,7 @@ def borrar_categoria_documentos():
         DELETE FROM documento_categorias
         WHERE colegio = ? AND nombre = ?
     """, (colegio, nombre))
+    invalidar_catalogo(c, "categorias", colegio)
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "categoria eliminada; documentos movidos a 'General'"}), 200
@@ -402,26 +2259,119 @@ def listar_documentos(colegio):
     categoria = request.args.get("categoria", "General")
     conn = get_conn()
     c = conn.cursor()
-    c.execute("""
-        SELECT id, nombre_original, colegio, categoria, subido_por, creado_en
+    c.execute(f"""
+        SELECT {DOCUMENTO_COLUMNAS}
         FROM documentos
         WHERE colegio = ? AND categoria = ?
         ORDER BY creado_en DESC
     """, (colegio, categoria))
-    docs = []
-    for row in c.fetchall():
-        docs.append({
-            "id": row["id"],
-            "nombre": row["nombre_original"],
-            "colegio": row["colegio"],
-            "categoria": row["categoria"],
-            "subido_por": row["subido_por"],
-            "creado_en": row["creado_en"],
-        })
+    docs = [documento_dict(row) for row in c.fetchall()]
     conn.close()
     return jsonify({"archivos": docs})
 
 
+DOCUMENTO_COLUMNAS = "id, nombre_original, colegio, categoria, subido_por, creado_en, tamano, mime"
+
+
+def documento_dict(row):
+    return {
+        "id": row["id"],
+        "nombre": row["nombre_original"],
+        "colegio": row["colegio"],
+        "categoria": row["categoria"],
+        "subido_por": row["subido_por"],
+        "creado_en": row["creado_en"],
+        "tamano": row["tamano"],
+        "mime": row["mime"],
+    }
+
+
+# --- almacenamiento por contenido: uploads/ab/cd/<sha256> ---
+UPLOAD_CHUNK = 64 * 1024
+
+
+def _ruta_contenido(sha256):
+    return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+
+def guardar_por_contenido(stream):
+    """
+    Copia el stream a uploads/ por bloques mientras calcula su SHA-256.
+    Si ya existe un archivo con el mismo contenido, no se guarda otra copia.
+    Devuelve (nombre_fisico relativo a UPLOAD_FOLDER, sha256, tamano).
+    """
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_TMP)
+    h = hashlib.sha256()
+    tamano = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                bloque = stream.read(UPLOAD_CHUNK)
+                if not bloque:
+                    break
+                h.update(bloque)
+                f.write(bloque)
+                tamano += len(bloque)
+        sha256 = h.hexdigest()
+        relativo = _ruta_contenido(sha256)
+        destino = os.path.join(UPLOAD_FOLDER, relativo)
+        if os.path.exists(destino):
+            os.unlink(tmp)
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(tmp, destino)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return relativo, sha256, tamano
+
+
+@app.cli.command("migrar-documentos")
+def migrar_documentos_cmd():
+    """
+    Pasa los documentos viejos (uploads/<nombre>) al almacenamiento por
+    contenido y borra los archivos que ya no tienen referencias.
+    flask --app app migrar-documentos
+    """
+    migrados = 0
+    huerfanos, en_uso = set(), set()
+    for _colegio, conn in iterar_shards():
+        c = conn.cursor()
+        rows = c.execute("""
+            SELECT id, nombre_original, nombre_fisico FROM documentos WHERE sha256 IS NULL
+        """).fetchall()
+        for row in rows:
+            viejo = os.path.join(UPLOAD_FOLDER, row["nombre_fisico"])
+            if not os.path.isfile(viejo):
+                print(f"  doc {row['id']}: falta {row['nombre_fisico']}, se omite")
+                continue
+            with open(viejo, "rb") as f:
+                nombre_fisico, sha256, tamano = guardar_por_contenido(f)
+            mime = mimetypes.guess_type(row["nombre_original"] or "")[0] or "application/octet-stream"
+            c.execute("""
+                UPDATE documentos SET nombre_fisico=?, sha256=?, tamano=?, mime=? WHERE id=?
+            """, (nombre_fisico, sha256, tamano, mime, row["id"]))
+            conn.commit()
+            os.unlink(viejo)
+            migrados += 1
+        for row in c.execute("SELECT sha256, refs FROM archivos"):
+            (en_uso if row["refs"] > 0 else huerfanos).add(row["sha256"])
+        conn.close()
+
+    # el mismo contenido puede estar referenciado desde otro shard
+    huerfanos -= en_uso
+    for sha256 in huerfanos:
+        ruta = os.path.join(UPLOAD_FOLDER, _ruta_contenido(sha256))
+        if os.path.exists(ruta):
+            os.unlink(ruta)
+    for _colegio, conn in iterar_shards():
+        conn.executemany("DELETE FROM archivos WHERE sha256=? AND refs <= 0", [(h,) for h in huerfanos])
+        conn.commit()
+        conn.close()
+    print(f"documentos migrados: {migrados}, archivos sin referencias borrados: {len(huerfanos)}")
+
+
 @app.route("/documentos/upload", methods=["POST"])
 def subir_documento():
     if "archivo" not in request.files:
@@ -435,16 +2385,9 @@ def subir_documento():
     if archivo.filename == "":
         return jsonify({"error": "archivo sin nombre"}), 400
 
-    filename_seguro = secure_filename(archivo.filename)
-    ruta_guardar = os.path.join(UPLOAD_FOLDER, filename_seguro)
-    base_name = filename_seguro
-    contador = 1
-    while os.path.exists(ruta_guardar):
-        name, ext = os.path.splitext(base_name)
-        filename_seguro = f"{name}_{contador}{ext}"
-        ruta_guardar = os.path.join(UPLOAD_FOLDER, filename_seguro)
-        contador += 1
-    archivo.save(ruta_guardar)
+    nombre_fisico, sha256, tamano = guardar_por_contenido(archivo.stream)
+    mime = (mimetypes.guess_type(archivo.filename)[0]
+            or archivo.mimetype or "application/octet-stream")
 
     conn = get_conn()
     c = conn.cursor()
@@ -452,21 +2395,59 @@ def subir_documento():
         INSERT OR IGNORE INTO documento_categorias (colegio, nombre)
         VALUES (?, ?)
     """, (colegio, categoria))
+    if c.rowcount:
+        invalidar_catalogo(c, "categorias", colegio)
     c.execute("""
-        INSERT INTO documentos (nombre_original, nombre_fisico, colegio, categoria, subido_por)
-        VALUES (?, ?, ?, ?, ?)
-    """, (archivo.filename, filename_seguro, colegio, categoria, subido_por))
+        INSERT INTO documentos (nombre_original, nombre_fisico, colegio, categoria, subido_por,
+                                sha256, tamano, mime)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (archivo.filename, nombre_fisico, colegio, categoria, subido_por, sha256, tamano, mime))
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "archivo subido"}), 200
 
 
+# Modo de entrega de archivos: "" (el worker usa sendfile vía wsgi.file_wrapper),
+# "nginx" (X-Accel-Redirect a DOCUMENTOS_ACCEL_PREFIX) o "sendfile" (X-Sendfile).
+DOCUMENTOS_ACCEL = os.environ.get("DOCUMENTOS_ACCEL", "").lower()
+DOCUMENTOS_ACCEL_PREFIX = os.environ.get("DOCUMENTOS_ACCEL_PREFIX", "/uploads-internos")
+_LECTURA_RANGO = 64 * 1024
+
+
+def _leer_rango(f, restante):
+    """Iterador para rangos que no llegan al final del archivo."""
+    try:
+        while restante > 0:
+            bloque = f.read(min(_LECTURA_RANGO, restante))
+            if not bloque:
+                break
+            restante -= len(bloque)
+            yield bloque
+    finally:
+        f.close()
+
+
+def _disposicion(nombre):
+    # igual que send_file de werkzeug: filename* para nombres no ASCII
+    try:
+        nombre.encode("ascii")
+        return {"filename": nombre}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", nombre).encode("ascii", "ignore").decode("ascii")
+        return {"filename": simple, "filename*": "UTF-8''" + quote(nombre, safe="!#$&+-.^_`|~")}
+
+
 @app.route("/documentos/download/<int:doc_id>", methods=["GET"])
 def descargar_documento(doc_id):
+    """
+    Descarga con soporte de Range (206), If-None-Match / If-Modified-Since
+    (304) e If-Range. El cuerpo va por wsgi.file_wrapper para que gunicorn
+    use sendfile, o lo entrega el proxy con DOCUMENTOS_ACCEL.
+    """
     conn = get_conn()
     c = conn.cursor()
     c.execute("""
-        SELECT nombre_original, nombre_fisico
+        SELECT nombre_original, nombre_fisico, sha256, mime
         FROM documentos
         WHERE id = ?
     """, (doc_id,))
@@ -474,12 +2455,67 @@ def descargar_documento(doc_id):
     conn.close()
     if not row:
         return jsonify({"error": "no existe documento"}), 404
-    return send_from_directory(
-        UPLOAD_FOLDER,
-        row["nombre_fisico"],
-        as_attachment=True,
-        download_name=row["nombre_original"],
-    )
+
+    ruta = safe_join(UPLOAD_FOLDER, row["nombre_fisico"])
+    if ruta is None or not os.path.isfile(ruta):
+        return jsonify({"error": "archivo no encontrado"}), 404
+    st = os.stat(ruta)
+    nombre = row["nombre_original"] or os.path.basename(ruta)
+    mime = row["mime"] or mimetypes.guess_type(nombre)[0] or "application/octet-stream"
+    # el sha256 es un ETag fuerte; los documentos sin migrar usan mtime-tamaño
+    etag = row["sha256"] or f"{int(st.st_mtime)}-{st.st_size}"
+
+    resp = Response(mimetype=mime)
+    resp.headers.set("Content-Disposition", "attachment", **_disposicion(nombre))
+    resp.set_etag(etag)
+    resp.last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers["Cache-Control"] = "private, no-cache"
+
+    if DOCUMENTOS_ACCEL == "nginx":
+        resp.headers["X-Accel-Redirect"] = f"{DOCUMENTOS_ACCEL_PREFIX}/{quote(row['nombre_fisico'])}"
+        return resp
+    if DOCUMENTOS_ACCEL == "sendfile":
+        resp.headers["X-Sendfile"] = ruta
+        return resp
+
+    if request.if_none_match:
+        no_cambio = request.if_none_match.contains(etag)
+    else:
+        no_cambio = bool(request.if_modified_since and request.if_modified_since >= resp.last_modified)
+    if no_cambio:
+        resp.status_code = 304
+        return resp
+
+    inicio, fin = 0, st.st_size
+    rango = request.range
+    if rango and request.if_range.etag is not None and request.if_range.etag != etag:
+        rango = None
+    if rango and request.if_range.date is not None and request.if_range.date < resp.last_modified:
+        rango = None
+    if rango and (rango.units != "bytes" or len(rango.ranges) != 1):
+        # varios rangos u otra unidad: se ignora y va el archivo entero (200)
+        rango = None
+    if rango:
+        limites = rango.range_for_length(st.st_size)
+        if limites is None:
+            resp.status_code = 416
+            resp.headers["Content-Range"] = f"bytes */{st.st_size}"
+            return resp
+        inicio, fin = limites
+        resp.status_code = 206
+        resp.headers["Content-Range"] = f"bytes {inicio}-{fin - 1}/{st.st_size}"
+
+    f = open(ruta, "rb")
+    f.seek(inicio)
+    resp.content_length = fin - inicio
+    if fin == st.st_size:
+        # gunicorn manda con sendfile desde la posición actual, sin copiar en Python
+        resp.response = wrap_file(request.environ, f)
+        resp.direct_passthrough = True
+    else:
+        resp.response = _leer_rango(f, fin - inicio)
+    return resp
 
 
 @app.route("/docentes/<colegio>", methods=["GET"])
@@ -497,6 +2533,7 @@ def listar_docentes(colegio):
 
 
 @app.route("/horarios/<colegio>", methods=["GET"])
+@cache_catalogo("horarios")
 def listar_horarios_colegio(colegio):
     conn = get_conn()
     c = conn.cursor()
@@ -540,6 +2577,8 @@ def guardar_horario():
     else:
         c.execute("INSERT INTO horarios (colegio, docente, data) VALUES (?, ?, ?)",
                   (colegio, docente, json.dumps(horario_data)))
+    indexar_horario(c, colegio, docente, horario_data)
+    invalidar_catalogo(c, "horarios", colegio)
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "horario guardado"}), 200
@@ -550,34 +2589,510 @@ def eliminar_horario(colegio, docente_email):
     conn = get_conn()
     c = conn.cursor()
     c.execute("DELETE FROM horarios WHERE colegio=? AND docente=?", (colegio, docente_email))
+    c.execute("DELETE FROM horario_intervalos WHERE colegio=? AND docente=?", (colegio, docente_email))
+    invalidar_catalogo(c, "horarios", colegio)
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "horario eliminado"}), 200
 
 
+# =============== HORARIOS: ÍNDICE DE INTERVALOS ===============
+# Cada celda del horario ("Mar-2": {"texto": ...}) se guarda como intervalo
+# (colegio, dia, inicio, fin) en minutos. Las horas salen de la celda
+# ("inicio"/"fin" si vienen) o de los periodos del colegio.
+HORARIO_INICIO = os.environ.get("HORARIO_INICIO", "08:00")
+HORARIO_DURACION_MIN = int(os.environ.get("HORARIO_DURACION_MIN", "45"))
+# Los intervalos más largos se parten; así un solapamiento solo puede empezar
+# en [inicio - MAX, fin) y la consulta es un rango sobre el índice.
+HORARIO_MAX_INTERVALO = 240
+DIAS = ("Lun", "Mar", "Mie", "Jue", "Vie", "Sab", "Dom")
+
+
+def normalizar_dia(valor):
+    """'Mié', 'miercoles', 'MIE' -> 'Mie'. None si no es un día."""
+    dia = normalizar_texto(valor)[:3].capitalize()
+    return dia if dia in DIAS else None
+
+
+def a_minutos(hhmm):
+    h, m = str(hhmm).strip().split(":")[:2]
+    minutos = int(h) * 60 + int(m)
+    if not 0 <= minutos <= 24 * 60:
+        raise ValueError(hhmm)
+    return minutos
+
+
+def a_hhmm(minutos):
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+def periodos_colegio(c, colegio):
+    """{periodo: (inicio, fin)} en minutos; si el colegio no definió, los por defecto."""
+    rows = c.execute("""
+        SELECT periodo, inicio, fin FROM horario_periodos WHERE colegio=?
+    """, (colegio,)).fetchall()
+    if rows:
+        return {r["periodo"]: (a_minutos(r["inicio"]), a_minutos(r["fin"])) for r in rows}
+    base = a_minutos(HORARIO_INICIO)
+    return {
+        p: (base + (p - 1) * HORARIO_DURACION_MIN, base + p * HORARIO_DURACION_MIN)
+        for p in range(1, 13)
+    }
+
+
+def _intervalos_horario(horario, periodos):
+    """Genera (dia, inicio, fin, periodo, curso, aula) para cada celda del horario."""
+    if not isinstance(horario, dict):
+        return
+    for clave, celda in horario.items():
+        dia_txt, _, periodo_txt = str(clave).rpartition("-")
+        dia = normalizar_dia(dia_txt)
+        if not dia:
+            continue
+        celda = celda if isinstance(celda, dict) else {"texto": celda}
+        try:
+            periodo = int(periodo_txt)
+        except ValueError:
+            periodo = None
+        try:
+            if celda.get("inicio") and celda.get("fin"):
+                inicio, fin = a_minutos(celda["inicio"]), a_minutos(celda["fin"])
+            elif periodo in periodos:
+                inicio, fin = periodos[periodo]
+            else:
+                continue
+        except (TypeError, ValueError):
+            continue
+        curso = str(celda.get("curso") or celda.get("texto") or "").strip()
+        aula = str(celda.get("aula") or "").strip()
+        while fin > inicio:
+            tramo = min(fin, inicio + HORARIO_MAX_INTERVALO)
+            yield dia, inicio, tramo, periodo, curso, aula
+            inicio = tramo
+
+
+def indexar_horario(c, colegio, docente, horario, periodos=None):
+    """Reemplaza los intervalos del docente. No hace commit."""
+    if periodos is None:
+        periodos = periodos_colegio(c, colegio)
+    c.execute("DELETE FROM horario_intervalos WHERE colegio=? AND docente=?", (colegio, docente))
+    c.executemany("""
+        INSERT INTO horario_intervalos (colegio, docente, dia, inicio, fin, periodo, curso, aula)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(colegio, docente) + iv for iv in _intervalos_horario(horario, periodos)])
+
+
+def reindexar_horarios(c, colegio):
+    periodos = periodos_colegio(c, colegio)
+    for row in c.execute("SELECT docente, data FROM horarios WHERE colegio=?", (colegio,)).fetchall():
+        try:
+            horario = json.loads(row["data"] or "{}")
+        except ValueError:
+            horario = {}
+        indexar_horario(c, colegio, row["docente"], horario, periodos)
+
+
+def _intervalo_consulta():
+    """(dia, inicio, fin) desde ?dia=Mar&inicio=10:00&fin=10:45 o ?periodo=3."""
+    dia = normalizar_dia(request.args.get("dia"))
+    if not dia:
+        raise ValueError("dia inválido")
+    inicio = request.args.get("inicio")
+    fin = request.args.get("fin")
+    if inicio and fin:
+        inicio, fin = a_minutos(inicio), a_minutos(fin)
+        if fin <= inicio:
+            raise ValueError("fin debe ser mayor que inicio")
+        return dia, inicio, fin
+    return dia, None, None
+
+
+@app.route("/horarios_periodos/<colegio>", methods=["GET"])
+def listar_periodos_horario(colegio):
+    conn = get_conn()
+    periodos = periodos_colegio(conn.cursor(), colegio)
+    conn.close()
+    return jsonify({"periodos": [
+        {"periodo": p, "inicio": a_hhmm(i), "fin": a_hhmm(f)}
+        for p, (i, f) in sorted(periodos.items())
+    ]})
+
+
+@app.route("/horarios_periodos/<colegio>", methods=["POST"])
+def guardar_periodos_horario(colegio):
+    """
+    Define las horas de cada periodo del colegio y reindexa sus horarios.
+    Body: { "periodos": [ {"periodo": 1, "inicio": "07:30", "fin": "08:15"}, ... ] }
+    """
+    data = request.get_json(silent=True) or {}
+    filas = []
+    try:
+        for p in data.get("periodos") or []:
+            inicio, fin = a_minutos(p["inicio"]), a_minutos(p["fin"])
+            if fin <= inicio:
+                raise ValueError
+            filas.append((colegio, int(p["periodo"]), a_hhmm(inicio), a_hhmm(fin)))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "periodos inválidos"}), 400
+    if not filas:
+        return jsonify({"error": "faltan periodos"}), 400
+
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("DELETE FROM horario_periodos WHERE colegio=?", (colegio,))
+    c.executemany("""
+        INSERT INTO horario_periodos (colegio, periodo, inicio, fin) VALUES (?, ?, ?, ?)
+    """, filas)
+    reindexar_horarios(c, colegio)
+    conn.commit()
+    conn.close()
+    return jsonify({"mensaje": "periodos guardados"}), 200
+
+
+@app.route("/horarios_libres/<colegio>", methods=["GET"])
+def docentes_libres(colegio):
+    """
+    Docentes sin clase en un intervalo.
+    GET /horarios_libres/LAS%20ROSAS?dia=Mar&inicio=10:00&fin=10:45  (o &periodo=3)
+    """
+    try:
+        dia, inicio, fin = _intervalo_consulta()
+    except ValueError as e:
+        return jsonify({"error": str(e) or "intervalo inválido"}), 400
+
+    conn = get_conn()
+    c = conn.cursor()
+    if inicio is None:
+        periodo = request.args.get("periodo", type=int)
+        rango = periodos_colegio(c, colegio).get(periodo)
+        if not rango:
+            conn.close()
+            return jsonify({"error": "indique inicio/fin o un periodo válido"}), 400
+        inicio, fin = rango
+
+    c.execute("""
+        SELECT d.docente, u.nombre
+        FROM (
+            SELECT docente FROM horarios WHERE colegio = ?
+            UNION
+            SELECT email FROM usuarios WHERE colegio = ? AND rol = 'docente'
+        ) AS d
+        LEFT JOIN usuarios u ON u.colegio = ? AND u.email = d.docente
+        WHERE NOT EXISTS (
+            SELECT 1 FROM horario_intervalos i
+            WHERE i.colegio = ? AND i.dia = ?
+              AND i.inicio > ? AND i.inicio < ? AND i.fin > ?
+              AND i.docente = d.docente
+        )
+        ORDER BY d.docente
+    """, (colegio, colegio, colegio, colegio, dia, inicio - HORARIO_MAX_INTERVALO, fin, inicio))
+    libres = [{"docente": r["docente"], "nombre": r["nombre"]} for r in c.fetchall()]
+    conn.close()
+    return jsonify({"dia": dia, "inicio": a_hhmm(inicio), "fin": a_hhmm(fin), "libres": libres})
+
+
+@app.route("/horarios_conflictos/<colegio>", methods=["GET"])
+def conflictos_horario(colegio):
+    """
+    Clases que se solapan en la misma aula (?aula=X), el mismo curso
+    (?curso=3A) o del mismo docente (?docente=email). Opcional ?dia=Mar.
+    Sin filtro revisa todas las aulas con nombre.
+    """
+    dia = request.args.get("dia")
+    if dia and not normalizar_dia(dia):
+        return jsonify({"error": "dia inválido"}), 400
+
+    columna, valor = "aula", request.args.get("aula")
+    for col in ("curso", "docente"):
+        if request.args.get(col):
+            columna, valor = col, request.args.get(col)
+
+    params = [colegio]
+    filtro = f"a.{columna} != ''"
+    if valor:
+        filtro = f"a.{columna} = ?"
+        params.append(valor)
+    if dia:
+        filtro += " AND a.dia = ?"
+        params.append(normalizar_dia(dia))
+
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT a.{columna} AS clave, a.dia,
+               a.docente AS docente_a, a.inicio AS inicio_a, a.fin AS fin_a, a.curso AS curso_a,
+               b.docente AS docente_b, b.inicio AS inicio_b, b.fin AS fin_b, b.curso AS curso_b
+        FROM horario_intervalos a
+        JOIN horario_intervalos b
+          ON b.colegio = a.colegio AND b.{columna} = a.{columna} AND b.dia = a.dia
+         AND b.inicio >= a.inicio AND b.inicio < a.fin
+         AND (b.inicio > a.inicio OR b.id > a.id)
+        WHERE a.colegio = ? AND {filtro}
+        ORDER BY a.{columna}, a.dia, a.inicio
+    """, params)
+    conflictos = [{
+        columna: r["clave"],
+        "dia": r["dia"],
+        "a": {"docente": r["docente_a"], "inicio": a_hhmm(r["inicio_a"]), "fin": a_hhmm(r["fin_a"]), "curso": r["curso_a"]},
+        "b": {"docente": r["docente_b"], "inicio": a_hhmm(r["inicio_b"]), "fin": a_hhmm(r["fin_b"]), "curso": r["curso_b"]},
+    } for r in c.fetchall()]
+    conn.close()
+    return jsonify({"conflictos": conflictos})
+
+
+# =============== EVENTOS: VENTANAS Y EVENTOS RECURRENTES ===============
+# GET /eventos/<colegio>?desde=&hasta= devuelve los eventos que se solapan con
+# la ventana (fecha_inicio <= hasta y fecha_fin >= desde) usando el índice
+# (colegio, fecha_inicio, fecha_fin). Un evento con "regla" se repite y se
+# expande solo dentro de la ventana pedida; las expansiones se memorizan por
+# (evento, ventana) y se descartan al crear, editar o borrar el evento.
+EVENTO_COLUMNAS = "id, colegio, titulo, descripcion, fecha_inicio, fecha_fin, regla"
+EVENTOS_VENTANA_MAX_DIAS = int(os.environ.get("EVENTOS_VENTANA_MAX_DIAS", "400"))
+EVENTOS_EXPANSION_MAX = 2048  # expansiones memorizadas por proceso
+REGLA_FRECUENCIAS = ("diaria", "semanal", "mensual")
+REGLA_MAX_VECES = 1000
+_expansiones = OrderedDict()  # (evento_id, desde, hasta) -> (firma, [(inicio, fin), ...])
+_expansiones_lock = threading.Lock()
+
+
+def _fecha(valor):
+    """'YYYY-MM-DD' o 'YYYY-MM-DD HH:MM' / 'YYYY-MM-DDTHH:MM' -> date."""
+    try:
+        return datetime.strptime(str(valor)[:10], "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError(f"fecha inválida: {valor}") from None
+
+
+def _sumar_meses(dia, meses):
+    anio, mes = divmod(dia.year * 12 + dia.month - 1 + meses, 12)
+    return dia.replace(year=anio, month=mes + 1, day=1)
+
+
+def _dia_del_mes(primero, regla, dia_base):
+    """Fecha de la repetición mensual en el mes de `primero` (None si ese mes no la tiene)."""
+    semana = regla.get("semana")
+    if semana is None:
+        try:
+            return primero.replace(day=dia_base.day)
+        except ValueError:
+            return None  # p.ej. día 31 en un mes de 30
+    desfase = (dia_base.weekday() - primero.weekday()) % 7
+    if semana > 0:
+        dia = primero + timedelta(days=desfase + 7 * (semana - 1))
+        return dia if dia.month == primero.month else None
+    ultimo = _sumar_meses(primero, 1) - timedelta(days=1)
+    return ultimo - timedelta(days=(ultimo.weekday() - dia_base.weekday()) % 7)
+
+
+def _inicios_regla(regla, inicio, desde, hasta):
+    """
+    Fechas de inicio de las repeticiones entre desde y hasta (inclusive), sin
+    recorrer la serie desde el principio: salta directo al primer periodo.
+    """
+    n = regla.get("intervalo", 1)
+    excepciones = set(regla.get("excepciones", ()))
+    fin_serie = _fecha(regla["hasta"]) if regla.get("hasta") else None
+    if fin_serie and fin_serie < hasta:
+        hasta = fin_serie
+    desde = max(desde, inicio)
+    if desde > hasta:
+        return []
+    frecuencia = regla["frecuencia"]
+    fechas = []
+    if frecuencia == "diaria":
+        k = -(-(desde - inicio).days // n)
+        dia = inicio + timedelta(days=k * n)
+        while dia <= hasta:
+            fechas.append(dia)
+            dia += timedelta(days=n)
+    elif frecuencia == "semanal":
+        dias = sorted(DIAS.index(d) for d in regla.get("dias") or [DIAS[inicio.weekday()]])
+        lunes0 = inicio - timedelta(days=inicio.weekday())
+        semana = (desde - lunes0).days // 7 // n * n
+        lunes = lunes0 + timedelta(weeks=semana)
+        while lunes <= hasta:
+            for d in dias:
+                dia = lunes + timedelta(days=d)
+                if desde <= dia <= hasta:
+                    fechas.append(dia)
+            lunes += timedelta(weeks=n)
+    else:  # mensual
+        meses = (desde.year - inicio.year) * 12 + desde.month - inicio.month
+        mes = _sumar_meses(inicio, meses // n * n)
+        while mes <= hasta:
+            dia = _dia_del_mes(mes, regla, inicio)
+            if dia and desde <= dia <= hasta:
+                fechas.append(dia)
+            mes = _sumar_meses(mes, n)
+    return [d for d in fechas if d.isoformat() not in excepciones]
+
+
+def _es_entero(valor):
+    return isinstance(valor, int) and not isinstance(valor, bool)
+
+
+def normalizar_regla(regla, fecha_inicio, fecha_fin):
+    """
+    Valida la regla de repetición del body y devuelve (regla_json, serie_fin),
+    o (None, None) si el evento no se repite. ValueError con el mensaje de error
+    (también si un campo no es del tipo esperado).
+    {"frecuencia": "diaria" | "semanal" | "mensual", "intervalo": 1,
+     "dias": ["Lun", "Mie"],        (semanal; por defecto el día de fecha_inicio)
+     "semana": 1..5 | -1,           (mensual: "el 2do martes", -1 = el último)
+     "hasta": "YYYY-MM-DD" | "veces": 10, "excepciones": ["YYYY-MM-DD"]}
+    serie_fin es el día en que termina la última repetición (None si no termina).
+    """
+    if not regla:
+        return None, None
+    if not isinstance(regla, dict) or regla.get("frecuencia") not in REGLA_FRECUENCIAS:
+        raise ValueError(f"regla.frecuencia debe ser {', '.join(REGLA_FRECUENCIAS)}")
+    inicio = _fecha(fecha_inicio)
+    limpia = {"frecuencia": regla["frecuencia"]}
+    intervalo = regla.get("intervalo", 1)
+    if not _es_entero(intervalo) or intervalo < 1:
+        raise ValueError("regla.intervalo debe ser un entero positivo")
+    limpia["intervalo"] = intervalo
+    if regla["frecuencia"] == "semanal" and regla.get("dias"):
+        if not isinstance(regla["dias"], list) or not all(isinstance(d, str) for d in regla["dias"]):
+            raise ValueError("regla.dias debe ser una lista de días")
+        dias = [normalizar_dia(d) for d in regla["dias"]]
+        if None in dias:
+            raise ValueError("regla.dias inválido")
+        limpia["dias"] = sorted(set(dias), key=DIAS.index)
+    if regla["frecuencia"] == "mensual" and regla.get("semana") is not None:
+        if not _es_entero(regla["semana"]) or regla["semana"] not in (1, 2, 3, 4, 5, -1):
+            raise ValueError("regla.semana debe ser 1 a 5 o -1")
+        limpia["semana"] = regla["semana"]
+    if regla.get("excepciones"):
+        if not isinstance(regla["excepciones"], list):
+            raise ValueError("regla.excepciones debe ser una lista de fechas")
+        limpia["excepciones"] = sorted({_fecha(d).isoformat() for d in regla["excepciones"]})
+    if regla.get("hasta"):
+        limpia["hasta"] = _fecha(regla["hasta"]).isoformat()
+    elif regla.get("veces"):
+        veces = regla["veces"]
+        if not _es_entero(veces) or not 1 <= veces <= REGLA_MAX_VECES:
+            raise ValueError(f"regla.veces debe estar entre 1 y {REGLA_MAX_VECES}")
+        # se guarda como fecha: así la ventana no necesita contar desde el inicio
+        fechas, desde = [], inicio
+        while len(fechas) < veces:
+            hasta = desde + timedelta(days=366)
+            fechas += _inicios_regla(limpia, inicio, desde, hasta)
+            desde = hasta + timedelta(days=1)
+            if desde.year > inicio.year + 100:
+                break
+        if not fechas:
+            raise ValueError("la regla no genera ninguna fecha")
+        limpia["hasta"] = fechas[:veces][-1].isoformat()
+    if "hasta" not in limpia:
+        return json.dumps(limpia, ensure_ascii=False), None
+    duracion = _fecha(fecha_fin or fecha_inicio) - inicio
+    return json.dumps(limpia, ensure_ascii=False), (_fecha(limpia["hasta"]) + duracion).isoformat()
+
+
+def expandir_evento(evento, desde, hasta):
+    """Repeticiones [(fecha_inicio, fecha_fin)] del evento que se solapan con la ventana."""
+    clave = (evento["id"], desde, hasta)
+    firma = (evento["regla"], evento["fecha_inicio"], evento["fecha_fin"])
+    with _expansiones_lock:
+        guardado = _expansiones.get(clave)
+        if guardado and guardado[0] == firma:
+            _expansiones.move_to_end(clave)
+            return guardado[1]
+    regla = json.loads(evento["regla"])
+    fecha_inicio = evento["fecha_inicio"]
+    fecha_fin = evento["fecha_fin"] or fecha_inicio
+    duracion = (_fecha(fecha_fin) - _fecha(fecha_inicio)).days
+    hora_inicio, hora_fin = fecha_inicio[10:], fecha_fin[10:]
+    # una repetición que empieza antes de la ventana puede seguir dentro de ella
+    inicios = _inicios_regla(regla, _fecha(fecha_inicio), _fecha(desde) - timedelta(days=duracion), _fecha(hasta))
+    ocurrencias = [
+        (d.isoformat() + hora_inicio, (d + timedelta(days=duracion)).isoformat() + hora_fin)
+        for d in inicios
+    ]
+    with _expansiones_lock:
+        _expansiones[clave] = (firma, ocurrencias)
+        _expansiones.move_to_end(clave)
+        while len(_expansiones) > EVENTOS_EXPANSION_MAX:
+            _expansiones.popitem(last=False)
+    return ocurrencias
+
+
+def invalidar_expansiones(evento_id):
+    """Descarta las expansiones memorizadas del evento en este proceso."""
+    with _expansiones_lock:
+        for clave in [k for k in _expansiones if k[0] == evento_id]:
+            del _expansiones[clave]
+
+
+def evento_dict(row):
+    return {
+        "id": row["id"],
+        "colegio": row["colegio"],
+        "titulo": row["titulo"],
+        "descripcion": row["descripcion"],
+        "fecha_inicio": row["fecha_inicio"],
+        "fecha_fin": row["fecha_fin"],
+        "regla": json.loads(row["regla"]) if row["regla"] else None,
+    }
+
+
 @app.route("/eventos/<colegio>", methods=["GET"])
 @app.route("/eventos/<colegio>/", methods=["GET"])
+@cache_catalogo("eventos")
 def listar_eventos(colegio):
+    """
+    Sin parámetros: todos los eventos (los recurrentes una vez, con su regla).
+    ?desde=YYYY-MM-DD&hasta=YYYY-MM-DD: los que se solapan con la ventana, con
+    cada repetición de los recurrentes como un evento más ("repeticion": true,
+    mismo id).
+    """
+    desde = request.args.get("desde")
+    hasta = request.args.get("hasta")
     conn = get_conn()
     c = conn.cursor()
-    c.execute("""
-        SELECT id, colegio, titulo, descripcion, fecha_inicio, fecha_fin
+    if not desde and not hasta:
+        c.execute(f"""
+            SELECT {EVENTO_COLUMNAS}
+            FROM eventos
+            WHERE colegio = ?
+            ORDER BY fecha_inicio
+        """, (colegio,))
+        eventos = [evento_dict(r) for r in c.fetchall()]
+        conn.close()
+        return jsonify({"eventos": eventos})
+
+    try:
+        desde_d, hasta_d = _fecha(desde or hasta), _fecha(hasta or desde)
+    except ValueError:
+        conn.close()
+        return jsonify({"error": "desde y hasta deben ser YYYY-MM-DD"}), 400
+    if hasta_d < desde_d or (hasta_d - desde_d).days > EVENTOS_VENTANA_MAX_DIAS:
+        conn.close()
+        return jsonify({"error": f"ventana inválida (máximo {EVENTOS_VENTANA_MAX_DIAS} días)"}), 400
+    desde, hasta = desde_d.isoformat(), hasta_d.isoformat()
+    # fecha_inicio puede traer hora: se compara contra el día siguiente a hasta
+    c.execute(f"""
+        SELECT {EVENTO_COLUMNAS}
         FROM eventos
-        WHERE colegio = ?
-        ORDER BY fecha_inicio
-    """, (colegio,))
+        WHERE colegio = ? AND fecha_inicio < date(?, '+1 day')
+          AND IFNULL(fecha_fin, fecha_inicio) >= ? AND regla IS NULL
+        UNION ALL
+        SELECT {EVENTO_COLUMNAS}
+        FROM eventos
+        WHERE colegio = ? AND regla IS NOT NULL AND fecha_inicio < date(?, '+1 day')
+          AND IFNULL(serie_fin, '9999-12-31') >= ?
+    """, (colegio, hasta, desde, colegio, hasta, desde))
     rows = c.fetchall()
     conn.close()
     eventos = []
     for r in rows:
-        eventos.append({
-            "id": r["id"],
-            "colegio": r["colegio"],
-            "titulo": r["titulo"],
-            "descripcion": r["descripcion"],
-            "fecha_inicio": r["fecha_inicio"],
-            "fecha_fin": r["fecha_fin"],
-        })
+        if not r["regla"]:
+            eventos.append(evento_dict(r))
+            continue
+        for inicio, fin in expandir_evento(r, desde, hasta):
+            eventos.append(dict(evento_dict(r), fecha_inicio=inicio, fecha_fin=fin, repeticion=True))
+    eventos.sort(key=lambda e: (e["fecha_inicio"], e["id"]))
     return jsonify({"eventos": eventos})
 
 
@@ -592,15 +3107,22 @@ def crear_evento():
     fecha_fin = data.get("fecha_fin") or fecha_inicio
     if not colegio or not titulo or not fecha_inicio:
         return jsonify({"error": "faltan datos"}), 400
+    try:
+        regla, serie_fin = normalizar_regla(data.get("regla"), fecha_inicio, fecha_fin)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e) or "regla inválida"}), 400
     conn = get_conn()
     c = conn.cursor()
     c.execute("""
-        INSERT INTO eventos (colegio, titulo, descripcion, fecha_inicio, fecha_fin)
-        VALUES (?, ?, ?, ?, ?)
-    """, (colegio, titulo, descripcion, fecha_inicio, fecha_fin))
+        INSERT INTO eventos (colegio, titulo, descripcion, fecha_inicio, fecha_fin, regla, serie_fin)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (colegio, titulo, descripcion, fecha_inicio, fecha_fin, regla, serie_fin))
+    evento_id = c.lastrowid
+    invalidar_catalogo(c, "eventos", colegio)
     conn.commit()
     conn.close()
-    return jsonify({"mensaje": "evento creado"}), 200
+    invalidar_expansiones(evento_id)
+    return jsonify({"mensaje": "evento creado", "id": evento_id}), 200
 
 
 @app.route("/eventos/<int:evento_id>", methods=["PUT"])
@@ -614,17 +3136,29 @@ def actualizar_evento(evento_id):
     fecha_fin = data.get("fecha_fin") or fecha_inicio
     conn = get_conn()
     c = conn.cursor()
-    c.execute("SELECT id FROM eventos WHERE id=?", (evento_id,))
-    if not c.fetchone():
+    c.execute("SELECT id, colegio, regla FROM eventos WHERE id=?", (evento_id,))
+    anterior = c.fetchone()
+    if not anterior:
         conn.close()
         return jsonify({"error": "evento no encontrado"}), 404
+    # sin "regla" en el body se conserva la que tenía; "regla": null la quita
+    regla = data["regla"] if "regla" in data else (json.loads(anterior["regla"]) if anterior["regla"] else None)
+    try:
+        regla, serie_fin = normalizar_regla(regla, fecha_inicio, fecha_fin)
+    except (TypeError, ValueError) as e:
+        conn.close()
+        return jsonify({"error": str(e) or "regla inválida"}), 400
     c.execute("""
         UPDATE eventos
-        SET colegio=?, titulo=?, descripcion=?, fecha_inicio=?, fecha_fin=?
+        SET colegio=?, titulo=?, descripcion=?, fecha_inicio=?, fecha_fin=?, regla=?, serie_fin=?
         WHERE id=?
-    """, (colegio, titulo, descripcion, fecha_inicio, fecha_fin, evento_id))
+    """, (colegio, titulo, descripcion, fecha_inicio, fecha_fin, regla, serie_fin, evento_id))
+    invalidar_catalogo(c, "eventos", anterior["colegio"])
+    if colegio != anterior["colegio"]:
+        invalidar_catalogo(c, "eventos", colegio)
     conn.commit()
     conn.close()
+    invalidar_expansiones(evento_id)
     return jsonify({"mensaje": "evento actualizado"}), 200
 
 
@@ -633,9 +3167,12 @@ def actualizar_evento(evento_id):
 def eliminar_evento(evento_id):
     conn = get_conn()
     c = conn.cursor()
-    c.execute("DELETE FROM eventos WHERE id=?", (evento_id,))
+    c.execute("DELETE FROM eventos WHERE id=? RETURNING colegio", (evento_id,))
+    for row in c.fetchall():
+        invalidar_catalogo(c, "eventos", row["colegio"])
     conn.commit()
     conn.close()
+    invalidar_expansiones(evento_id)
     return jsonify({"mensaje": "evento eliminado"}), 200
 
 
@@ -729,9 +3266,297 @@ def borrar_asistencia_qr(qr_id):
     c.execute("DELETE FROM asistencia_qr WHERE id=?", (qr_id,))
     conn.commit()
     conn.close()
+    olvidar_imagenes_qr(qr_id)
     return jsonify({"mensaje": "qr eliminado"}), 200
 
 
+# =============== ASISTENCIA QR: IMÁGENES ===============
+QR_CACHE_DIR = os.environ.get("QR_CACHE_DIR", os.path.join(BASE_DIR, "qr_cache"))
+QR_CACHE_MAX = int(os.environ.get("QR_CACHE_MAX", "256"))       # imágenes en memoria
+QR_WORKERS = int(os.environ.get("QR_WORKERS", "2"))              # hilos para hojas de impresión
+QR_HOJAS_EN_COLA = int(os.environ.get("QR_HOJAS_EN_COLA", "8"))
+QR_HOJA_ESPERA = float(os.environ.get("QR_HOJA_ESPERA", "2"))    # segundos antes de responder 202
+QR_HOJAS_MAX_MB = float(os.environ.get("QR_HOJAS_MAX_MB", "200"))  # hojas guardadas en disco
+QR_IMAGENES_MAX_MB = float(os.environ.get("QR_IMAGENES_MAX_MB", "200"))  # QR sueltos en disco
+QR_FORMATOS = {"png": "image/png", "svg": "image/svg+xml"}
+
+_qr_cache = OrderedDict()  # (qr_id, sha1(payload), size, formato) -> bytes (size None en SVG)
+_qr_lock = threading.Lock()
+_hojas_pool = None
+_hojas_pool_pid = None
+_hojas_en_curso = {}  # clave -> Future
+
+
+def _render_qr(payload, size, formato):
+    """Genera la imagen del QR (PNG de size x size px, o SVG)."""
+    qr = qrcode.QRCode(border=2, box_size=10, error_correction=qrcode.constants.ERROR_CORRECT_M)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    buf = io.BytesIO()
+    if formato == "svg":
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buf)
+    else:
+        img = qr.make_image(fill_color="black", back_color="white").get_image().convert("L")
+        img.resize((size, size), Image.NEAREST).save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def imagen_qr(qr_id, payload, size, formato):
+    """Imagen del QR desde la caché en memoria, luego la de disco, o renderizada."""
+    huella = hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+    if formato == "svg":
+        size = None  # vectorial: un solo archivo sirve para todos los tamaños
+    clave = (qr_id, huella, size, formato)
+    with _qr_lock:
+        datos = _qr_cache.get(clave)
+        if datos is not None:
+            _qr_cache.move_to_end(clave)
+            return datos
+
+    nombre = f"{huella}.svg" if size is None else f"{huella}-{size}.{formato}"
+    ruta = os.path.join(QR_CACHE_DIR, str(qr_id), nombre)
+    try:
+        with open(ruta, "rb") as f:
+            datos = f.read()
+        os.utime(ruta)
+    except FileNotFoundError:
+        datos = _render_qr(payload, size, formato)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(ruta))
+        with os.fdopen(fd, "wb") as f:
+            f.write(datos)
+        os.replace(tmp, ruta)
+        _podar_lru(_imagenes_en_disco(), ruta, QR_IMAGENES_MAX_MB)
+
+    with _qr_lock:
+        _qr_cache[clave] = datos
+        while len(_qr_cache) > QR_CACHE_MAX:
+            _qr_cache.popitem(last=False)
+    return datos
+
+
+def olvidar_imagenes_qr(qr_id):
+    """Borra de ambas cachés las imágenes y las hojas de un formulario eliminado."""
+    with _qr_lock:
+        for clave in [k for k in _qr_cache if k[0] == qr_id]:
+            del _qr_cache[clave]
+    directorio = os.path.join(QR_CACHE_DIR, str(qr_id))
+    try:
+        with open(os.path.join(directorio, "hojas.txt"), encoding="utf-8") as f:
+            hojas = f.read().split()
+    except FileNotFoundError:
+        hojas = []
+    for nombre in hojas:
+        try:
+            os.unlink(os.path.join(QR_CACHE_DIR, "hojas", nombre))
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(directorio, ignore_errors=True)
+
+
+def _tam_qr():
+    return max(64, min(request.args.get("size", 300, type=int), 2048))
+
+
+@app.route("/asistencia_qr/<int:qr_id>/qr.<formato>", methods=["GET"])
+def imagen_asistencia_qr(qr_id, formato):
+    """
+    Imagen del QR de un formulario.
+    GET /asistencia_qr/5/qr.png?size=400   (o qr.svg)
+    """
+    if formato not in QR_FORMATOS:
+        return jsonify({"error": "formato inválido (png o svg)"}), 400
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT qr_string FROM asistencia_qr WHERE id=?", (qr_id,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return jsonify({"error": "qr no encontrado"}), 404
+
+    size = _tam_qr()
+    datos = imagen_qr(qr_id, row["qr_string"], size, formato)
+    resp = Response(datos, mimetype=QR_FORMATOS[formato])
+    resp.set_etag(hashlib.sha1(datos).hexdigest())
+    resp.headers["Cache-Control"] = "private, max-age=3600"
+    return resp.make_conditional(request)
+
+
+def _fuente(tam):
+    try:
+        return ImageFont.load_default(size=tam)
+    except TypeError:  # Pillow sin FreeType / versión vieja
+        return ImageFont.load_default()
+
+
+def _render_hoja(formularios, size, formato, ruta):
+    """
+    Arma la hoja A4 (150 dpi, 2 x 3 QR por página) con el título debajo de
+    cada QR y la guarda en `ruta` (PDF o PNG de la primera página).
+    """
+    ancho, alto, margen = 1240, 1754, 80
+    cols, filas = 2, 3
+    celda_w = (ancho - 2 * margen) // cols
+    celda_h = (alto - 2 * margen) // filas
+    lado = min(size, celda_w - 40, celda_h - 90)
+    fuente = _fuente(28)
+    paginas = []
+    for i, (qr_id, titulo, payload) in enumerate(formularios):
+        if i % (cols * filas) == 0:
+            pagina = Image.new("L", (ancho, alto), 255)
+            dibujo = ImageDraw.Draw(pagina)
+            paginas.append(pagina)
+        pos = i % (cols * filas)
+        x = margen + (pos % cols) * celda_w
+        y = margen + (pos // cols) * celda_h
+        qr_img = Image.open(io.BytesIO(imagen_qr(qr_id, payload, lado, "png")))
+        pagina.paste(qr_img, (x + (celda_w - lado) // 2, y))
+        texto = (titulo or "")[:40]
+        tw = dibujo.textlength(texto, font=fuente)
+        dibujo.text((x + (celda_w - tw) / 2, y + lado + 20), texto, fill=0, font=fuente)
+
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(ruta))
+    with os.fdopen(fd, "wb") as f:
+        if formato == "pdf":
+            paginas[0].save(f, format="PDF", resolution=150, save_all=True, append_images=paginas[1:])
+        else:
+            paginas[0].save(f, format="PNG", optimize=True)
+    os.replace(tmp, ruta)
+    # cada formulario anota sus hojas para borrarlas si se elimina
+    for qr_id, _titulo, _payload in formularios:
+        directorio = os.path.join(QR_CACHE_DIR, str(qr_id))
+        os.makedirs(directorio, exist_ok=True)
+        with open(os.path.join(directorio, "hojas.txt"), "a", encoding="utf-8") as f:
+            f.write(os.path.basename(ruta) + "\n")
+    directorio = os.path.dirname(ruta)
+    _podar_lru((e for e in os.scandir(directorio) if e.name.endswith((".pdf", ".png"))),
+               ruta, QR_HOJAS_MAX_MB)
+
+
+def _imagenes_en_disco():
+    """Entradas de los QR sueltos guardados en QR_CACHE_DIR/<qr_id>/."""
+    for carpeta in os.scandir(QR_CACHE_DIR):
+        if not carpeta.name.isdigit():
+            continue
+        try:
+            archivos = list(os.scandir(carpeta.path))
+        except FileNotFoundError:
+            continue  # formulario borrado mientras tanto
+        yield from (e for e in archivos if e.name.endswith((".png", ".svg")))
+
+
+def _podar_lru(entradas, nueva, limite_mb):
+    """
+    LRU en disco: si los archivos pasan de limite_mb borra los de uso más
+    viejo (cada acierto renueva el mtime). El recién hecho no se toca.
+    """
+    archivos = []
+    for entrada in entradas:
+        if entrada.path == nueva:
+            continue
+        try:
+            st = entrada.stat()
+        except FileNotFoundError:
+            continue
+        archivos.append((st.st_mtime, st.st_size, entrada.path))
+    total = sum(a[1] for a in archivos)
+    try:
+        total += os.path.getsize(nueva)
+    except FileNotFoundError:
+        pass  # la podó otro worker
+    limite = limite_mb * 1024 * 1024
+    for _mtime, tam, ruta in sorted(archivos):
+        if total <= limite:
+            break
+        try:
+            os.unlink(ruta)
+        except FileNotFoundError:
+            pass
+        total -= tam
+
+
+def _pool_hojas():
+    global _hojas_pool, _hojas_pool_pid
+    if _hojas_pool_pid != os.getpid():
+        _hojas_pool = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr-hojas")
+        _hojas_pool_pid = os.getpid()
+        _hojas_en_curso.clear()
+    return _hojas_pool
+
+
+@app.route("/asistencia_qr/hoja_impresion", methods=["GET"])
+def hoja_impresion_qr():
+    """
+    Hoja imprimible con varios QR.
+    GET /asistencia_qr/hoja_impresion?ids=3,4,7&size=400&formato=pdf|png
+    Se genera en un pool de hilos y queda guardada en disco: si tarda más
+    de QR_HOJA_ESPERA segundos responde 202 y el cliente reintenta la misma URL.
+    """
+    formato = (request.args.get("formato") or "pdf").lower()
+    if formato not in ("pdf", "png"):
+        return jsonify({"error": "formato inválido (pdf o png)"}), 400
+    try:
+        ids = [int(x) for x in (request.args.get("ids") or "").split(",") if x.strip()]
+    except ValueError:
+        return jsonify({"error": "ids inválidos"}), 400
+    if not ids or len(ids) > 60:
+        return jsonify({"error": "indique entre 1 y 60 ids"}), 400
+    size = _tam_qr()
+
+    # los ids pueden ser de distintos colegios (shards)
+    por_id = {}
+    for _colegio, conn in iterar_shards():
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT id, titulo, qr_string, colegio FROM asistencia_qr
+            WHERE id IN ({", ".join("?" * len(ids))})
+        """, ids)
+        filas = c.fetchall()
+        conn.close()
+        if g.usuario and any(r["colegio"] != g.usuario["colegio"] for r in filas):
+            return jsonify({"error": "sin acceso a este colegio"}), 403
+        por_id.update({r["id"]: (r["id"], r["titulo"], r["qr_string"]) for r in filas})
+    formularios = [por_id[i] for i in ids if i in por_id]
+    if not formularios:
+        return jsonify({"error": "qr no encontrado"}), 404
+
+    # misma selección y contenido -> mismo archivo (lo reusan todos los workers)
+    clave = hashlib.sha1(json.dumps([formularios, size, formato]).encode("utf-8")).hexdigest()
+    ruta = os.path.join(QR_CACHE_DIR, "hojas", f"{clave}.{formato}")
+    mimetype = "application/pdf" if formato == "pdf" else "image/png"
+
+    try:
+        os.utime(ruta)  # acierto: la poda borra primero las de uso más viejo
+        generar = False
+    except FileNotFoundError:
+        generar = True
+    if generar:
+        with _qr_lock:
+            pool = _pool_hojas()
+            futuro = _hojas_en_curso.get(clave)
+            if futuro is None:
+                if len(_hojas_en_curso) >= QR_HOJAS_EN_COLA:
+                    return jsonify({"error": "servidor ocupado, reintente"}), 503, {"Retry-After": "2"}
+                futuro = pool.submit(_render_hoja, formularios, size, formato, ruta)
+                _hojas_en_curso[clave] = futuro
+                futuro.add_done_callback(lambda _f: _hojas_en_curso.pop(clave, None))
+        try:
+            futuro.result(timeout=QR_HOJA_ESPERA)
+        except FuturoTimeout:
+            return jsonify({"mensaje": "generando hoja, reintente"}), 202, {"Retry-After": "2"}
+
+    try:
+        with open(ruta, "rb") as f:
+            datos = f.read()
+    except FileNotFoundError:
+        # la borró la poda de otro worker justo ahora
+        return jsonify({"mensaje": "generando hoja, reintente"}), 202, {"Retry-After": "1"}
+    resp = Response(datos, mimetype=mimetype)
+    resp.headers.set("Content-Disposition", "inline", filename=f"qr_{'_'.join(map(str, ids[:5]))}.{formato}")
+    return resp
+
+
 @app.route("/asistencia_qr/registrar", methods=["POST"])
 def registrar_asistencia():
     data = request.get_json()
@@ -754,14 +3579,43 @@ def registrar_asistencia():
 
 @app.route("/asistencia_qr/registros/<int:qr_id>", methods=["GET"])
 def listar_registros_qr(qr_id):
+    """
+    Respuestas de un formulario QR.
+    Los parámetros con el nombre de un campo del formulario filtran por ese
+    campo (sin distinguir mayúsculas), p.ej. ?curso=3A&ci=1234567. Para otras
+    claves de 'datos' se usa el prefijo campo.: ?campo.turno=tarde.
+    El resto de los parámetros (p.ej. ?_=123 contra cachés) se ignoran.
+    """
     conn = get_conn()
     c = conn.cursor()
-    c.execute("""
+    c.execute("SELECT campos FROM asistencia_qr WHERE id=?", (qr_id,))
+    qr = c.fetchone()
+    try:
+        campos = set(json.loads(qr["campos"] or "[]")) if qr else set()
+    except Exception:
+        campos = set()
+
+    params = [qr_id]
+    filtro = ""
+    for nombre, valor in request.args.items():
+        if nombre.startswith("campo."):
+            campo = nombre[len("campo."):]
+        elif nombre in campos:
+            campo = nombre
+        else:
+            continue
+        filtro += """
+          AND id IN (SELECT registro_id FROM {t}.asistencia_registro_campos
+                     WHERE qr_id = ? AND campo = ? AND valor = ?)"""
+        params.extend([qr_id, campo, valor])
+
+    esquemas = adjuntar_archivos(conn, anios_archivados_qr(c, [qr_id]))
+    fuente = union_archivos(esquemas, f"""
         SELECT id, qr_id, datos, creado_en
-        FROM asistencia_registros
-        WHERE qr_id=?
-        ORDER BY creado_en DESC
-    """, (qr_id,))
+        FROM {{t}}.asistencia_registros
+        WHERE qr_id=? {filtro}
+    """)
+    c.execute(f"SELECT * FROM ({fuente}) ORDER BY creado_en DESC", params * len(esquemas))
     registros = []
     for row in c.fetchall():
         try:
@@ -778,6 +3632,93 @@ def listar_registros_qr(qr_id):
     return jsonify({"registros": registros})
 
 
+@app.route("/asistencia_qr/distribucion/<int:qr_id>", methods=["GET"])
+def distribucion_campos_qr(qr_id):
+    """
+    Cuántas respuestas hay por valor de cada campo de un formulario QR.
+    GET /asistencia_qr/distribucion/5?campo=curso&limit=50
+    Devuelve: { total, campos: { campo: [ {valor, total} ] } }
+    """
+    campo = request.args.get("campo")
+    limit = max(1, min(request.args.get("limit", 50, type=int), 1000))
+
+    conn = get_conn()
+    c = conn.cursor()
+    esquemas = adjuntar_archivos(conn, anios_archivados_qr(c, [qr_id]))
+    total = c.execute(f"""
+        SELECT SUM(n) FROM ({union_archivos(esquemas, "SELECT COUNT(*) AS n FROM {t}.asistencia_registros WHERE qr_id=?")})
+    """, (qr_id,) * len(esquemas)).fetchone()[0]
+
+    params = [qr_id]
+    filtro = ""
+    if campo:
+        filtro = " AND campo = ?"
+        params.append(campo)
+    fuente = union_archivos(esquemas, f"""
+        SELECT campo, valor FROM {{t}}.asistencia_registro_campos
+        WHERE qr_id = ? {filtro}
+    """)
+    c.execute(f"""
+        SELECT campo, valor, COUNT(*) AS total
+        FROM ({fuente})
+        GROUP BY campo, valor
+        ORDER BY campo, total DESC, valor
+    """, params * len(esquemas))
+    campos = {}
+    for row in c.fetchall():
+        valores = campos.setdefault(row["campo"], [])
+        if len(valores) < limit:
+            valores.append({"valor": row["valor"], "total": row["total"]})
+    conn.close()
+    return jsonify({"total": total, "campos": campos})
+
+
+@app.route("/asistencia_qr/registros/<int:qr_id>.csv", methods=["GET"])
+def exportar_registros_qr_csv(qr_id):
+    """
+    Exporta las respuestas de un formulario QR en CSV (streaming).
+    Una columna por cada campo del formulario; las claves de 'datos' que
+    no son campos del formulario van juntas en la columna 'otros' (JSON).
+    """
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("SELECT titulo, campos FROM asistencia_qr WHERE id=?", (qr_id,))
+    qr = c.fetchone()
+    if not qr:
+        conn.close()
+        return jsonify({"error": "qr no encontrado"}), 404
+    try:
+        campos = json.loads(qr["campos"] or "[]")
+    except Exception:
+        campos = []
+    esquemas = adjuntar_archivos(conn, anios_archivados_qr(c, [qr_id]))
+    fuente = union_archivos(esquemas, """
+        SELECT id, datos, creado_en FROM {t}.asistencia_registros WHERE qr_id=?
+    """)
+
+    def generar():
+        w = csv.writer(_EcoCSV())
+        yield w.writerow(["id", "creado_en"] + campos + ["otros"])
+        for rows in iterar_consulta(f"""
+            SELECT id, datos, creado_en FROM ({fuente})
+            ORDER BY creado_en, id
+        """, (qr_id,) * len(esquemas), conn=conn):
+            lineas = []
+            for r in rows:
+                try:
+                    datos = json.loads(r["datos"] or "{}")
+                except Exception:
+                    datos = {}
+                if not isinstance(datos, dict):
+                    datos = {}
+                fila = [r["id"], r["creado_en"]] + [datos.pop(cpo, "") for cpo in campos]
+                fila.append(json.dumps(datos, ensure_ascii=False) if datos else "")
+                lineas.append(w.writerow(fila))
+            yield "".join(lineas)
+
+    return respuesta_csv(generar(), f"asistencia_qr_{qr_id}.csv")
+
+
 @app.route("/asistencia_qr/estadisticas/<colegio>", methods=["GET"])
 @app.route("/asistencia_qr/estadisticas/<colegio>/", methods=["GET"])
 def estadisticas_asistencia(colegio):
@@ -810,10 +3751,619 @@ def estadisticas_asistencia(colegio):
     """, params)
 
     items = [dict(row) for row in c.fetchall()]
+    # respuestas que ya pasaron al archivo anual
+    por_id = {it["qr_id"]: it for it in items}
+    esquemas = adjuntar_archivos(conn, anios_archivados_qr(c, list(por_id))) if por_id else ["main"]
+    marcas = ", ".join("?" * len(por_id))
+    for esquema in esquemas[1:]:
+        for row in c.execute(f"""
+            SELECT qr_id, COUNT(*) FROM {esquema}.asistencia_registros
+            WHERE qr_id IN ({marcas}) GROUP BY qr_id
+        """, list(por_id)):
+            por_id[row[0]]["total_respuestas"] += row[1]
     conn.close()
     return jsonify({"items": items})
 
 
+# =============== ASISTENCIA BIOMÉTRICA: INSERCIÓN ===============
+MARCACION_COLUMNAS = "id, colegio, usuario_id, usuario_nombre, email, tipo, timestamp"
+MARCAR_LOTE_MAX = int(os.environ.get("MARCAR_LOTE_MAX", "5000"))
+_FILAS_POR_INSERT = 500  # 6 parámetros por fila, muy por debajo del límite de SQLite
+
+
+def _normalizar_timestamp(valor):
+    """
+    Convierte un timestamp del cliente al formato que guarda la BD
+    ('YYYY-MM-DD HH:MM:SS'). None si no vino. ValueError si es inválido.
+    """
+    if valor in (None, ""):
+        return None
+    dt = datetime.fromisoformat(str(valor).strip().replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        # la BD guarda hora local sin zona
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+_TIPOS_MARCACION = (("colegio", str), ("usuario_nombre", str), ("tipo", str),
+                    ("email", str), ("usuario_id", int))
+
+
+def _campo_mal_tipado(data):
+    """Primer campo de una marcación que no es del tipo esperado, o None."""
+    for campo, tipo in _TIPOS_MARCACION:
+        valor = data.get(campo)
+        if valor is not None and (not isinstance(valor, tipo) or isinstance(valor, bool)):
+            return campo
+    return None
+
+
+def _validar_marcacion(data):
+    """Devuelve (fila, None) o (None, error) para una marcación de la puerta."""
+    if not isinstance(data, dict):
+        return None, "marcacion inválida"
+    campo = _campo_mal_tipado(data)
+    if campo:
+        return None, f"{campo} inválido"
+    colegio = data.get("colegio")
+    usuario_nombre = data.get("usuario_nombre")
+    tipo = (data.get("tipo") or "").lower()
+    if not colegio or not usuario_nombre or tipo not in ("entrada", "salida"):
+        return None, "datos inválidos"
+    try:
+        ts = _normalizar_timestamp(data.get("timestamp"))
+    except (TypeError, ValueError):
+        return None, "timestamp inválido"
+    fila = (colegio, data.get("usuario_id"), usuario_nombre, data.get("email", ""), tipo, ts)
+    return fila, None
+
+
+def _insertar_marcaciones(c, filas):
+    """
+    Inserta filas (colegio, usuario_id, usuario_nombre, email, tipo, timestamp)
+    con INSERT multi-fila + RETURNING. No hace commit.
+    Devuelve las filas guardadas en el mismo orden que `filas`.
+    """
+    guardadas = []
+    for i in range(0, len(filas), _FILAS_POR_INSERT):
+        bloque = filas[i:i + _FILAS_POR_INSERT]
+        valores = ", ".join(["(?, ?, ?, ?, ?, COALESCE(?, datetime('now','localtime')))"] * len(bloque))
+        params = [v for fila in bloque for v in fila]
+        c.execute(f"""
+            INSERT INTO asistencia_marcaciones (colegio, usuario_id, usuario_nombre, email, tipo, timestamp)
+            VALUES {valores}
+            RETURNING {MARCACION_COLUMNAS}
+        """, params)
+        # los ids son crecientes en el orden de VALUES
+        guardadas.extend(sorted((dict(r) for r in c.fetchall()), key=lambda r: r["id"]))
+
+    conteos = {}
+    for fila in filas:
+        clave = (fila[0], fila[2], fila[3])
+        conteos[clave] = conteos.get(clave, 0) + 1
+    _sumar_personas(c, conteos)
+    return guardadas
+
+
+def guardar_marcaciones(filas):
+    """
+    Inserta y confirma filas de uno o varios colegios: una transacción por
+    base (una sola sin DB_SHARDS). Devuelve las filas en el orden de `filas`.
+    """
+    grupos = {}
+    for i, fila in enumerate(filas):
+        shard = shard_de(fila[0])
+        grupos.setdefault(shard and shard[1], (fila[0], []))[1].append(i)
+    guardadas = [None] * len(filas)
+    for colegio, indices in grupos.values():
+        conn = get_conn(colegio)
+        try:
+            items = _insertar_marcaciones(conn.cursor(), [filas[i] for i in indices])
+            conn.commit()
+        finally:
+            conn.close()
+        for i, item in zip(indices, items):
+            guardadas[i] = item
+    feed_marcaciones.avisar()
+    return guardadas
+
+
+# =============== ASISTENCIA BIOMÉTRICA: COLA DE ESCRITURA (opcional) ===============
+# Con MARCAR_MODO_COLA=1, /asistencia_biometrico/marcar responde apenas la
+# marcación queda en el diario local del worker (append + fsync) y un hilo
+# la pasa a SQLite en lotes: una transacción cada COLA_FLUSH_MS ms o cada
+# COLA_FLUSH_FILAS marcaciones. Si un worker muere, el siguiente que arranca
+# recupera sus diarios al iniciar el proceso (al importar la app y, con
+# gunicorn, en post_worker_init): entrega "al menos una vez". Las filas que
+# la base rechaza por su contenido van a COLA_DIR/descartadas.jsonl.
+MARCAR_MODO_COLA = os.environ.get("MARCAR_MODO_COLA", "0") == "1"
+COLA_DIR = os.environ.get("COLA_DIR", os.path.join(BASE_DIR, "cola_marcaciones"))
+COLA_MAX = int(os.environ.get("COLA_MAX", "10000"))
+COLA_FLUSH_MS = int(os.environ.get("COLA_FLUSH_MS", "200"))
+COLA_FLUSH_FILAS = int(os.environ.get("COLA_FLUSH_FILAS", "500"))
+COLA_FSYNC = os.environ.get("COLA_FSYNC", "1") == "1"
+
+
+def _error_pasajero(e):
+    """Fallas que no dependen de la fila: base bloqueada, pool agotado, shard en mudanza."""
+    if isinstance(e, sqlite3.IntegrityError):
+        return SHARD_MOVIDO in str(e)
+    return isinstance(e, (sqlite3.OperationalError, RuntimeError, OSError))
+
+
+class ColaMarcaciones:
+    """Cola de marcaciones con diario en disco y escritor en segundo plano."""
+
+    def __init__(self, directorio, max_filas, flush_ms, flush_filas):
+        self.directorio = directorio
+        self.max_filas = max_filas
+        self.flush_ms = flush_ms
+        self.flush_filas = flush_filas
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._descartadas = 0
+
+    def _iniciar(self):
+        # se llama con self._lock tomado; una vez por proceso (post-fork)
+        self._pid = os.getpid()
+        self._pendientes = []
+        self._segmentos = []  # diarios cuyo contenido está en _pendientes
+        self._seq = 0
+        self._evento = threading.Event()
+        self._detener = threading.Event()
+        self._encoladas = 0
+        self._rechazadas = 0
+        self._escritas = 0
+        self._commits = 0
+        self._errores = 0
+        self._descartadas = 0
+        self._lote_ultimo = 0
+        self._lote_max = 0
+        self._commit_ms_ultimo = 0.0
+        os.makedirs(self.directorio, exist_ok=True)
+        self._abrir_segmento()
+        self._hilo = threading.Thread(target=self._loop, name="cola-marcaciones", daemon=True)
+        self._hilo.start()
+
+    def _abrir_segmento(self):
+        self._seq += 1
+        nombre = f"seg-{self._pid}-{self._seq}.jsonl"
+        ruta = os.path.join(self.directorio, nombre)
+        # se crea con otro nombre y se renombra ya con el lock: quien recupera
+        # nunca ve un seg-*.jsonl sin dueño que todavía no tomó el lock
+        nuevo = os.path.join(self.directorio, "." + nombre)
+        f = open(nuevo, "a", encoding="utf-8")
+        # el lock indica que el diario tiene dueño vivo
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.rename(nuevo, ruta)
+        self._segmentos.append((ruta, f))
+
+    def _guardar(self, filas):
+        """
+        Guarda las filas; si el lote falla, una por una, y las que fallan por
+        su contenido van a descartadas.jsonl. Devuelve las que no se pudieron
+        guardar por un error pasajero, para reintentarlas.
+        """
+        try:
+            guardar_marcaciones(filas)
+            return []
+        except Exception as e:
+            if _error_pasajero(e):
+                print("Aviso cola marcaciones:", e)
+                return list(filas)
+        for i, fila in enumerate(filas):
+            try:
+                guardar_marcaciones([fila])
+            except Exception as e:
+                if _error_pasajero(e):
+                    print("Aviso cola marcaciones:", e)
+                    return list(filas[i:])
+                self._descartar(fila, e)
+        return []
+
+    def _descartar(self, fila, error):
+        with open(os.path.join(self.directorio, "descartadas.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"fila": fila, "error": str(error)}, default=str) + "\n")
+        self._descartadas += 1
+        print(f"Cola marcaciones: fila descartada ({error}): {fila!r}")
+
+    def recuperar_huerfanos(self):
+        """Pasa a SQLite los diarios de workers muertos. Al iniciar el proceso; nunca falla."""
+        try:
+            self._recuperar()
+        except Exception as e:
+            print("Aviso cola marcaciones al recuperar:", e)
+
+    def _recuperar(self):
+        if not os.path.isdir(self.directorio):
+            return
+        for nombre in sorted(os.listdir(self.directorio)):
+            ruta = os.path.join(self.directorio, nombre)
+            if nombre.startswith(".seg-") and nombre.endswith(".jsonl"):
+                # su dueño murió antes de renombrarlo: está vacío
+                pid = nombre[5:].split("-", 1)[0]
+                if pid.isdigit() and not Metricas._vivo(int(pid)):
+                    try:
+                        os.unlink(ruta)
+                    except FileNotFoundError:
+                        pass
+                continue
+            if not (nombre.startswith("seg-") and nombre.endswith(".jsonl")):
+                continue
+            try:
+                f = open(ruta, "r+", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()  # lo tiene otro worker vivo
+                continue
+            try:
+                # otro proceso pudo recuperarlo y borrarlo entre el open y el lock
+                vigente = os.stat(ruta).st_ino == os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                vigente = False
+            if not vigente:
+                f.close()
+                continue
+            filas = []
+            for linea in f:
+                try:
+                    filas.append(tuple(json.loads(linea)))
+                except ValueError:
+                    pass  # última línea cortada por la caída
+            quedan = self._guardar(filas) if filas else []
+            if quedan:
+                # se deja solo lo pendiente para el próximo arranque
+                f.seek(0)
+                f.truncate()
+                f.writelines(json.dumps(fila) + "\n" for fila in quedan)
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                print(f"Cola marcaciones: {len(quedan)} de {nombre} quedan para reintentar")
+                continue
+            os.unlink(ruta)
+            f.close()
+            print(f"Cola marcaciones: recuperadas {len(filas)} de {nombre}")
+
+    def encolar(self, fila):
+        """Guarda la fila en el diario. False si la cola está llena."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._iniciar()
+            if len(self._pendientes) >= self.max_filas:
+                self._rechazadas += 1
+                return False
+            f = self._segmentos[-1][1]
+            f.write(json.dumps(fila) + "\n")
+            f.flush()
+            if COLA_FSYNC:
+                os.fsync(f.fileno())
+            self._pendientes.append(fila)
+            self._encoladas += 1
+            lleno = len(self._pendientes) >= self.flush_filas
+        if lleno:
+            self._evento.set()
+        return True
+
+    def _loop(self):
+        while not self._detener.is_set():
+            self._evento.wait(self.flush_ms / 1000.0)
+            self._evento.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("Aviso cola marcaciones:", e)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._pid != os.getpid() or not self._pendientes:
+                    return 0
+                lote, self._pendientes = self._pendientes, []
+                segmentos, self._segmentos = self._segmentos, []
+                self._abrir_segmento()
+            inicio = time.perf_counter()
+            descartadas = self._descartadas
+            quedan = self._guardar(lote)
+            if quedan:
+                with self._lock:
+                    # lo que queda pasa al diario nuevo y los viejos se borran:
+                    # los reintentos no acumulan archivos abiertos
+                    f = self._segmentos[-1][1]
+                    try:
+                        f.writelines(json.dumps(fila) + "\n" for fila in quedan)
+                        f.flush()
+                        if COLA_FSYNC:
+                            os.fsync(f.fileno())
+                    except OSError:
+                        self._segmentos = segmentos + self._segmentos
+                        raise
+                    finally:
+                        self._pendientes = quedan + self._pendientes
+                        self._errores += 1
+            for ruta, f in segmentos:
+                os.unlink(ruta)
+                f.close()
+            escritas = len(lote) - len(quedan) - (self._descartadas - descartadas)
+            with self._lock:
+                self._escritas += escritas
+                self._commits += 1
+                self._lote_ultimo = len(lote)
+                self._lote_max = max(self._lote_max, len(lote))
+                self._commit_ms_ultimo = (time.perf_counter() - inicio) * 1000
+            return escritas
+
+    def cerrar(self):
+        if self._pid != os.getpid():
+            return
+        self._detener.set()
+        self._evento.set()
+        self._hilo.join(timeout=10)
+        try:
+            self.flush()
+        except Exception as e:
+            print("Aviso cola marcaciones al cerrar:", e)
+            return
+        with self._lock:
+            if not self._pendientes:
+                for ruta, f in self._segmentos:
+                    os.unlink(ruta)
+                    f.close()
+                self._segmentos = []
+
+    def stats(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {"activa": False, "modo_cola": MARCAR_MODO_COLA}
+            return {
+                "activa": True,
+                "modo_cola": MARCAR_MODO_COLA,
+                "pid": self._pid,
+                "profundidad": len(self._pendientes),
+                "max": self.max_filas,
+                "encoladas": self._encoladas,
+                "rechazadas": self._rechazadas,
+                "escritas": self._escritas,
+                "commits": self._commits,
+                "errores": self._errores,
+                "descartadas": self._descartadas,
+                "lote_ultimo": self._lote_ultimo,
+                "lote_max": self._lote_max,
+                "lote_promedio": round(self._escritas / self._commits, 2) if self._commits else 0.0,
+                "commit_ms_ultimo": round(self._commit_ms_ultimo, 3),
+            }
+
+
+cola_marcaciones = ColaMarcaciones(COLA_DIR, COLA_MAX, COLA_FLUSH_MS, COLA_FLUSH_FILAS)
+atexit.register(cola_marcaciones.cerrar)
+
+
+# =============== ASISTENCIA BIOMÉTRICA: EN VIVO (SSE) ===============
+# /asistencia_biometrico/stream/<colegio> empuja cada marcación confirmada
+# como un evento SSE cuyo id es el id de la marcación. En cada worker un solo
+# hilo vigila la base: cada SSE_POLL_S consulta PRAGMA data_version (no lee
+# tablas) y solo si otra conexión hizo commit lee las marcaciones con id mayor
+# a la última vista y las reparte entre los suscriptores de cada colegio. Los
+# commits del propio worker lo despiertan en el acto. Sin suscriptores duerme.
+# Cada stream ocupa un hilo: en producción va con workers gthread (ver
+# gunicorn.conf.py, que sube SSE_MAX_S a 300). Sin esa configuración los
+# streams se cortan antes del timeout de 30 s del worker sync de gunicorn.
+SSE_POLL_S = float(os.environ.get("SSE_POLL_S", "1"))
+SSE_MAX_S = float(os.environ.get("SSE_MAX_S", "25"))  # luego EventSource reconecta con Last-Event-ID
+SSE_MAX_SUSCRIPTORES = int(os.environ.get("SSE_MAX_SUSCRIPTORES", "200"))  # por worker
+SSE_PING_S = 15
+SSE_COLA = 1000  # eventos sin enviar por suscriptor antes de cortarlo
+SSE_REANUDAR_MAX = 5000  # marcaciones que se reenvían al reanudar
+_SSE_LOTE = 500
+
+
+def evento_sse(fila):
+    return f"id: {fila['id']}\nevent: marcacion\ndata: {json.dumps(dict(fila), ensure_ascii=False)}\n\n"
+
+
+class _Suscriptor:
+    __slots__ = ("cola", "cortado")
+
+    def __init__(self):
+        self.cola = queue.Queue(SSE_COLA)
+        self.cortado = False  # se llenó su cola: debe reconectar y reanudar
+
+
+class FeedMarcaciones:
+    """Reparte las marcaciones nuevas a los streams SSE de este worker."""
+
+    def __init__(self, poll_s):
+        self.poll_s = poll_s
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _iniciar(self):
+        # con self._lock tomado; una vez por proceso (post-fork)
+        self._pid = os.getpid()
+        self._suscriptores = {}  # colegio -> set de _Suscriptor
+        self._vistas = {}  # ruta de la base -> [conexión, data_version, último id]
+        self._despertar = threading.Event()
+        threading.Thread(target=self._loop, name="feed-marcaciones", daemon=True).start()
+
+    def suscribir(self, colegio):
+        """Un _Suscriptor nuevo, o None si el worker ya tiene demasiados."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._iniciar()
+            if sum(len(s) for s in self._suscriptores.values()) >= SSE_MAX_SUSCRIPTORES:
+                return None
+            sus = _Suscriptor()
+            self._suscriptores.setdefault(colegio, set()).add(sus)
+        self._despertar.set()
+        return sus
+
+    def lleno(self):
+        with self._lock:
+            return (self._pid == os.getpid()
+                    and sum(len(s) for s in self._suscriptores.values()) >= SSE_MAX_SUSCRIPTORES)
+
+    def desuscribir(self, colegio, sus):
+        with self._lock:
+            suscriptores = self._suscriptores.get(colegio)
+            if suscriptores is not None:
+                suscriptores.discard(sus)
+                if not suscriptores:
+                    del self._suscriptores[colegio]
+
+    def avisar(self):
+        """Llamar después de confirmar marcaciones en este worker."""
+        if self._pid == os.getpid():
+            self._despertar.set()
+
+    def _loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            with self._lock:
+                hay = bool(self._suscriptores)
+            self._despertar.wait(self.poll_s if hay else None)
+            self._despertar.clear()
+            try:
+                self._revisar()
+            except Exception as e:
+                print("Aviso feed marcaciones:", e)
+
+    def _revisar(self):
+        with self._lock:
+            colegios = list(self._suscriptores)
+        rutas = set()
+        for colegio in colegios:
+            shard = shard_de(colegio)
+            rutas.add(shard[1] if shard else DB_FILE)
+        for ruta in list(self._vistas):
+            if ruta not in rutas:
+                self._vistas.pop(ruta)[0].close()
+        for ruta in rutas:
+            vista = self._vistas.get(ruta)
+            if vista is None:
+                conn = _abrir_conexion(ruta)
+                ultimo = conn.execute("SELECT IFNULL(MAX(id), 0) FROM asistencia_marcaciones").fetchone()[0]
+                vista = self._vistas[ruta] = [conn, None, ultimo]
+            conn = vista[0]
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == vista[1]:
+                continue
+            vista[1] = version
+            while True:
+                filas = conn.execute(f"""
+                    SELECT {MARCACION_COLUMNAS} FROM asistencia_marcaciones
+                    WHERE id > ? ORDER BY id LIMIT {_SSE_LOTE}
+                """, (vista[2],)).fetchall()
+                if filas:
+                    vista[2] = filas[-1]["id"]
+                    self._repartir(filas)
+                if len(filas) < _SSE_LOTE:
+                    break
+
+    def _repartir(self, filas):
+        with self._lock:
+            for fila in filas:
+                suscriptores = self._suscriptores.get(fila["colegio"])
+                if not suscriptores:
+                    continue
+                evento = (fila["id"], evento_sse(fila))
+                for sus in list(suscriptores):
+                    try:
+                        sus.cola.put_nowait(evento)
+                    except queue.Full:
+                        sus.cortado = True
+                        suscriptores.discard(sus)
+
+    def stats(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {"activo": False}
+            return {
+                "activo": True,
+                "pid": self._pid,
+                "suscriptores": {c: len(s) for c, s in self._suscriptores.items()},
+                "ultimo_id": {ruta: v[2] for ruta, v in self._vistas.items()},
+            }
+
+
+feed_marcaciones = FeedMarcaciones(SSE_POLL_S)
+
+
+@app.route("/asistencia_biometrico/stream/<colegio>", methods=["GET"])
+def stream_marcaciones(colegio):
+    """
+    Server-Sent Events con cada marcación nueva del colegio:
+        id: 1234
+        event: marcacion
+        data: {"id": 1234, "colegio": "...", "usuario_nombre": "...", "tipo": "entrada", ...}
+    Al reconectar, EventSource manda Last-Event-ID (también vale ?desde_id=)
+    y se reenvía lo que faltó. Si faltan más de SSE_REANUDAR_MAX se manda un
+    evento "reinicio" para que el cliente recargue la lista completa.
+    EventSource no puede mandar Authorization: el token va en ?token=.
+    """
+    desde_id = request.headers.get("Last-Event-ID") or request.args.get("desde_id")
+    if desde_id is not None:
+        try:
+            desde_id = int(desde_id)
+        except ValueError:
+            return jsonify({"error": "Last-Event-ID inválido"}), 400
+    if feed_marcaciones.lleno():
+        return jsonify({"error": "demasiadas conexiones en vivo, reintente"}), 503, {"Retry-After": "5"}
+
+    def generar():
+        # suscribir aquí: si la respuesta nunca se recorre, no queda un suscriptor colgado
+        sus = feed_marcaciones.suscribir(colegio)
+        if sus is None:
+            yield "retry: 5000\n\n"
+            return
+        try:
+            yield "retry: 3000\n\n"
+            enviado = 0
+            if desde_id is not None:
+                # suscrito antes de leer: lo que llegue mientras tanto queda en la cola
+                enviado = desde_id
+                conn = get_conn(colegio)
+                try:
+                    for _ in range(0, SSE_REANUDAR_MAX, _SSE_LOTE):
+                        filas = conn.execute(f"""
+                            SELECT {MARCACION_COLUMNAS} FROM asistencia_marcaciones
+                            WHERE id > ? AND +colegio = ? ORDER BY id LIMIT {_SSE_LOTE}
+                        """, (enviado, colegio)).fetchall()
+                        for fila in filas:
+                            yield evento_sse(fila)
+                        if filas:
+                            enviado = filas[-1]["id"]
+                        if len(filas) < _SSE_LOTE:
+                            break
+                    else:
+                        yield "event: reinicio\ndata: {}\n\n"
+                        enviado = 0
+                finally:
+                    conn.close()
+            limite = time.monotonic() + SSE_MAX_S
+            while time.monotonic() < limite:
+                try:
+                    marcacion_id, texto = sus.cola.get(timeout=SSE_PING_S)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if marcacion_id > enviado:
+                    yield texto
+                    enviado = marcacion_id
+                if sus.cortado and sus.cola.empty():
+                    break
+        finally:
+            feed_marcaciones.desuscribir(colegio, sus)
+
+    resp = Response(stream_with_context(generar()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
 # =============== ASISTENCIA BIOMÉTRICA: ENDPOINTS GENERALES ===============
 @app.route("/asistencia_marcacion", methods=["POST"])
 def registrar_marcacion():
@@ -827,7 +4377,12 @@ def registrar_marcacion():
       "tipo": "entrada" | "salida"
     }
     """
-    data = request.get_json() or {}
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "se esperaba un objeto JSON"}), 400
+    campo = _campo_mal_tipado(data)
+    if campo:
+        return jsonify({"error": f"{campo} inválido"}), 400
     colegio = data.get("colegio")
     tipo = (data.get("tipo") or "").lower()
     usuario_id = data.get("usuario_id")
@@ -839,22 +4394,11 @@ def registrar_marcacion():
 
     conn = get_conn()
     c = conn.cursor()
-    c.execute("""
-        INSERT INTO asistencia_marcaciones (colegio, usuario_id, usuario_nombre, email, tipo)
-        VALUES (?, ?, ?, ?, ?)
-    """, (colegio, usuario_id, usuario_nombre, email, tipo))
+    item = _insertar_marcaciones(c, [(colegio, usuario_id, usuario_nombre, email, tipo, None)])[0]
     conn.commit()
-
-    marc_id = c.lastrowid
-    c.execute("""
-        SELECT id, colegio, usuario_id, usuario_nombre, email, tipo, timestamp
-        FROM asistencia_marcaciones
-        WHERE id=?
-    """, (marc_id,))
-    row = c.fetchone()
     conn.close()
+    feed_marcaciones.avisar()
 
-    item = dict(row)
     return jsonify({"mensaje": "marcacion registrada", "item": item}), 200
 
 
@@ -873,23 +4417,16 @@ def resumen_marcaciones(colegio):
     params = [colegio]
     filtro = ""
     if desde:
-        filtro += " AND date(timestamp) >= date(?)"
+        filtro += " AND fecha >= date(?)"
         params.append(desde)
     if hasta:
-        filtro += " AND date(timestamp) <= date(?)"
+        filtro += " AND fecha <= date(?)"
         params.append(hasta)
 
     c.execute(f"""
-        SELECT
-          date(timestamp) AS fecha,
-          usuario_nombre,
-          email,
-          SUM(CASE WHEN tipo='entrada' THEN 1 ELSE 0 END) AS entradas,
-          SUM(CASE WHEN tipo='salida' THEN 1 ELSE 0 END) AS salidas,
-          COUNT(*) AS total
-        FROM asistencia_marcaciones
+        SELECT fecha, usuario_nombre, email, entradas, salidas, total
+        FROM asistencia_resumen_diario
         WHERE colegio=? {filtro}
-        GROUP BY fecha, usuario_nombre, email
         ORDER BY fecha DESC, usuario_nombre
     """, params)
 
@@ -906,28 +4443,28 @@ def biometrico_buscar_usuarios(colegio):
     GET /asistencia_marcaciones/buscar_usuarios/LAS%20ROSAS?q=pedro
     Devuelve: { items: [ {usuario_nombre, email, total} ] }
     """
-    q = (request.args.get("q") or "").strip().lower()
+    q = normalizar_texto(request.args.get("q"))
 
     conn = get_conn()
     c = conn.cursor()
 
-    params = [colegio]
-    filtro = "WHERE colegio = ?"
     if q:
-        filtro += " AND (LOWER(usuario_nombre) LIKE ? OR LOWER(email) LIKE ?)"
-        like_pat = f"%{q}%"
-        params.extend([like_pat, like_pat])
-
-    c.execute(f"""
-        SELECT usuario_nombre,
-               email,
-               COUNT(*) AS total
-        FROM asistencia_marcaciones
-        {filtro}
-        GROUP BY usuario_nombre, email
-        ORDER BY usuario_nombre
-        LIMIT 100
-    """, params)
+        # coincidencias por prefijo primero, luego por subcadena
+        c.execute("""
+            SELECT usuario_nombre, email, total
+            FROM asistencia_personas
+            WHERE colegio = ? AND (instr(nombre_norm, ?) > 0 OR instr(email_norm, ?) > 0)
+            ORDER BY (instr(nombre_norm, ?) = 1 OR instr(email_norm, ?) = 1) DESC, usuario_nombre
+            LIMIT 100
+        """, (colegio, q, q, q, q))
+    else:
+        c.execute("""
+            SELECT usuario_nombre, email, total
+            FROM asistencia_personas
+            WHERE colegio = ?
+            ORDER BY usuario_nombre
+            LIMIT 100
+        """, (colegio,))
 
     items = [dict(row) for row in c.fetchall()]
     conn.close()
@@ -958,25 +4495,26 @@ def biometrico_detalle_usuario(colegio):
         where.append("m.email = ?")
         params.append(email)
     if desde:
-        where.append("date(m.timestamp) >= date(?)")
+        where.append("m.timestamp >= date(?)")
         params.append(desde)
     if hasta:
-        where.append("date(m.timestamp) <= date(?)")
+        where.append("m.timestamp < date(?, '+1 day')")
         params.append(hasta)
 
     where_sql = " AND ".join(where)
+    esquemas = adjuntar_archivos(conn, anios_consultados(c, desde, hasta))
 
-    c.execute(f"""
+    fuente = union_archivos(esquemas, f"""
         SELECT
           m.id,
           m.usuario_nombre,
           m.email,
           m.tipo,
           m.timestamp
-        FROM asistencia_marcaciones m
+        FROM {{t}}.asistencia_marcaciones m
         WHERE {where_sql}
-        ORDER BY m.timestamp
-    """, params)
+    """)
+    c.execute(f"SELECT * FROM ({fuente}) ORDER BY timestamp", params * len(esquemas))
 
     items = [dict(row) for row in c.fetchall()]
     conn.close()
@@ -996,69 +4534,215 @@ def marcar_biometrico():
       "tipo": "entrada" | "salida"
     }
     """
-    data = request.get_json() or {}
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "se esperaba un objeto JSON"}), 400
+    # se valida antes de encolar: un 202 no puede quedar luego sin guardar
+    campo = _campo_mal_tipado(data)
+    if campo:
+        return jsonify({"error": f"{campo} inválido"}), 400
     colegio = data.get("colegio")
     usuario_nombre = data.get("usuario_nombre")
-    email = data.get("email", "")
+    email = data.get("email") or ""
     tipo = (data.get("tipo") or "").lower()
 
     if not colegio or not usuario_nombre or tipo not in ("entrada", "salida"):
         return jsonify({"error": "datos inválidos"}), 400
 
+    if MARCAR_MODO_COLA:
+        # la hora se fija al recibirla, no cuando el escritor la guarda
+        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if not cola_marcaciones.encolar((colegio, None, usuario_nombre, email, tipo, ts)):
+            return jsonify({"error": "servidor ocupado, reintente"}), 503, {"Retry-After": "1"}
+        return jsonify({
+            "mensaje": "marcacion encolada",
+            "item": {
+                "colegio": colegio,
+                "usuario_id": None,
+                "usuario_nombre": usuario_nombre,
+                "email": email,
+                "tipo": tipo,
+                "timestamp": ts,
+            }
+        }), 202
+
     conn = get_conn()
     c = conn.cursor()
-    c.execute("""
-        INSERT INTO asistencia_marcaciones (colegio, usuario_id, usuario_nombre, email, tipo)
-        VALUES (?, NULL, ?, ?, ?)
-    """, (colegio, usuario_nombre, email, tipo))
-    marc_id = c.lastrowid
+    item = _insertar_marcaciones(c, [(colegio, None, usuario_nombre, email, tipo, None)])[0]
     conn.commit()
-
-    c.execute("""
-        SELECT id, colegio, usuario_id, usuario_nombre, email, tipo, timestamp
-        FROM asistencia_marcaciones
-        WHERE id=?
-    """, (marc_id,))
-    row = c.fetchone()
     conn.close()
+    feed_marcaciones.avisar()
 
     return jsonify({
         "mensaje": "marcacion registrada",
-        "item": dict(row)
+        "item": item
+    }), 200
+
+
+@app.route("/asistencia_biometrico/marcar_lote", methods=["POST"])
+def marcar_biometrico_lote():
+    """
+    Lote de marcaciones (p.ej. las que la puerta guardó sin conexión).
+    Body:
+    {
+      "marcaciones": [
+        {"colegio": "...", "usuario_nombre": "...", "email": "...",
+         "tipo": "entrada" | "salida", "timestamp": "2025-11-15 07:02:10"},
+        ...
+      ]
+    }
+    "timestamp" es opcional (si falta se usa la hora del servidor).
+    Todo el lote se guarda en una sola transacción (una por shard con
+    DB_SHARDS=1); los ítems inválidos
+    se informan en "errores" con su índice y no frenan al resto.
+    """
+    data = request.get_json(silent=True)
+    marcaciones = data.get("marcaciones") if isinstance(data, dict) else data
+    if not isinstance(marcaciones, list):
+        return jsonify({"error": "se esperaba una lista de marcaciones"}), 400
+    if len(marcaciones) > MARCAR_LOTE_MAX:
+        return jsonify({"error": f"máximo {MARCAR_LOTE_MAX} marcaciones por lote"}), 400
+
+    filas = []
+    indices = []
+    errores = []
+    for i, m in enumerate(marcaciones):
+        fila, error = _validar_marcacion(m)
+        if error:
+            errores.append({"indice": i, "error": error})
+        else:
+            filas.append(fila)
+            indices.append(i)
+
+    items = []
+    if filas:
+        guardadas = guardar_marcaciones(filas)
+        for i, item in zip(indices, guardadas):
+            items.append({"indice": i, "item": item})
+
+    return jsonify({
+        "mensaje": "lote procesado",
+        "insertados": len(items),
+        "items": items,
+        "errores": errores,
     }), 200
 
 
+LIBRO_LIMIT_MAX = int(os.environ.get("LIBRO_LIMIT_MAX", "5000"))
+
+
 @app.route("/asistencia_biometrico/registros/<colegio>", methods=["GET"])
 def listar_marcaciones(colegio):
     """
     Devuelve el 'libro' de marcaciones del biométrico para un colegio.
     /asistencia_biometrico/registros/LAS%20ROSAS?desde=2025-01-01&hasta=2025-12-31
+    Paginación opcional: ?limit=500 devuelve "next" ("timestamp|id" de la
+    última fila) y ?after=<next> pide la página siguiente.
+    Sin ?desde= los años ya archivados solo entran desde el año de ?hasta=
+    (o el actual).
+    Con "Accept: application/x-ndjson" las filas se envían en streaming,
+    una por línea.
     """
     desde = request.args.get("desde")
     hasta = request.args.get("hasta")
-
-    conn = get_conn()
-    c = conn.cursor()
+    after = request.args.get("after")
+    limit = request.args.get("limit", type=int)
 
     params = [colegio]
     filtro = ""
     if desde:
-        filtro += " AND datetime(timestamp) >= datetime(?)"
+        filtro += " AND timestamp >= datetime(?)"
         params.append(desde)
     if hasta:
-        filtro += " AND datetime(timestamp) <= datetime(?)"
+        filtro += " AND timestamp <= datetime(?)"
         params.append(hasta)
+    if after:
+        try:
+            after_ts, after_id = after.rsplit("|", 1)
+            params.extend([after_ts, int(after_id)])
+        except ValueError:
+            return jsonify({"error": "cursor 'after' inválido"}), 400
+        # keyset sobre (timestamp, id) en orden descendente
+        filtro += " AND (timestamp, id) < (?, ?)"
 
-    c.execute(f"""
-        SELECT id, colegio, usuario_id, usuario_nombre, email, tipo, timestamp
-        FROM asistencia_marcaciones
+    conn = get_conn()
+    # con cursor, las páginas siguientes no pasan de after_ts
+    tope = hasta
+    if after and (not tope or after_ts < tope):
+        tope = after_ts
+    esquemas = adjuntar_archivos(conn, anios_consultados(conn, desde, tope))
+    params = params * len(esquemas)
+    limite = ""
+    if limit is not None:
+        limit = max(1, min(limit, LIBRO_LIMIT_MAX))
+        limite = "LIMIT ?"
+        params.append(limit)
+
+    fuente = union_archivos(esquemas, f"""
+        SELECT {MARCACION_COLUMNAS}
+        FROM {{t}}.asistencia_marcaciones
         WHERE colegio=? {filtro}
+    """)
+    sql = f"""
+        SELECT {MARCACION_COLUMNAS}
+        FROM ({fuente})
         ORDER BY timestamp DESC, id DESC
-    """, params)
+        {limite}
+    """
+
+    if request.accept_mimetypes.best == "application/x-ndjson":
+        def generar():
+            for rows in iterar_consulta(sql, params, conn=conn):
+                yield "".join(json.dumps(dict(r)) + "\n" for r in rows)
+        return Response(stream_with_context(generar()), mimetype="application/x-ndjson")
 
+    c = conn.cursor()
+    c.execute(sql, params)
     items = [dict(row) for row in c.fetchall()]
     conn.close()
-    return jsonify({"items": items}), 200
+
+    if limit is None:
+        return jsonify({"items": items}), 200
+    siguiente = None
+    if len(items) == limit:
+        siguiente = f"{items[-1]['timestamp']}|{items[-1]['id']}"
+    return jsonify({"items": items, "next": siguiente}), 200
+
+
+@app.route("/asistencia_biometrico/export/<colegio>.csv", methods=["GET"])
+def exportar_marcaciones_csv(colegio):
+    """
+    Exporta las marcaciones de un colegio en CSV, en streaming y en orden
+    cronológico. Mismos filtros que el libro: ?desde=...&hasta=...
+    """
+    desde = request.args.get("desde")
+    hasta = request.args.get("hasta")
+
+    params = [colegio]
+    filtro = ""
+    if desde:
+        filtro += " AND timestamp >= datetime(?)"
+        params.append(desde)
+    if hasta:
+        filtro += " AND timestamp <= datetime(?)"
+        params.append(hasta)
+
+    conn = get_conn()
+    esquemas = adjuntar_archivos(conn, anios_consultados(conn, desde, hasta))
+    fuente = union_archivos(esquemas, f"""
+        SELECT {MARCACION_COLUMNAS}
+        FROM {{t}}.asistencia_marcaciones
+        WHERE colegio=? {filtro}
+    """)
+    sql = f"SELECT {MARCACION_COLUMNAS} FROM ({fuente}) ORDER BY timestamp, id"
+
+    def generar():
+        w = csv.writer(_EcoCSV())
+        yield w.writerow(["id", "colegio", "usuario_id", "usuario_nombre", "email", "tipo", "timestamp"])
+        for rows in iterar_consulta(sql, params * len(esquemas), conn=conn):
+            yield "".join(w.writerow(tuple(r)) for r in rows)
+
+    return respuesta_csv(generar(), f"marcaciones_{colegio}.csv")
 
 
 # =============== ASISTENCIA BIOMÉTRICA: RESUMEN FECHA A FECHA ===============
@@ -1076,23 +4760,23 @@ def biometrico_fecha_a_fecha(colegio):
     params = [colegio]
     filtro = ""
     if desde:
-        filtro += " AND date(timestamp) >= date(?)"
+        filtro += " AND fecha >= date(?)"
         params.append(desde)
     if hasta:
-        filtro += " AND date(timestamp) <= date(?)"
+        filtro += " AND fecha <= date(?)"
         params.append(hasta)
 
-    # Agrupamos por usuario y fecha
+    # Agrupamos por usuario y fecha (sobre el resumen diario)
     c.execute(f"""
         SELECT
           usuario_nombre,
           IFNULL(email, '') AS email,
-          date(timestamp) AS fecha,
-          SUM(CASE WHEN tipo='entrada' THEN 1 ELSE 0 END) AS entradas,
-          SUM(CASE WHEN tipo='salida' THEN 1 ELSE 0 END) AS salidas
-        FROM asistencia_marcaciones
+          fecha,
+          SUM(entradas) AS entradas,
+          SUM(salidas) AS salidas
+        FROM asistencia_resumen_diario
         WHERE colegio=? {filtro}
-        GROUP BY usuario_nombre, email, date(timestamp)
+        GROUP BY usuario_nombre, email, fecha
         ORDER BY usuario_nombre, fecha
     """, params)
 
@@ -1123,8 +4807,241 @@ def biometrico_fecha_a_fecha(colegio):
     return jsonify({"items": items}), 200
 
 
+# =============== ARCHIVO ANUAL DE ASISTENCIA ===============
+# flask archivar-asistencia pasa las marcaciones y respuestas QR anteriores al
+# corte a archivo/<base>-<año>.db, en lotes cortos, con la app funcionando.
+# El resumen diario y el buscador de personas no se tocan; el libro, el detalle,
+# los exportes y los informes QR adjuntan (ATTACH) los años archivados solo
+# cuando el rango pedido llega a ellos; sin "desde" solo se adjuntan los años
+# a partir del de "hasta" (o del actual). Cada lote se copia primero al
+# archivo (synchronous=FULL, commit propio) y recién después se borra de la base.
+ARCHIVO_DIR = os.environ.get("ARCHIVO_DIR", os.path.join(BASE_DIR, "archivo"))
+ARCHIVO_LOTE = int(os.environ.get("ARCHIVO_LOTE", "2000"))
+ARCHIVO_PAUSA_MS = int(os.environ.get("ARCHIVO_PAUSA_MS", "50"))
+TABLAS_ARCHIVO = ("asistencia_marcaciones", "asistencia_registros", "asistencia_registro_campos")
+
+
+def _anio(fecha):
+    texto = str(fecha or "")[:4]
+    return int(texto) if texto.isdigit() else None
+
+
+def anios_archivados(c, desde=None, hasta=None):
+    """[(anio, archivo)] de los años archivados que se cruzan con [desde, hasta]."""
+    d, h = _anio(desde), _anio(hasta)
+    return [
+        (r["anio"], r["archivo"])
+        for r in c.execute("SELECT anio, archivo FROM asistencia_archivos ORDER BY anio")
+        if (d is None or r["anio"] >= d) and (h is None or r["anio"] <= h)
+    ]
+
+
+def anios_consultados(c, desde, hasta):
+    """
+    Años archivados para una consulta de la API. Sin desde no se adjunta todo
+    el historial, solo desde el año de hasta (o el actual): los años
+    anteriores se piden con desde.
+    """
+    return anios_archivados(c, desde or str(_anio(hasta) or datetime.now().year), hasta)
+
+
+def anios_archivados_qr(c, qr_ids):
+    """Años archivados que tienen respuestas de esos formularios."""
+    return [(r["anio"], r["archivo"]) for r in c.execute(f"""
+        SELECT DISTINCT a.anio, a.archivo
+        FROM asistencia_qr_archivo q JOIN asistencia_archivos a ON a.anio = q.anio
+        WHERE q.qr_id IN ({", ".join("?" * len(qr_ids))})
+        ORDER BY a.anio
+    """, list(qr_ids))]
+
+
+def adjuntar_archivos(conn, anios):
+    """
+    ATTACH de cada año como arch_<año>. Devuelve los esquemas a consultar,
+    empezando por "main". Se sueltan solos al devolver la conexión.
+    """
+    esquemas = ["main"]
+    for anio, archivo in anios:
+        esquema = f"arch_{anio}"
+        ruta = os.path.join(ARCHIVO_DIR, archivo)
+        if esquema not in conn._adjuntos and os.path.exists(ruta):
+            conn.execute(f"ATTACH DATABASE ? AS {esquema}", (ruta,))
+            conn._adjuntos.append(esquema)
+        if esquema in conn._adjuntos:
+            esquemas.append(esquema)
+    return esquemas
+
+
+def union_archivos(esquemas, consulta):
+    """
+    Repite `consulta` (con {t} en lugar del esquema) por cada base y las une
+    con UNION ALL. Los parámetros se repiten len(esquemas) veces.
+    """
+    return "\nUNION ALL\n".join(consulta.replace("{t}", e) for e in esquemas)
+
+
+def _preparar_archivo(conn, base, anio):
+    """Adjunta (creándolo si hace falta) el archivo del año y lo registra."""
+    archivo = f"{base}-{anio}.db"
+    esquema = f"arch_{anio}"
+    if esquema not in conn._adjuntos:
+        os.makedirs(ARCHIVO_DIR, exist_ok=True)
+        conn.execute(f"ATTACH DATABASE ? AS {esquema}", (os.path.join(ARCHIVO_DIR, archivo),))
+        conn._adjuntos.append(esquema)
+        conn.execute(f"PRAGMA {esquema}.journal_mode=WAL")
+        # cada commit del archivo llega al disco antes de borrar de la base
+        conn.execute(f"PRAGMA {esquema}.synchronous=FULL")
+        # mismas tablas e índices que la base (sin triggers)
+        for row in conn.execute(f"""
+            SELECT type, name, sql FROM main.sqlite_master
+            WHERE tbl_name IN ({", ".join("?" * len(TABLAS_ARCHIVO))})
+              AND type IN ('table', 'index') AND sql IS NOT NULL
+            ORDER BY type DESC
+        """, TABLAS_ARCHIVO).fetchall():
+            prefijo = f"CREATE {row['type'].upper()} {row['name']}"
+            if row["sql"].startswith(prefijo):
+                conn.execute(f"CREATE {row['type'].upper()} IF NOT EXISTS {esquema}.{row['name']}"
+                             + row["sql"][len(prefijo):])
+        conn.execute("INSERT OR IGNORE INTO asistencia_archivos (anio, archivo) VALUES (?, ?)",
+                     (anio, archivo))
+        conn.commit()
+    return esquema
+
+
+def _columnas(conn, tabla):
+    return ", ".join(r["name"] for r in conn.execute(f"PRAGMA main.table_info({tabla})"))
+
+
+def archivar_asistencia(conn, corte, lote=ARCHIVO_LOTE):
+    """
+    Mueve a los archivos anuales las marcaciones (timestamp) y respuestas QR
+    (creado_en) anteriores a `corte`. Cada lote son dos transacciones cortas:
+    la copia al archivo y, ya confirmada, el borrado en la base (con WAL una
+    transacción entre bases adjuntas no es atómica). Si se corta en el medio,
+    la próxima corrida repite la copia (INSERT OR IGNORE) y borra.
+    Devuelve (marcaciones, respuestas) movidas.
+    """
+    c = conn.cursor()
+    base = os.path.splitext(os.path.basename(c.execute("PRAGMA database_list").fetchone()["file"]))[0]
+    pausa = ARCHIVO_PAUSA_MS / 1000.0
+    cols_m = _columnas(conn, "asistencia_marcaciones")
+    cols_r = _columnas(conn, "asistencia_registros")
+    cols_c = _columnas(conn, "asistencia_registro_campos")
+
+    def por_anio(rows):
+        grupos = {}
+        for r in rows:
+            grupos.setdefault(_anio(r[1]), []).append(r[0])
+        return grupos
+
+    marcaciones = 0
+    colegios = [r[0] for r in c.execute("""
+        SELECT DISTINCT colegio FROM asistencia_resumen_diario WHERE fecha < ?
+    """, (corte,)).fetchall()]
+    for colegio in colegios:
+        while True:
+            rows = c.execute("""
+                SELECT id, timestamp FROM asistencia_marcaciones
+                WHERE colegio IS ? AND timestamp < ?
+                ORDER BY timestamp LIMIT ?
+            """, (colegio, corte, lote)).fetchall()
+            if not rows:
+                break
+            grupos = por_anio(rows)
+            esquemas = {anio: _preparar_archivo(conn, base, anio) for anio in grupos}
+            c.execute("BEGIN")
+            for anio, ids in grupos.items():
+                c.execute(f"""
+                    INSERT OR IGNORE INTO {esquemas[anio]}.asistencia_marcaciones ({cols_m})
+                    SELECT {cols_m} FROM main.asistencia_marcaciones
+                    WHERE id IN (SELECT value FROM json_each(?))
+                """, (json.dumps(ids),))
+            conn.commit()
+            c.execute("BEGIN IMMEDIATE")
+            for anio, ids in grupos.items():
+                c.executemany("INSERT INTO marcaciones_archivando (id) VALUES (?)", [(i,) for i in ids])
+                # el trigger del resumen ignora estos ids: el resumen queda completo
+                c.execute(f"""
+                    DELETE FROM main.asistencia_marcaciones
+                    WHERE id IN (SELECT id FROM marcaciones_archivando)
+                      AND id IN (SELECT id FROM {esquemas[anio]}.asistencia_marcaciones)
+                """)
+                c.execute("DELETE FROM marcaciones_archivando")
+            conn.commit()
+            marcaciones += len(rows)
+            time.sleep(pausa)
+
+    respuestas = 0
+    qr_ids = [r[0] for r in c.execute("SELECT DISTINCT qr_id FROM asistencia_registros").fetchall()]
+    for qr_id in qr_ids:
+        while True:
+            rows = c.execute("""
+                SELECT id, creado_en FROM asistencia_registros
+                WHERE qr_id = ? AND creado_en < ?
+                ORDER BY creado_en LIMIT ?
+            """, (qr_id, corte, lote)).fetchall()
+            if not rows:
+                break
+            grupos = por_anio(rows)
+            esquemas = {anio: _preparar_archivo(conn, base, anio) for anio in grupos}
+            c.execute("BEGIN")
+            for anio, ids in grupos.items():
+                esquema, ids_json = esquemas[anio], json.dumps(ids)
+                c.execute(f"""
+                    INSERT OR IGNORE INTO {esquema}.asistencia_registros ({cols_r})
+                    SELECT {cols_r} FROM main.asistencia_registros
+                    WHERE id IN (SELECT value FROM json_each(?))
+                """, (ids_json,))
+                # por si un intento anterior se cortó entre el archivo y la base
+                c.execute(f"""
+                    DELETE FROM {esquema}.asistencia_registro_campos
+                    WHERE registro_id IN (SELECT value FROM json_each(?))
+                """, (ids_json,))
+                c.execute(f"""
+                    INSERT INTO {esquema}.asistencia_registro_campos ({cols_c})
+                    SELECT {cols_c} FROM main.asistencia_registro_campos
+                    WHERE registro_id IN (SELECT value FROM json_each(?))
+                """, (ids_json,))
+            conn.commit()
+            c.execute("BEGIN IMMEDIATE")
+            for anio, ids in grupos.items():
+                esquema, ids_json = esquemas[anio], json.dumps(ids)
+                c.execute("INSERT OR IGNORE INTO asistencia_qr_archivo (qr_id, anio) VALUES (?, ?)",
+                          (qr_id, anio))
+                c.execute(f"""
+                    DELETE FROM main.asistencia_registros
+                    WHERE id IN (SELECT value FROM json_each(?))
+                      AND id IN (SELECT id FROM {esquema}.asistencia_registros)
+                """, (ids_json,))
+            conn.commit()
+            respuestas += len(rows)
+            time.sleep(pausa)
+    return marcaciones, respuestas
+
+
+@app.cli.command("archivar-asistencia")
+@click.option("--antes", help="fecha de corte YYYY-MM-DD (por defecto, 1 de enero de este año)")
+def archivar_asistencia_cmd(antes):
+    """
+    Pasa la asistencia anterior al corte a los archivos anuales.
+    flask --app app archivar-asistencia --antes 2025-01-01
+    """
+    corte = antes or f"{datetime.now().year}-01-01"
+    try:
+        datetime.strptime(corte, "%Y-%m-%d")
+    except ValueError:
+        raise click.BadParameter("use YYYY-MM-DD", param_hint="--antes")
+    for colegio, conn in iterar_shards():
+        inicio = time.perf_counter()
+        marcaciones, respuestas = archivar_asistencia(conn, corte)
+        conn.close()
+        print(f"  {colegio or 'base central'}: {marcaciones} marcaciones, {respuestas} respuestas QR "
+              f"archivadas ({time.perf_counter() - inicio:.1f}s)")
+
+
 # =============== CURSOS / ESTUDIANTES / PROFESORES ===============
 @app.route("/cursos/<colegio>", methods=["GET"])
+@cache_catalogo("cursos")
 def listar_cursos(colegio):
     conn = get_conn()
     c = conn.cursor()
@@ -1154,6 +5071,8 @@ def crear_curso():
         INSERT OR IGNORE INTO cursos (colegio, nombre, nivel, turno)
         VALUES (?, ?, ?, ?)
     """, (colegio, nombre, nivel, turno))
+    if c.rowcount:
+        invalidar_catalogo(c, "cursos", colegio)
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "curso creado"}), 200
@@ -1164,32 +5083,87 @@ def eliminar_curso(curso_id):
     conn = get_conn()
     c = conn.cursor()
     c.execute("DELETE FROM estudiantes WHERE curso_id=?", (curso_id,))
-    c.execute("DELETE FROM cursos WHERE id=?", (curso_id,))
+    c.execute("DELETE FROM cursos WHERE id=? RETURNING colegio", (curso_id,))
+    for row in c.fetchall():
+        invalidar_catalogo(c, "cursos", row["colegio"])
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "curso eliminado"}), 200
 
 
+# --- listados con ?fields= (proyección en el SQL) y ?formato=columnas ---
+# campos calculados que se pueden pedir además de las columnas de la tabla
+CAMPOS_VIRTUALES = {
+    "estudiantes": {"curso": "(SELECT nombre FROM cursos WHERE cursos.id = estudiantes.curso_id)"},
+    "profesores": {},
+}
+
+
+def proyeccion(tabla, columnas):
+    """
+    ?fields=id,nombre,curso -> "id, nombre, (SELECT ...) AS curso" para el
+    SELECT. Sin fields, "*". ValueError si piden un campo que no existe.
+    """
+    fields = request.args.get("fields")
+    if not fields:
+        return "*"
+    virtuales = CAMPOS_VIRTUALES[tabla]
+    pedidos = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    desconocidos = [f for f in pedidos if f not in columnas and f not in virtuales]
+    if not pedidos or desconocidos:
+        raise ValueError(f"campos inválidos: {', '.join(desconocidos)}; válidos: "
+                         f"{', '.join(list(columnas) + list(virtuales))}")
+    return ", ".join(f"{virtuales[f]} AS {f}" if f in virtuales else f for f in pedidos)
+
+
+def respuesta_listado(clave, c, convertir=None):
+    """
+    Filas del cursor como lista de objetos, o con ?formato=columnas como
+    {"columns": [...], "rows": [[...], ...]} (sin repetir las claves).
+    convertir: {columna: función} que se aplica al valor (p.ej. JSON guardado como texto).
+    """
+    columnas = [d[0] for d in c.description]
+    filas = c.fetchall()
+    if convertir:
+        indices = [(i, convertir[col]) for i, col in enumerate(columnas) if col in convertir]
+        if indices:
+            filas = [list(f) for f in filas]
+            for fila in filas:
+                for i, funcion in indices:
+                    fila[i] = funcion(fila[i])
+    if request.args.get("formato") == "columnas":
+        return jsonify({"columns": columnas, "rows": [list(f) for f in filas]})
+    return jsonify({clave: [dict(zip(columnas, f)) for f in filas]})
+
+
 @app.route("/estudiantes/<colegio>", methods=["GET"])
 def listar_estudiantes(colegio):
+    """
+    Opcional: ?curso_id=, ?fields=id,nombre,curso (columnas de estudiantes y
+    "curso", el nombre del curso), ?formato=columnas.
+    """
     curso_id = request.args.get("curso_id")
+    try:
+        campos = proyeccion("estudiantes", ["id"] + ESTUDIANTE_COLUMNAS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     conn = get_conn()
     c = conn.cursor()
     if curso_id:
-        c.execute("""
-            SELECT * FROM estudiantes
+        c.execute(f"""
+            SELECT {campos} FROM estudiantes
             WHERE colegio=? AND curso_id=?
             ORDER BY nombre
         """, (colegio, curso_id))
     else:
-        c.execute("""
-            SELECT * FROM estudiantes
+        c.execute(f"""
+            SELECT {campos} FROM estudiantes
             WHERE colegio=?
             ORDER BY nombre
         """, (colegio,))
-    ests = [dict(row) for row in c.fetchall()]
+    resp = respuesta_listado("estudiantes", c)
     conn.close()
-    return jsonify({"estudiantes": ests})
+    return resp
 
 
 @app.route("/estudiantes", methods=["POST"])
@@ -1273,7 +5247,279 @@ def eliminar_estudiante(est_id):
     return jsonify({"mensaje": "estudiante eliminado"}), 200
 
 
+# --- importación masiva (CSV o JSON lines) ---
+ESTUDIANTE_COLUMNAS = [
+    "colegio", "curso_id", "nombre", "rude", "ci", "fecha_nac", "estado",
+    "padre_nombre", "padre_ci", "padre_fecha_nac", "padre_cel",
+    "madre_nombre", "madre_ci", "madre_fecha_nac", "madre_cel",
+    "tutor_nombre", "tutor_cel",
+]
+IMPORTAR_LOTE = 1000
+IMPORTAR_MAX_ERRORES = 1000
+
+
+class ArchivoInvalido(ValueError):
+    """El archivo importado no se puede seguir leyendo (codificación, CSV roto)."""
+
+    def __init__(self, mensaje, linea):
+        super().__init__(mensaje)
+        self.linea = linea
+
+
+def _lineas_utf8(stream):
+    """Líneas del archivo subido ya decodificadas; ArchivoInvalido con el número de la que no es UTF-8."""
+    for n, crudo in enumerate(stream, start=1):
+        try:
+            yield crudo.decode("utf-8-sig" if n == 1 else "utf-8")
+        except UnicodeDecodeError:
+            raise ArchivoInvalido("el archivo no está en UTF-8", n) from None
+
+
+def _leer_filas_importacion(archivo, formato):
+    """
+    Lee el archivo subido fila por fila sin cargarlo entero.
+    Genera (número de línea, dict) o (número de línea, None) si la línea es inválida.
+    Lanza ArchivoInvalido si no es UTF-8 o el CSV está mal formado.
+    """
+    lineas = _lineas_utf8(archivo.stream)
+    if formato == "jsonl":
+        for n, linea in enumerate(lineas, start=1):
+            if not linea.strip():
+                continue
+            try:
+                fila = json.loads(linea)
+            except ValueError:
+                fila = None
+            yield n, fila if isinstance(fila, dict) else None
+    else:
+        lector = csv.DictReader(lineas)
+        try:
+            for fila in lector:
+                yield lector.line_num, {k.strip(): (v or "").strip() for k, v in fila.items() if k}
+        except csv.Error as e:
+            raise ArchivoInvalido(f"CSV inválido: {e}", lector.reader.line_num) from None
+
+
+def _formato_importacion(archivo):
+    formato = (request.form.get("formato") or "").lower()
+    if formato in ("csv", "jsonl"):
+        return formato
+    nombre = (archivo.filename or "").lower()
+    return "jsonl" if nombre.endswith((".jsonl", ".ndjson")) else "csv"
+
+
+class _CursosImportacion:
+    """Resuelve (colegio, curso, turno) -> curso_id y crea los que falten."""
+
+    def __init__(self, c, crear):
+        self.c = c
+        self.crear = crear
+        self.por_nombre = {}
+        self.ids = {}
+        self.creados = 0
+
+    def _cargar(self, colegio):
+        if colegio not in self.ids:
+            self.ids[colegio] = set()
+            for r in self.c.execute("SELECT id, nombre, turno FROM cursos WHERE colegio=?", (colegio,)):
+                self.ids[colegio].add(r["id"])
+                self.por_nombre[(colegio, r["nombre"], r["turno"] or "")] = r["id"]
+
+    def existe(self, colegio, curso_id):
+        self._cargar(colegio)
+        return curso_id in self.ids[colegio]
+
+    def obtener(self, colegio, nombre, nivel, turno):
+        self._cargar(colegio)
+        clave = (colegio, nombre, turno)
+        if clave not in self.por_nombre:
+            curso_id = None
+            if self.crear:
+                self.c.execute("""
+                    INSERT INTO cursos (colegio, nombre, nivel, turno) VALUES (?, ?, ?, ?)
+                """, (colegio, nombre, nivel, turno))
+                curso_id = self.c.lastrowid
+                self.ids[colegio].add(curso_id)
+                invalidar_catalogo(self.c, "cursos", colegio)
+            self.por_nombre[clave] = curso_id
+            self.creados += 1
+        return self.por_nombre[clave]
+
+
+@app.route("/estudiantes/importar", methods=["POST"])
+def importar_estudiantes():
+    """
+    Importación masiva de estudiantes (multipart):
+      archivo: CSV con encabezado o JSON lines, mismas columnas que POST /estudiantes.
+               En lugar de curso_id se puede dar curso (+ nivel, turno): si el
+               curso no existe se crea.
+      colegio: colegio por defecto para las filas que no lo traen
+      formato: csv | jsonl (si no, se deduce de la extensión)
+      dry_run: 1 para solo validar, sin guardar nada
+    Todo se inserta en una sola transacción; las filas con errores se informan
+    con su número de línea y no se guardan.
+    """
+    if "archivo" not in request.files:
+        return jsonify({"error": "no se envió archivo"}), 400
+    archivo = request.files["archivo"]
+    colegio_defecto = request.form.get("colegio") or ""
+    dry_run = (request.form.get("dry_run") or request.args.get("dry_run") or "") in ("1", "true", "si")
+    formato = _formato_importacion(archivo)
+
+    inicio = time.perf_counter()
+    conn = get_conn()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    cursos = _CursosImportacion(c, crear=not dry_run)
+    errores = []
+    lote = []
+    filas = 0
+    validas = 0
+
+    def error(linea, mensaje):
+        if len(errores) < IMPORTAR_MAX_ERRORES:
+            errores.append({"linea": linea, "error": mensaje})
+
+    def volcar():
+        if lote and not dry_run:
+            c.executemany(f"""
+                INSERT INTO estudiantes ({", ".join(ESTUDIANTE_COLUMNAS)})
+                VALUES ({", ".join("?" * len(ESTUDIANTE_COLUMNAS))})
+            """, lote)
+        lote.clear()
+
+    try:
+        for linea, fila in _leer_filas_importacion(archivo, formato):
+            filas += 1
+            if fila is None:
+                error(linea, "línea inválida")
+                continue
+            colegio = str(fila.get("colegio") or colegio_defecto).strip()
+            nombre = str(fila.get("nombre") or "").strip()
+            if not colegio or not nombre:
+                error(linea, "faltan colegio o nombre")
+                continue
+            if shard_de(colegio) != shard_de(colegio_defecto):
+                error(linea, "colegio con base propia: importarlo por separado")
+                continue
+
+            curso_id = fila.get("curso_id")
+            if curso_id not in (None, ""):
+                try:
+                    curso_id = int(curso_id)
+                except (TypeError, ValueError):
+                    error(linea, "curso_id inválido")
+                    continue
+                if not cursos.existe(colegio, curso_id):
+                    error(linea, f"curso_id {curso_id} no existe en {colegio}")
+                    continue
+            elif str(fila.get("curso") or "").strip():
+                curso_id = cursos.obtener(
+                    colegio,
+                    str(fila["curso"]).strip(),
+                    str(fila.get("nivel") or "").strip(),
+                    str(fila.get("turno") or "").strip(),
+                )
+            else:
+                error(linea, "falta curso_id o curso")
+                continue
+
+            valores = {k: str(fila.get(k) or "").strip() for k in ESTUDIANTE_COLUMNAS}
+            valores.update(colegio=colegio, curso_id=curso_id, nombre=nombre)
+            lote.append(tuple(valores[k] for k in ESTUDIANTE_COLUMNAS))
+            validas += 1
+            if len(lote) >= IMPORTAR_LOTE:
+                volcar()
+        volcar()
+    except ArchivoInvalido as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({"error": str(e), "linea": e.linea}), 400
+
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    conn.close()
+
+    segundos = time.perf_counter() - inicio
+    return jsonify({
+        "mensaje": "validación terminada" if dry_run else "importación terminada",
+        "dry_run": dry_run,
+        "filas": filas,
+        "insertados": 0 if dry_run else validas,
+        "validos": validas,
+        "cursos_creados": cursos.creados,
+        "errores": errores,
+        "total_errores": filas - validas,
+        "segundos": round(segundos, 3),
+        "filas_por_segundo": round(filas / segundos, 1) if segundos else None,
+    }), 200
+
+
+@app.route("/cursos/importar", methods=["POST"])
+def importar_cursos():
+    """
+    Importación masiva de cursos (multipart, CSV o JSON lines con
+    colegio, nombre, nivel, turno). Los cursos que ya existen se ignoran.
+    Acepta colegio, formato y dry_run igual que /estudiantes/importar.
+    """
+    if "archivo" not in request.files:
+        return jsonify({"error": "no se envió archivo"}), 400
+    archivo = request.files["archivo"]
+    colegio_defecto = request.form.get("colegio") or ""
+    dry_run = (request.form.get("dry_run") or request.args.get("dry_run") or "") in ("1", "true", "si")
+
+    inicio = time.perf_counter()
+    errores = []
+    nuevos = []
+    filas = 0
+    try:
+        for linea, fila in _leer_filas_importacion(archivo, _formato_importacion(archivo)):
+            filas += 1
+            colegio = str((fila or {}).get("colegio") or colegio_defecto).strip()
+            nombre = str((fila or {}).get("nombre") or "").strip()
+            if not colegio or not nombre or shard_de(colegio) != shard_de(colegio_defecto):
+                if len(errores) < IMPORTAR_MAX_ERRORES:
+                    mensaje = ("línea inválida" if fila is None else
+                               "faltan colegio o nombre" if not colegio or not nombre else
+                               "colegio con base propia: importarlo por separado")
+                    errores.append({"linea": linea, "error": mensaje})
+                continue
+            nuevos.append((colegio, nombre, str(fila.get("nivel") or "").strip(),
+                           str(fila.get("turno") or "").strip()))
+    except ArchivoInvalido as e:
+        return jsonify({"error": str(e), "linea": e.linea}), 400
+
+    conn = get_conn()
+    c = conn.cursor()
+    antes = conn.total_changes
+    c.executemany("""
+        INSERT OR IGNORE INTO cursos (colegio, nombre, nivel, turno)
+        VALUES (?, ?, ?, ?)
+    """, nuevos)
+    creados = conn.total_changes - antes
+    for colegio in {n[0] for n in nuevos}:
+        invalidar_catalogo(c, "cursos", colegio)
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    conn.close()
+
+    segundos = time.perf_counter() - inicio
+    return jsonify({
+        "mensaje": "validación terminada" if dry_run else "importación terminada",
+        "dry_run": dry_run,
+        "filas": filas,
+        "cursos_creados": creados,
+        "errores": errores,
+        "segundos": round(segundos, 3),
+    }), 200
+
+
 @app.route("/comisiones/<colegio>", methods=["GET"])
+@cache_catalogo("comisiones")
 def listar_comisiones(colegio):
     conn = get_conn()
     c = conn.cursor()
@@ -1299,6 +5545,8 @@ def crear_comision():
         INSERT OR IGNORE INTO comisiones (colegio, nombre)
         VALUES (?, ?)
     """, (colegio, nombre))
+    if c.rowcount:
+        invalidar_catalogo(c, "comisiones", colegio)
     conn.commit()
     conn.close()
     return jsonify({"mensaje": "comision creada"}), 200
@@ -1314,6 +5562,7 @@ def eliminar_comision(com_id):
         colegio, nombre = row["colegio"], row["nombre"]
         c.execute("UPDATE profesores SET comision='' WHERE colegio=? AND comision=?", (colegio, nombre))
         c.execute("DELETE FROM comisiones WHERE id=?", (com_id,))
+        invalidar_catalogo(c, "comisiones", colegio)
         conn.commit()
         conn.close()
         return jsonify({"mensaje": "comision eliminada"}), 200
@@ -1321,38 +5570,55 @@ def eliminar_comision(com_id):
     return jsonify({"error": "comision no encontrada"}), 404
 
 
+PROFESOR_COLUMNAS = [
+    "id", "colegio", "nombre", "carnet", "cargo", "fecha_nac", "cel1", "cel2", "cel_extra",
+    "asesor_curso", "comision", "clases", "extra_campos",
+]
+
+
 @app.route("/profesores/<colegio>", methods=["GET"])
 def listar_profesores(colegio):
+    """Opcional: ?comision= (o __none), ?fields=id,nombre,cargo, ?formato=columnas."""
     com = request.args.get("comision")
+    try:
+        campos = proyeccion("profesores", PROFESOR_COLUMNAS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     conn = get_conn()
     c = conn.cursor()
     if com is None:
-        c.execute("""
-            SELECT * FROM profesores
+        c.execute(f"""
+            SELECT {campos} FROM profesores
             WHERE colegio=? ORDER BY nombre
         """, (colegio,))
     elif com == "__none":
-        c.execute("""
-            SELECT * FROM profesores
+        c.execute(f"""
+            SELECT {campos} FROM profesores
             WHERE colegio=? AND (comision IS NULL OR comision='')
             ORDER BY nombre
         """, (colegio,))
     else:
-        c.execute("""
-            SELECT * FROM profesores
+        c.execute(f"""
+            SELECT {campos} FROM profesores
             WHERE colegio=? AND comision=?
             ORDER BY nombre
         """, (colegio, com))
-    arr = []
-    for r in c.fetchall():
-        item = dict(r)
-        try:
-            item["extra_campos"] = json.loads(item.get("extra_campos") or "{}")
-        except Exception:
-            item["extra_campos"] = {}
-        arr.append(item)
+    resp = respuesta_listado("profesores", c, {"extra_campos": _extra_campos})
     conn.close()
-    return jsonify({"profesores": arr})
+    return resp
+
+
+def _extra_campos(texto):
+    try:
+        return json.loads(texto or "{}")
+    except Exception:
+        return {}
+
+
+def profesor_dict(row):
+    item = dict(row)
+    item["extra_campos"] = _extra_campos(item.get("extra_campos"))
+    return item
 
 
 @app.route("/profesores", methods=["POST"])
@@ -1420,10 +5686,179 @@ def eliminar_profesor(prof_id):
     return jsonify({"mensaje": "profesor eliminado"}), 200
 
 
+# =============== SINCRONIZACIÓN INCREMENTAL (APP MÓVIL) ===============
+# Los triggers de SYNC_TABLAS dan a cada fila insertada, modificada o borrada
+# una revisión creciente (por base: central o shard) y dejan una marca de
+# borrado. La app guarda la última revisión que vio y pide solo lo nuevo.
+SYNC_LOTE = int(os.environ.get("SYNC_LOTE", "500"))
+SYNC_LOTE_MAX = 5000
+
+# tabla -> (columnas, fila -> dict), con el mismo formato que los listados
+SYNC_FORMATO = {
+    "estudiantes": ("*", dict),
+    "profesores": ("*", profesor_dict),
+    "cursos": ("id, nombre, nivel, turno", dict),
+    "eventos": (EVENTO_COLUMNAS, evento_dict),
+    "documentos": (DOCUMENTO_COLUMNAS, documento_dict),
+}
+
+
+@app.route("/sync/<colegio>", methods=["GET"])
+def sincronizar(colegio):
+    """
+    Cambios del colegio posteriores a la revisión `since` (0 = todo).
+    ?since=<rev>&epoca=<epoca>&limite=500&tablas=estudiantes,cursos
+    {
+      "epoca": "...", "rev": 1234, "hay_mas": false, "completo": false,
+      "cambios": {"estudiantes": {"upsert": [{...}], "borrados": [12, 15]}, ...}
+    }
+    Se repite con since=rev mientras hay_mas sea true. Con "completo": true
+    la respuesta empieza desde 0 y el cliente debe reemplazar su copia (la
+    base se rehízo o los borrados que le faltan ya se podaron).
+    """
+    try:
+        since = int(request.args.get("since", 0))
+        limite = min(max(int(request.args.get("limite", SYNC_LOTE)), 1), SYNC_LOTE_MAX)
+    except ValueError:
+        return jsonify({"error": "since y limite deben ser enteros"}), 400
+    tablas = SYNC_TABLAS
+    if request.args.get("tablas"):
+        tablas = tuple(t for t in request.args["tablas"].split(",") if t)
+        if any(t not in SYNC_TABLAS for t in tablas):
+            return jsonify({"error": f"tablas válidas: {', '.join(SYNC_TABLAS)}"}), 400
+
+    conn = get_conn()
+    c = conn.cursor()
+    estado = c.execute("SELECT rev, epoca, podado_hasta FROM sync_estado").fetchone()
+    epoca = request.args.get("epoca")
+    completo = since > 0 and (
+        since > estado["rev"] or since < estado["podado_hasta"] or (epoca is not None and epoca != estado["epoca"])
+    )
+    if completo:
+        since = 0
+
+    marcas = ",".join("?" * len(tablas))
+    filtro = "" if since else " AND borrado = 0"  # la primera vez los borrados no sirven
+    c.execute(f"""
+        SELECT tabla, fila_id, rev, borrado FROM sync_revisiones
+        WHERE colegio = ? AND rev > ? AND tabla IN ({marcas}){filtro}
+        ORDER BY rev
+        LIMIT ?
+    """, (colegio, since, *tablas, limite + 1))
+    revisiones = c.fetchall()
+    hay_mas = len(revisiones) > limite
+    revisiones = revisiones[:limite]
+
+    cambios = {}
+    ids = {}
+    for r in revisiones:
+        tabla = cambios.setdefault(r["tabla"], {"upsert": [], "borrados": []})
+        if r["borrado"]:
+            tabla["borrados"].append(r["fila_id"])
+        else:
+            ids.setdefault(r["tabla"], []).append(r["fila_id"])
+    for tabla, fila_ids in ids.items():
+        columnas, formato = SYNC_FORMATO[tabla]
+        # si una fila se borró recién, su marca llega en una página siguiente
+        c.execute(f"""
+            SELECT {columnas} FROM {tabla} WHERE id IN ({",".join("?" * len(fila_ids))})
+        """, fila_ids)
+        cambios[tabla]["upsert"] = [formato(row) for row in c.fetchall()]
+    conn.close()
+
+    return jsonify({
+        "epoca": estado["epoca"],
+        # en la última página el cliente queda al día con la revisión actual
+        "rev": revisiones[-1]["rev"] if hay_mas else max([estado["rev"], since] + [r["rev"] for r in revisiones[-1:]]),
+        "hay_mas": hay_mas,
+        "completo": completo,
+        "cambios": cambios,
+    })
+
+
+@app.cli.command("podar-sync")
+@click.option("--dias", default=90, show_default=True, help="borrados más viejos que esto se eliminan")
+def podar_sync_cmd(dias):
+    """
+    Elimina las marcas de borrado viejas (flask --app app podar-sync --dias 90).
+    Un cliente que no sincroniza desde antes recibe "completo" y baja todo.
+    """
+    total = 0
+    for _colegio, conn in iterar_shards():
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            DELETE FROM sync_revisiones
+            WHERE borrado = 1 AND cambiado_en < datetime('now', 'localtime', ?)
+            RETURNING rev
+        """, (f"-{dias} days",))
+        revs = [r["rev"] for r in c.fetchall()]
+        if revs:
+            c.execute("UPDATE sync_estado SET podado_hasta = MAX(podado_hasta, ?)", (max(revs),))
+        conn.commit()
+        conn.close()
+        total += len(revs)
+    print(f"marcas de borrado eliminadas: {total}")
+
+
+# =============== ADMIN ===============
+@app.route("/admin/db_pool", methods=["GET"])
+def admin_db_pool():
+    if not _shard_pools:
+        return jsonify(db_pool.stats())
+    return jsonify({
+        "central": db_pool.stats(),
+        "shards": {colegio: _shard_pools[ruta].stats()
+                   for colegio, (_i, ruta) in _shards.items() if ruta in _shard_pools},
+    })
+
+
+@app.route("/admin/cola_marcaciones", methods=["GET"])
+def admin_cola_marcaciones():
+    return jsonify(cola_marcaciones.stats())
+
+
+@app.route("/admin/feed_marcaciones", methods=["GET"])
+def admin_feed_marcaciones():
+    return jsonify(feed_marcaciones.stats())
+
+
+@app.route("/admin/consultas_lentas", methods=["GET"])
+def admin_consultas_lentas():
+    """
+    Peores consultas (de todos los workers) y las últimas registradas.
+    ?orden=total_ms|max_ms|veces (por defecto total_ms), ?limite=20,
+    ?marcadas=1 solo las que tienen recorridos completos o B-tree temporales.
+    """
+    orden = request.args.get("orden", "total_ms")
+    if orden not in ("total_ms", "max_ms", "veces"):
+        return jsonify({"error": "orden debe ser total_ms, max_ms o veces"}), 400
+    try:
+        limite = max(1, int(request.args.get("limite", 20)))
+    except ValueError:
+        return jsonify({"error": "limite inválido"}), 400
+    peores, ultimas = consultas_lentas.juntar()
+    if request.args.get("marcadas") == "1":
+        peores = [r for r in peores if r["marcas"]]
+        ultimas = [u for u in ultimas if u["marcas"]]
+    peores.sort(key=lambda r: r[orden], reverse=True)
+    ultimas.sort(key=lambda u: u["cuando"], reverse=True)
+    return jsonify({
+        "umbral_ms": CONSULTAS_LENTAS_MS,
+        "peores": peores[:limite],
+        "ultimas": ultimas[:limite],
+    })
+
+
 # --- INICIALIZAR BD AL IMPORTAR ---
 init_db()
+if DB_SHARDS:
+    _cargar_shards()
+    for _indice, _ruta in _shards.values():
+        init_db(_ruta, central=False)
+cola_marcaciones.recuperar_huerfanos()
 
 if __name__ == "__main__":
-    # Solo para modo local; Render usará gunicorn app:app
+    # Solo para modo local; Render usará gunicorn app:app (con gunicorn.conf.py)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,455 @@
+"""
+Benchmark de los endpoints más usados de la API.
+
+1) Generar una base sintética (reproducible con --semilla):
+   python benchmark.py generar --dir bench_data --colegios 4 --usuarios 400 \
+       --marcaciones 200000 --anio 2025
+
+2) Medir con una mezcla de peticiones realista:
+   python benchmark.py carga --dir bench_data --segundos 20 --hilos 8 \
+       --mezcla puerta --guardar bench_baseline.json
+   python benchmark.py carga --dir bench_data --comparar bench_baseline.json
+
+Sin --url usa el test client de Flask sobre una copia de la base (cada corrida
+empieza con los mismos datos). Con --url http://127.0.0.1:8000 le pega a un
+servidor ya levantado (p.ej. DB_FILE=bench_data/colegios.db gunicorn app:app).
+"""
+import argparse
+import atexit
+import http.client
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import quote, urlsplit
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# operación -> peso, por escenario
+MEZCLAS = {
+    "normal": {
+        "marcar": 30, "libro": 15, "libro_rango": 10, "fecha_a_fecha": 10,
+        "estudiantes": 15, "documentos": 10, "descarga": 5, "descarga_rango": 5,
+    },
+    # hora de entrada: casi todo son marcaciones en la puerta
+    "puerta": {
+        "marcar": 85, "libro": 5, "fecha_a_fecha": 5, "estudiantes": 5,
+    },
+    "informes": {
+        "libro": 25, "libro_rango": 25, "fecha_a_fecha": 30, "estudiantes": 20,
+    },
+}
+
+NOMBRES = ["Ana", "Luis", "María", "José", "Carla", "Jorge", "Lucía", "Pedro", "Sofía", "Diego",
+           "Valeria", "Andrés", "Camila", "Mateo", "Daniela", "Rodrigo", "Paola", "Javier"]
+APELLIDOS = ["Quispe", "Mamani", "Flores", "Rojas", "Vargas", "Gutiérrez", "Choque", "Pérez",
+             "López", "Condori", "Fernández", "Torrez", "Ramos", "Suárez"]
+
+
+def _preparar_entorno(directorio):
+    """Apunta la app a los archivos del benchmark (antes de importar app)."""
+    directorio = os.path.abspath(directorio)
+    os.environ["DB_FILE"] = os.path.join(directorio, "colegios.db")
+    os.environ["UPLOAD_FOLDER"] = os.path.join(directorio, "uploads")
+    for var, sub in (("METRICAS_DIR", "metricas"), ("QR_CACHE_DIR", "qr_cache"),
+                     ("COLA_DIR", "cola_marcaciones"), ("ARCHIVO_DIR", "archivo")):
+        os.environ.setdefault(var, os.path.join(directorio, sub))
+    sys.path.insert(0, BASE_DIR)
+
+
+# =============== GENERADOR DE DATOS ===============
+def _dias_habiles(anio):
+    """Días de clase (lunes a viernes) de febrero a noviembre."""
+    dia, fin = date(anio, 2, 1), date(anio, 11, 30)
+    dias = []
+    while dia <= fin:
+        if dia.weekday() < 5:
+            dias.append(dia)
+        dia += timedelta(days=1)
+    return dias
+
+
+def generar(args):
+    if os.path.exists(os.path.join(args.dir, "colegios.db")):
+        sys.exit(f"{args.dir}/colegios.db ya existe: borrelo o use otro --dir")
+    os.makedirs(args.dir, exist_ok=True)
+    _preparar_entorno(args.dir)
+    import app  # crea el esquema en DB_FILE
+
+    rnd = random.Random(args.semilla)
+    inicio = time.perf_counter()
+    conn = sqlite3.connect(os.environ["DB_FILE"])
+    c = conn.cursor()
+    dias = _dias_habiles(args.anio)
+    colegios = [f"COLEGIO {i + 1}" for i in range(args.colegios)]
+
+    def persona():
+        return f"{rnd.choice(NOMBRES)} {rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)}"
+
+    for colegio in colegios:
+        c.execute("INSERT INTO colegios (nombre) VALUES (?)", (colegio,))
+        usuarios = [(persona(), f"u{i}@{colegio.replace(' ', '').lower()}.edu") for i in range(args.usuarios)]
+        c.executemany("""
+            INSERT INTO usuarios (nombre, email, password, rol, colegio) VALUES (?, ?, '1234', ?, ?)
+        """, [(n, e, "docente" if i % 10 else "admin", colegio) for i, (n, e) in enumerate(usuarios)])
+
+        # marcaciones: entrada 07:00-08:10 y salida 12:30-13:40, en orden de tiempo
+        marcaciones = []
+        for _ in range(args.marcaciones // args.colegios):
+            nombre, email = rnd.choice(usuarios)
+            tipo = rnd.choice(("entrada", "salida"))
+            base = 7 * 60 if tipo == "entrada" else 12 * 60 + 30
+            minuto = base + int(rnd.triangular(0, 70, 25))
+            ts = datetime.combine(rnd.choice(dias), datetime.min.time()) + timedelta(
+                minutes=minuto, seconds=rnd.randint(0, 59))
+            marcaciones.append((colegio, nombre, email, tipo, ts.strftime("%Y-%m-%d %H:%M:%S")))
+        marcaciones.sort(key=lambda m: m[4])
+        c.executemany("""
+            INSERT INTO asistencia_marcaciones (colegio, usuario_nombre, email, tipo, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        """, marcaciones)
+
+        cursos = []
+        for nivel in ("Primaria", "Secundaria"):
+            for grado in range(1, 7):
+                for paralelo in "AB":
+                    c.execute("""
+                        INSERT INTO cursos (colegio, nombre, nivel, turno) VALUES (?, ?, ?, 'Mañana')
+                    """, (colegio, f"{grado}{paralelo} {nivel[:3].upper()}", nivel))
+                    cursos.append((c.lastrowid, f"{grado}{paralelo} {nivel[:3].upper()}"))
+        c.executemany("""
+            INSERT INTO estudiantes (colegio, curso_id, nombre, rude, ci, fecha_nac, estado,
+                                     padre_nombre, padre_cel, madre_nombre, madre_cel)
+            VALUES (?, ?, ?, ?, ?, ?, 'EFECTIVO', ?, ?, ?, ?)
+        """, [
+            (colegio, rnd.choice(cursos)[0], persona(), f"{rnd.randint(10**13, 10**14 - 1)}",
+             str(rnd.randint(10**6, 10**7)), f"{rnd.randint(2008, 2019)}-0{rnd.randint(1, 9)}-1{rnd.randint(0, 9)}",
+             persona(), f"7{rnd.randint(10**6, 10**7 - 1)}", persona(), f"6{rnd.randint(10**6, 10**7 - 1)}")
+            for _ in range(args.estudiantes)
+        ])
+        c.executemany("""
+            INSERT INTO profesores (colegio, nombre, carnet, cargo, cel1, clases) VALUES (?, ?, ?, ?, ?, ?)
+        """, [
+            (colegio, persona(), str(rnd.randint(10**6, 10**7)), rnd.choice(("Docente", "Director", "Regente")),
+             f"7{rnd.randint(10**6, 10**7 - 1)}", ", ".join(rnd.sample([n for _i, n in cursos], 3)))
+            for _ in range(args.profesores)
+        ])
+
+        for q in range(args.formularios):
+            c.execute("""
+                INSERT INTO asistencia_qr (colegio, titulo, campos, fecha_inicio, qr_string)
+                VALUES (?, ?, '["nombre", "curso", "ci"]', ?, '')
+            """, (colegio, f"Reunión {q + 1}", rnd.choice(dias).isoformat()))
+            qr_id = c.lastrowid
+            c.execute("UPDATE asistencia_qr SET qr_string=? WHERE id=?",
+                      (json.dumps({"qr_id": qr_id, "colegio": colegio}), qr_id))
+            c.executemany("INSERT INTO asistencia_registros (qr_id, datos) VALUES (?, ?)", [
+                (qr_id, json.dumps({"nombre": persona(), "curso": rnd.choice(cursos)[1],
+                                    "ci": str(rnd.randint(10**6, 10**7))}))
+                for _ in range(args.registros)
+            ])
+
+        c.execute("INSERT OR IGNORE INTO documento_categorias (colegio, nombre) VALUES (?, 'General')",
+                  (colegio,))
+        for d in range(args.documentos):
+            tamano = rnd.randint(20, 800) * 1024
+            contenido = rnd.getrandbits(8 * tamano).to_bytes(tamano, "little")
+            with tempfile.TemporaryFile() as f:
+                f.write(contenido)
+                f.seek(0)
+                nombre_fisico, sha256, tamano = app.guardar_por_contenido(f)
+            c.execute("""
+                INSERT INTO documentos (nombre_original, nombre_fisico, colegio, categoria, subido_por,
+                                        sha256, tamano, mime)
+                VALUES (?, ?, ?, 'General', 'benchmark', ?, ?, 'application/pdf')
+            """, (f"documento_{d + 1}.pdf", nombre_fisico, colegio, sha256, tamano))
+        conn.commit()
+        print(f"  {colegio}: {len(marcaciones)} marcaciones")
+
+    app.reconstruir_personas(c)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    tam = os.path.getsize(os.environ["DB_FILE"]) / 1e6
+    print(f"base generada en {args.dir} ({tam:.1f} MB, {time.perf_counter() - inicio:.1f}s)")
+
+
+# =============== DRIVER DE CARGA ===============
+class ClienteFlask:
+    """Mismo uso que ClienteHTTP, sobre el test client (en proceso)."""
+
+    def __init__(self, app):
+        self.cliente = app.app.test_client()
+
+    def pedir(self, metodo, ruta, cuerpo=None, headers=None):
+        resp = self.cliente.open(ruta, method=metodo, json=cuerpo, headers=headers or {})
+        resp.get_data()  # consume el streaming
+        return resp.status_code
+
+
+class ClienteHTTP:
+    """Conexión keep-alive a un servidor levantado (se reabre si el servidor la cierra)."""
+
+    def __init__(self, url):
+        partes = urlsplit(url)
+        self.host, self.port = partes.hostname, partes.port or 80
+        self.conn = None
+
+    def pedir(self, metodo, ruta, cuerpo=None, headers=None):
+        headers = dict(headers or {})
+        datos = None
+        if cuerpo is not None:
+            datos = json.dumps(cuerpo).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        for intento in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.conn.request(metodo, ruta, body=datos, headers=headers)
+                resp = self.conn.getresponse()
+                resp.read()
+                if resp.getheader("Connection", "").lower() == "close":
+                    self.conn.close()
+                    self.conn = None
+                return resp.status
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close()
+                self.conn = None
+                if intento == 2:
+                    raise
+
+
+def _datos_de_prueba(db_file):
+    conn = sqlite3.connect(db_file)
+    conn.row_factory = sqlite3.Row
+    colegios = [r["nombre"] for r in conn.execute("SELECT nombre FROM colegios")]
+    personas = {}
+    for r in conn.execute("SELECT colegio, usuario_nombre, email FROM asistencia_personas"):
+        personas.setdefault(r["colegio"], []).append((r["usuario_nombre"], r["email"]))
+    documentos = [r["id"] for r in conn.execute("SELECT id FROM documentos")]
+    desde, hasta = conn.execute("""
+        SELECT MIN(timestamp), MAX(timestamp) FROM asistencia_marcaciones
+    """).fetchone()
+    conn.close()
+    if not colegios or not desde:
+        sys.exit("la base no tiene datos: corra primero 'python benchmark.py generar'")
+    return colegios, personas, documentos, desde[:10], hasta[:10]
+
+
+def _operaciones(colegios, personas, documentos, desde, hasta):
+    """operación -> función(rnd) que devuelve (método, ruta, cuerpo, headers)."""
+    d0 = date.fromisoformat(desde)
+    dias = (date.fromisoformat(hasta) - d0).days
+
+    def rango(rnd, max_dias):
+        ini = d0 + timedelta(days=rnd.randint(0, max(dias - max_dias, 0)))
+        return ini.isoformat(), (ini + timedelta(days=rnd.randint(1, max_dias))).isoformat()
+
+    def marcar(rnd):
+        colegio = rnd.choice(colegios)
+        nombre, email = rnd.choice(personas[colegio])
+        return "POST", "/asistencia_biometrico/marcar", {
+            "colegio": colegio, "usuario_nombre": nombre, "email": email,
+            "tipo": rnd.choice(("entrada", "salida")),
+        }, None
+
+    def libro(rnd):
+        return "GET", f"/asistencia_biometrico/registros/{quote(rnd.choice(colegios))}?limit=100", None, None
+
+    def libro_rango(rnd):
+        a, b = rango(rnd, 7)
+        return "GET", f"/asistencia_biometrico/registros/{quote(rnd.choice(colegios))}?desde={a}&hasta={b}", None, None
+
+    def fecha_a_fecha(rnd):
+        a, b = rango(rnd, 31)
+        return "GET", f"/asistencia_biometrico/fecha_a_fecha/{quote(rnd.choice(colegios))}?desde={a}&hasta={b}", None, None
+
+    def estudiantes(rnd):
+        return "GET", f"/estudiantes/{quote(rnd.choice(colegios))}", None, None
+
+    def documentos_(rnd):
+        return "GET", f"/documentos/{quote(rnd.choice(colegios))}?categoria=General", None, None
+
+    def descarga(rnd):
+        return "GET", f"/documentos/download/{rnd.choice(documentos)}", None, None
+
+    def descarga_rango(rnd):
+        inicio = rnd.randint(0, 16) * 1024
+        return "GET", f"/documentos/download/{rnd.choice(documentos)}", None, {
+            "Range": f"bytes={inicio}-{inicio + 65535}"}
+
+    ops = {
+        "marcar": marcar, "libro": libro, "libro_rango": libro_rango, "fecha_a_fecha": fecha_a_fecha,
+        "estudiantes": estudiantes, "documentos": documentos_,
+    }
+    if documentos:
+        ops.update(descarga=descarga, descarga_rango=descarga_rango)
+    return ops
+
+
+def _percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100.0 * (len(ordenados) - 1))))]
+
+
+def carga(args):
+    directorio = os.path.abspath(args.dir)
+    db_origen = os.path.join(directorio, "colegios.db")
+    if not os.path.exists(db_origen):
+        sys.exit(f"no existe {db_origen}: corra primero 'python benchmark.py generar'")
+    colegios, personas, documentos, desde, hasta = _datos_de_prueba(db_origen)
+
+    if args.url:
+        nuevo_cliente = lambda: ClienteHTTP(args.url)  # noqa: E731
+    else:
+        # cada corrida sobre una copia: las marcaciones no se acumulan entre corridas
+        copia = tempfile.mkdtemp(prefix="bench-")
+        # registrado antes de importar app: corre después de que la app vuelque sus métricas
+        atexit.register(shutil.rmtree, copia, True)
+        shutil.copy(db_origen, os.path.join(copia, "colegios.db"))
+        _preparar_entorno(copia)
+        os.environ["UPLOAD_FOLDER"] = os.path.join(directorio, "uploads")
+        import app
+        nuevo_cliente = lambda: ClienteFlask(app)  # noqa: E731
+
+    ops = _operaciones(colegios, personas, documentos, desde, hasta)
+    mezcla = {op: peso for op, peso in MEZCLAS[args.mezcla].items() if op in ops}
+    nombres, pesos = list(mezcla), list(mezcla.values())
+    lat = {op: [] for op in nombres}
+    errores = {op: 0 for op in nombres}
+    lock = threading.Lock()
+    calentamiento = time.monotonic() + args.calentamiento
+    fin = calentamiento + args.segundos
+
+    def trabajador(n):
+        rnd = random.Random(args.semilla * 1000 + n)
+        cliente = nuevo_cliente()
+        mias = {op: [] for op in nombres}
+        mios_err = {op: 0 for op in nombres}
+        while True:
+            ahora = time.monotonic()
+            if ahora >= fin:
+                break
+            op = rnd.choices(nombres, pesos)[0]
+            metodo, ruta, cuerpo, headers = ops[op](rnd)
+            t0 = time.perf_counter()
+            try:
+                status = cliente.pedir(metodo, ruta, cuerpo, headers)
+            except Exception:
+                status = 599
+            dt = time.perf_counter() - t0
+            if ahora >= calentamiento:
+                mias[op].append(dt)
+                if status >= 400 and status != 416:
+                    mios_err[op] += 1
+        with lock:
+            for op in nombres:
+                lat[op].extend(mias[op])
+                errores[op] += mios_err[op]
+
+    hilos = [threading.Thread(target=trabajador, args=(n,)) for n in range(args.hilos)]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+
+    resultados = {}
+    total = 0
+    for op in nombres:
+        ordenados = sorted(lat[op])
+        total += len(ordenados)
+        resultados[op] = {
+            "peticiones": len(ordenados),
+            "rps": round(len(ordenados) / args.segundos, 1),
+            "errores": errores[op],
+            "p50_ms": round(_percentil(ordenados, 50) * 1000, 2),
+            "p95_ms": round(_percentil(ordenados, 95) * 1000, 2),
+            "p99_ms": round(_percentil(ordenados, 99) * 1000, 2),
+        }
+    informe = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "mezcla": args.mezcla, "hilos": args.hilos, "segundos": args.segundos,
+            "semilla": args.semilla, "modo": args.url or "test_client",
+            "base_mb": round(os.path.getsize(db_origen) / 1e6, 1),
+        },
+        "total_rps": round(total / args.segundos, 1),
+        "resultados": resultados,
+    }
+    _imprimir(informe)
+    if args.comparar:
+        with open(args.comparar) as f:
+            _comparar(json.load(f), informe)
+    if args.guardar:
+        with open(args.guardar, "w") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+        print(f"baseline guardada en {args.guardar}")
+
+
+def _imprimir(informe):
+    print(f"\n{'operación':<16}{'pet.':>8}{'rps':>9}{'err':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op, r in informe["resultados"].items():
+        print(f"{op:<16}{r['peticiones']:>8}{r['rps']:>9}{r['errores']:>6}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+    print(f"total: {informe['total_rps']} peticiones/s")
+
+
+def _comparar(base, actual):
+    """Diferencia porcentual contra una corrida guardada (negativo = más rápido)."""
+    def delta(a, b):
+        return f"{(b - a) / a * 100:+.1f}%" if a else "  n/a"
+
+    print(f"\ncomparado con {base['fecha']} ({base['config']['mezcla']}, {base['config']['hilos']} hilos)")
+    print(f"{'operación':<16}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for op, r in actual["resultados"].items():
+        b = base["resultados"].get(op)
+        if not b:
+            continue
+        print(f"{op:<16}{delta(b['rps'], r['rps']):>10}{delta(b['p50_ms'], r['p50_ms']):>10}"
+              f"{delta(b['p95_ms'], r['p95_ms']):>10}{delta(b['p99_ms'], r['p99_ms']):>10}")
+    print(f"{'total':<16}{delta(base['total_rps'], actual['total_rps']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    g = sub.add_parser("generar", help="crea una base sintética")
+    g.add_argument("--dir", default="bench_data")
+    g.add_argument("--colegios", type=int, default=4)
+    g.add_argument("--usuarios", type=int, default=400, help="personas que marcan, por colegio")
+    g.add_argument("--marcaciones", type=int, default=200000, help="total, repartido entre colegios")
+    g.add_argument("--estudiantes", type=int, default=800, help="por colegio")
+    g.add_argument("--profesores", type=int, default=60, help="por colegio")
+    g.add_argument("--formularios", type=int, default=10, help="formularios QR por colegio")
+    g.add_argument("--registros", type=int, default=200, help="respuestas por formulario")
+    g.add_argument("--documentos", type=int, default=20, help="por colegio")
+    g.add_argument("--anio", type=int, default=datetime.now().year)
+    g.add_argument("--semilla", type=int, default=1)
+    g.set_defaults(func=generar)
+
+    c = sub.add_parser("carga", help="mide latencia y throughput")
+    c.add_argument("--dir", default="bench_data")
+    c.add_argument("--url", help="servidor ya levantado; si falta se usa el test client")
+    c.add_argument("--mezcla", choices=sorted(MEZCLAS), default="normal")
+    c.add_argument("--hilos", type=int, default=8)
+    c.add_argument("--segundos", type=float, default=20)
+    c.add_argument("--calentamiento", type=float, default=2)
+    c.add_argument("--semilla", type=int, default=1)
+    c.add_argument("--guardar", help="archivo JSON donde guardar esta corrida como baseline")
+    c.add_argument("--comparar", help="baseline JSON contra la cual comparar")
+    c.set_defaults(func=carga)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
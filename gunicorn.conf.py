@@ -0,0 +1,27 @@
+# Configuración de gunicorn (se carga sola con `gunicorn app:app` desde esta carpeta).
+#
+# El worker "sync" por defecto atiende una petición a la vez y mata a la que
+# pase de `timeout`: un solo stream en vivo (/asistencia_biometrico/stream/...)
+# dejaría la API sin responder. Con "gthread" cada worker atiende `threads`
+# peticiones a la vez y el timeout solo vigila que el worker siga vivo, así los
+# streams pueden durar SSE_MAX_S. Cada stream ocupa un hilo mientras dura, por
+# eso SSE_MAX_SUSCRIPTORES se limita a la mitad de los hilos: el resto queda
+# para la API.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+keepalive = 5
+
+os.environ.setdefault("SSE_MAX_S", "300")
+os.environ.setdefault("SSE_MAX_SUSCRIPTORES", str(max(1, threads // 2)))
+
+
+def post_worker_init(worker):
+    # un worker que reemplaza a uno caído recupera sus diarios de la cola de
+    # marcaciones al arrancar (con --preload el import no se repite)
+    from app import cola_marcaciones
+    cola_marcaciones.recuperar_huerfanos()
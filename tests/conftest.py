@@ -0,0 +1,20 @@
+"""
+Todos los módulos de prueba comparten una sola app (se importa una vez por
+proceso): sus archivos van a una carpeta temporal que se fija antes del import.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="test_colegios_")
+atexit.register(shutil.rmtree, _TMP, True)
+for _var, _nombre in (("DB_FILE", "colegios.db"), ("UPLOAD_FOLDER", "uploads"),
+                      ("METRICAS_DIR", "metricas"), ("QR_CACHE_DIR", "qr_cache"),
+                      ("COLA_DIR", "cola_marcaciones"), ("ARCHIVO_DIR", "archivo")):
+    os.environ[_var] = os.path.join(_TMP, _nombre)
+os.environ["METRICAS"] = "0"
+os.environ["CONSULTAS_LENTAS_MS"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
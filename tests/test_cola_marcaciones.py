@@ -0,0 +1,124 @@
+"""
+Cola de escritura del biométrico (MARCAR_MODO_COLA): lo encolado llega a
+SQLite, un diario de un worker caído se recupera, y una fila que la base
+rechaza va a descartadas.jsonl sin trabar a las demás ni al import.
+"""
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import app as api  # entorno temporal en conftest.py
+
+COLEGIO = "COLA PRUEBA"
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _fila(nombre, usuario_nombre=None):
+    return (COLEGIO, None, usuario_nombre or nombre, "", "entrada", "2025-05-05 07:00:00")
+
+
+def _guardados():
+    conn = sqlite3.connect(api.DB_FILE)
+    try:
+        return {r[0] for r in conn.execute(
+            "SELECT usuario_nombre FROM asistencia_marcaciones WHERE colegio=?", (COLEGIO,))}
+    finally:
+        conn.close()
+
+
+def _diarios(directorio):
+    return [n for n in os.listdir(directorio) if n.startswith("seg-")]
+
+
+@pytest.fixture
+def cola(tmp_path):
+    # flush_ms alto: el hilo no se adelanta, cada prueba llama a flush()
+    cola = api.ColaMarcaciones(str(tmp_path), 100, 60_000, 1000)
+    yield cola
+    cola.cerrar()
+
+
+def _caer_con(directorio, filas):
+    """Un proceso hijo encola `filas` y muere sin flush: deja su diario huérfano."""
+    pid = os.fork()
+    if pid == 0:
+        hijo = api.ColaMarcaciones(directorio, 100, 60_000, 1000)
+        for fila in filas:
+            hijo.encolar(fila)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_encolar_y_flush_guarda(cola, tmp_path):
+    for i in range(3):
+        assert cola.encolar(_fila(f"encolada {i}"))
+    assert cola.stats()["profundidad"] == 3
+
+    assert cola.flush() == 3
+    assert {f"encolada {i}" for i in range(3)} <= _guardados()
+    stats = cola.stats()
+    assert stats["profundidad"] == 0 and stats["escritas"] == 3
+    # solo queda el diario activo, vacío
+    (activo,) = _diarios(tmp_path)
+    assert os.path.getsize(tmp_path / activo) == 0
+
+
+def test_recupera_diario_tras_caida(tmp_path):
+    _caer_con(str(tmp_path), [_fila("caida 1"), _fila("caida 2")])
+    assert _diarios(tmp_path)
+
+    api.ColaMarcaciones(str(tmp_path), 100, 60_000, 1000).recuperar_huerfanos()
+    assert {"caida 1", "caida 2"} <= _guardados()
+    assert not _diarios(tmp_path)
+
+
+def test_fila_mala_no_traba_las_siguientes(cola, tmp_path):
+    cola.encolar(_fila("antes"))
+    cola.encolar(_fila("mala", usuario_nombre={"no": "texto"}))
+    cola.encolar(_fila("despues"))
+    assert cola.flush() == 2
+    cola.encolar(_fila("otra vez"))
+    assert cola.flush() == 1
+
+    assert {"antes", "despues", "otra vez"} <= _guardados()
+    stats = cola.stats()
+    assert stats["profundidad"] == 0 and stats["descartadas"] == 1
+    with open(tmp_path / "descartadas.jsonl", encoding="utf-8") as f:
+        (descartada,) = [json.loads(linea) for linea in f]
+    assert descartada["fila"][2] == {"no": "texto"}
+    # los reintentos no dejan diarios de más
+    assert len(_diarios(tmp_path)) == 1
+
+
+def test_diario_con_fila_mala_no_rompe_el_import(tmp_path):
+    _caer_con(str(tmp_path), [_fila("mala", usuario_nombre={"no": "texto"}),
+                              _fila("tras import")])
+    entorno = dict(os.environ, COLA_DIR=str(tmp_path))
+    proc = subprocess.run([sys.executable, "-c", "import app"], cwd=RAIZ, env=entorno,
+                          capture_output=True, text=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr
+    assert "tras import" in _guardados()
+    assert not _diarios(tmp_path)
+    assert (tmp_path / "descartadas.jsonl").exists()
+
+
+def test_marcar_en_cola_valida_antes_de_encolar(monkeypatch, tmp_path):
+    monkeypatch.setattr(api, "MARCAR_MODO_COLA", True)
+    monkeypatch.setattr(api, "cola_marcaciones", api.ColaMarcaciones(str(tmp_path), 100, 60_000, 1000))
+    cliente = api.app.test_client()
+
+    resp = cliente.post("/asistencia_biometrico/marcar", json={
+        "colegio": COLEGIO, "usuario_nombre": {"no": "texto"}, "tipo": "entrada"})
+    assert resp.status_code == 400
+    assert api.cola_marcaciones.stats()["activa"] is False  # nada se encoló
+
+    resp = cliente.post("/asistencia_biometrico/marcar", json={
+        "colegio": COLEGIO, "usuario_nombre": "por http", "tipo": "entrada"})
+    assert resp.status_code == 202
+    api.cola_marcaciones.flush()
+    api.cola_marcaciones.cerrar()
+    assert "por http" in _guardados()
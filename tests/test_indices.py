@@ -0,0 +1,83 @@
+"""
+Los reportes del biométrico deben resolverse con los índices de
+asistencia_marcaciones (ver init_db) y no con un recorrido completo.
+Se capturan las consultas que hace cada endpoint y se revisa su
+EXPLAIN QUERY PLAN.
+"""
+import re
+import sqlite3
+
+import pytest
+
+import app as api  # entorno temporal en conftest.py
+
+COLEGIO = "LAS ROSAS"
+
+
+@pytest.fixture(scope="module")
+def consultas():
+    """Cliente de prueba y lista con cada SQL que ejecutan sus conexiones."""
+    conn = sqlite3.connect(api.DB_FILE)
+    conn.executemany("""
+        INSERT INTO asistencia_marcaciones (colegio, usuario_nombre, email, tipo, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(colegio, f"persona {i % 20}", f"p{i % 20}@x.com", "entrada" if i % 2 else "salida",
+           f"2025-{1 + i % 12:02d}-{1 + i % 28:02d} 07:{i % 60:02d}:00")
+          for colegio in (COLEGIO, "OTRO") for i in range(500)])
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+    sql = []
+    abrir = api._abrir_conexion
+
+    def abrir_con_traza(ruta=api.DB_FILE):
+        raw = abrir(ruta)
+        raw.set_trace_callback(sql.append)
+        return raw
+
+    pool = api.db_pool
+    api._abrir_conexion = abrir_con_traza
+    api.db_pool = api.ConnectionPool(api.DB_POOL_SIZE, api.DB_POOL_TIMEOUT)
+    try:
+        yield api.app.test_client(), sql
+    finally:
+        api._abrir_conexion = abrir
+        api.db_pool = pool
+
+
+def _planes(sql):
+    """Detalle del plan de cada SELECT sobre asistencia_marcaciones."""
+    conn = sqlite3.connect(api.DB_FILE)
+    try:
+        return [
+            " | ".join(r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + s))
+            for s in sql
+            if s.lstrip().upper().startswith("SELECT") and "asistencia_marcaciones" in s
+        ]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("url, indice", [
+    (f"/asistencia_biometrico/registros/{COLEGIO}?desde=2025-03-01&hasta=2025-03-31",
+     "idx_marcaciones_colegio_ts"),
+    (f"/asistencia_biometrico/registros/{COLEGIO}?limit=50", "idx_marcaciones_colegio_ts"),
+    (f"/asistencia_biometrico/export/{COLEGIO}.csv?desde=2025-03-01&hasta=2025-03-31",
+     "idx_marcaciones_colegio_ts"),
+    (f"/asistencia_marcaciones/detalle_usuario/{COLEGIO}"
+     "?nombre=persona%203&email=p3@x.com&desde=2025-01-01&hasta=2025-06-30",
+     "idx_marcaciones_colegio_usuario_ts"),
+])
+def test_reportes_usan_indice(consultas, url, indice):
+    cliente, sql = consultas
+    del sql[:]
+    resp = cliente.get(url)
+    assert resp.status_code == 200
+    resp.get_data()  # los CSV se consultan al recorrer la respuesta
+
+    planes = _planes(sql)
+    assert planes, f"{url} no consultó asistencia_marcaciones"
+    for plan in planes:
+        assert f"USING INDEX {indice}" in plan or f"USING COVERING INDEX {indice}" in plan, plan
+        assert not re.search(r"\bSCAN (\w+\.)?(asistencia_marcaciones|m)\b", plan), plan
@@ -0,0 +1,103 @@
+"""
+Sesiones con token firmado: un token revocado da 401 (también si lo revocó
+otro worker), otro colegio da 403 y el registro público no crea admins.
+"""
+import sqlite3
+import time
+
+import pytest
+
+import app as api  # entorno temporal en conftest.py
+
+COLEGIO = "SESION UNO"
+OTRO = "SESION DOS"
+
+
+def _usuario(cliente, email, colegio):
+    resp = cliente.post("/registrar_usuario", json={
+        "nombre": email, "email": email, "password": "clave", "colegio": colegio})
+    assert resp.status_code == 200
+    resp = cliente.post("/login", json={"email": email, "password": "clave", "colegio": colegio})
+    assert resp.status_code == 200
+    return resp.get_json()
+
+
+def _auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture(scope="module")
+def cliente():
+    return api.app.test_client()
+
+
+def test_token_revocado_da_401(cliente):
+    token = _usuario(cliente, "salir@x.com", COLEGIO)["token"]
+    assert cliente.get(f"/estudiantes/{COLEGIO}", headers=_auth(token)).status_code == 200
+
+    assert cliente.post("/logout", headers=_auth(token)).status_code == 200
+    resp = cliente.get(f"/estudiantes/{COLEGIO}", headers=_auth(token))
+    assert resp.status_code == 401
+
+
+def test_revocado_por_otro_worker_da_401(cliente, monkeypatch):
+    token = _usuario(cliente, "otro.worker@x.com", COLEGIO)["token"]
+    datos, _emitido = api.leer_token(token)
+    # /logout atendido por otro proceso: solo queda la fila en la central
+    conn = sqlite3.connect(api.DB_FILE)
+    conn.execute("INSERT INTO sesiones_revocadas (jti, vence) VALUES (?, ?)",
+                 (datos["jti"], time.time() + 60))
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(api.tokens_revocados, "refresco_s", 0)
+    resp = cliente.get(f"/estudiantes/{COLEGIO}", headers=_auth(token))
+    assert resp.status_code == 401
+
+
+def test_otro_colegio_da_403(cliente):
+    token = _usuario(cliente, "ajeno@x.com", COLEGIO)["token"]
+    propio = _usuario(cliente, "propio@x.com", OTRO)["token"]
+    resp = cliente.post("/estudiantes", headers=_auth(propio),
+                        json={"colegio": OTRO, "curso_id": 1, "nombre": "de otro"})
+    assert resp.status_code == 200
+    conn = sqlite3.connect(api.DB_FILE)
+    (est_id,) = conn.execute("SELECT MAX(id) FROM estudiantes WHERE colegio=?", (OTRO,)).fetchone()
+    conn.close()
+
+    assert cliente.get(f"/estudiantes/{OTRO}", headers=_auth(token)).status_code == 403
+    assert cliente.get(f"/estudiantes/{COLEGIO}?colegio={OTRO}",
+                       headers=_auth(token)).status_code == 403
+    resp = cliente.put(f"/estudiantes/{est_id}", headers=_auth(token), json={"nombre": "x"})
+    assert resp.status_code == 403
+    resp = cliente.put(f"/estudiantes/{est_id}", headers=_auth(propio), json={"nombre": "y"})
+    assert resp.status_code == 200
+
+
+def test_registro_publico_no_crea_admin(cliente):
+    resp = cliente.post("/registrar_usuario", json={
+        "nombre": "intruso", "email": "intruso@x.com", "password": "clave",
+        "colegio": COLEGIO, "rol": "admin"})
+    assert resp.status_code == 403
+    conn = sqlite3.connect(api.DB_FILE)
+    assert conn.execute("SELECT 1 FROM usuarios WHERE email='intruso@x.com'").fetchone() is None
+    conn.close()
+
+    assert _usuario(cliente, "nuevo@x.com", COLEGIO)["rol"] == "docente"
+
+
+def test_admin_puede_asignar_rol(cliente):
+    _usuario(cliente, "jefe@x.com", COLEGIO)
+    conn = sqlite3.connect(api.DB_FILE)
+    conn.execute("UPDATE usuarios SET rol='admin' WHERE email='jefe@x.com'")
+    conn.commit()
+    conn.close()
+    token = cliente.post("/login", json={
+        "email": "jefe@x.com", "password": "clave", "colegio": COLEGIO}).get_json()["token"]
+
+    resp = cliente.post("/registrar_usuario", headers=_auth(token), json={
+        "nombre": "segundo", "email": "segundo@x.com", "password": "clave",
+        "colegio": COLEGIO, "rol": "admin"})
+    assert resp.status_code == 200
+    login = cliente.post("/login", json={
+        "email": "segundo@x.com", "password": "clave", "colegio": COLEGIO}).get_json()
+    assert login["rol"] == "admin"
@@ -0,0 +1,92 @@
+"""
+Con DB_SHARDS=1 y dos colegios partidos a su propio shard, las rutas que
+solo traen un id (/estudiantes/<id>, /asistencia_qr/registros/<id>) van al
+shard correcto, con ids de antes y de después de partir, y los listados de
+un colegio no muestran filas del otro.
+"""
+import sqlite3
+
+import pytest
+
+import app as api  # entorno temporal en conftest.py
+
+COLEGIOS = ("SHARD UNO", "SHARD DOS")
+
+
+def _crear(cliente, colegio, etiqueta):
+    """Un estudiante y un formulario QR con una respuesta; devuelve sus ids."""
+    nombre = f"{etiqueta} {colegio}"
+    resp = cliente.post("/estudiantes", json={"colegio": colegio, "curso_id": 1, "nombre": nombre})
+    assert resp.status_code == 200
+    resp = cliente.post("/asistencia_qr", json={
+        "colegio": colegio, "titulo": nombre, "fecha_inicio": "2025-01-01", "fecha_fin": "2025-12-31"})
+    assert resp.status_code == 200
+    qr_id = resp.get_json()["item"]["id"]
+    resp = cliente.post("/asistencia_qr/registrar", json={"qr_id": qr_id, "datos": {"de": nombre}})
+    assert resp.status_code == 200
+    resp = cliente.get(f"/estudiantes/{colegio}")
+    (est_id,) = [e["id"] for e in resp.get_json()["estudiantes"] if e["nombre"] == nombre]
+    return {"nombre": nombre, "est_id": est_id, "qr_id": qr_id}
+
+
+@pytest.fixture(scope="module")
+def shards(tmp_path_factory):
+    parche = pytest.MonkeyPatch()
+    parche.setattr(api, "DB_SHARDS", True)
+    parche.setattr(api, "SHARDS_DIR", str(tmp_path_factory.mktemp("shards")))
+    cliente = api.app.test_client()
+    # las filas "antes" nacen en la central y se mudan con crear_shard
+    filas = {(colegio, "antes"): _crear(cliente, colegio, "antes") for colegio in COLEGIOS}
+    for colegio in COLEGIOS:
+        assert api.crear_shard(colegio)
+    filas.update({(colegio, "despues"): _crear(cliente, colegio, "despues") for colegio in COLEGIOS})
+    try:
+        yield cliente, filas
+    finally:
+        parche.undo()
+
+
+def _en_base(ruta, sql, params):
+    conn = sqlite3.connect(ruta)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def test_ids_nuevos_llevan_el_indice_del_shard(shards):
+    _cliente, filas = shards
+    for colegio in COLEGIOS:
+        indice, _ruta = api.shard_de(colegio)
+        assert filas[(colegio, "despues")]["est_id"] // api.SHARD_ID_RANGO == indice
+        assert filas[(colegio, "antes")]["est_id"] // api.SHARD_ID_RANGO == 0
+
+
+@pytest.mark.parametrize("colegio", COLEGIOS)
+@pytest.mark.parametrize("etapa", ["antes", "despues"])
+def test_rutas_por_id_van_a_su_shard(shards, colegio, etapa):
+    cliente, filas = shards
+    fila = filas[(colegio, etapa)]
+    _indice, ruta = api.shard_de(colegio)
+
+    resp = cliente.put(f"/estudiantes/{fila['est_id']}", json={"nombre": fila["nombre"] + " editado"})
+    assert resp.status_code == 200
+    assert _en_base(ruta, "SELECT nombre FROM estudiantes WHERE id=?", (fila["est_id"],)) == [
+        (fila["nombre"] + " editado",)]
+    assert _en_base(api.DB_FILE, "SELECT 1 FROM estudiantes WHERE id=?", (fila["est_id"],)) == []
+
+    resp = cliente.get(f"/asistencia_qr/registros/{fila['qr_id']}")
+    assert resp.status_code == 200
+    assert [r["datos"] for r in resp.get_json()["registros"]] == [{"de": fila["nombre"]}]
+
+
+@pytest.mark.parametrize("colegio", COLEGIOS)
+def test_listados_no_se_mezclan(shards, colegio):
+    cliente, filas = shards
+    propios = {filas[(colegio, etapa)]["est_id"] for etapa in ("antes", "despues")}
+
+    estudiantes = cliente.get(f"/estudiantes/{colegio}").get_json()["estudiantes"]
+    assert {e["id"] for e in estudiantes} == propios
+    items = cliente.get(f"/asistencia_qr/{colegio}").get_json()["items"]
+    assert {i["colegio"] for i in items} == {colegio}
+    assert {i["id"] for i in items} == {filas[(colegio, etapa)]["qr_id"] for etapa in ("antes", "despues")}